@@ -1,27 +1,80 @@
 
 from django.contrib import admin
-from .models import UserProfile, LoginLog, DigitalSignature
+from .models import UserProfile, FaceTemplate, LoginLog, DigitalSignature, LoginStat
+from .face_templates import refresh_mean
+from .rate_limit import lockout_remaining, unlock
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
-    list_display = ('user', 'has_face_data', 'has_keys', 'login_attempts', 'is_locked')
+    list_display = ('user', 'has_face_data', 'has_keys', 'encoding_version', 'key_algorithm', 'is_locked')
+    list_filter = ('has_face_data', 'has_keys', 'key_algorithm')
     search_fields = ('user__username', 'user__email')
-    list_filter = ('is_locked',)
+    list_select_related = ('user',)
+    readonly_fields = ('has_face_data', 'has_keys', 'encoding_version')
+    actions = ['unlock_accounts']
     
-    def has_face_data(self, obj):
-        return bool(obj.face_encoding)
-    has_face_data.boolean = True
+    def get_queryset(self, request):
+        # The changelist only shows flags; the change form loads the keys it edits on access
+        return super().get_queryset(request).defer(*UserProfile.HEAVY_FIELDS)
     
-    def has_keys(self, obj):
-        return bool(obj.public_key and obj.private_key)
-    has_keys.boolean = True
+    def is_locked(self, obj):
+        return bool(lockout_remaining(obj.user.username))
+    is_locked.boolean = True
+    
+    @admin.action(description="Unlock selected accounts")
+    def unlock_accounts(self, request, queryset):
+        for username in queryset.values_list('user__username', flat=True):
+            unlock(username)
+        self.message_user(request, f"Unlocked {queryset.count()} accounts.")
+
+@admin.register(FaceTemplate)
+class FaceTemplateAdmin(admin.ModelAdmin):
+    list_display = ('user', 'source', 'created_at')
+    list_filter = ('source',)
+    search_fields = ('user__username',)
+    list_select_related = ('user',)
+    exclude = ('encoding',)
+    
+    def has_add_permission(self, request):
+        # Templates come from face captures, not from typing in an encoding
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        refresh_mean(obj.user_id)
+    
+    def delete_queryset(self, request, queryset):
+        user_ids = set(queryset.values_list('user_id', flat=True))
+        super().delete_queryset(request, queryset)
+        # Keep each user's mean template, and so their gallery entry, in step
+        for user_id in user_ids:
+            refresh_mean(user_id)
 
 @admin.register(LoginLog)
 class LoginLogAdmin(admin.ModelAdmin):
     list_display = ('user', 'timestamp', 'successful', 'ip_address', 'face_match_score')
     list_filter = ('successful', 'timestamp')
     search_fields = ('user__username', 'ip_address')
-    date_hierarchy = 'timestamp'
+    list_select_related = ('user',)
+    # The raw table is huge: no date drill-down or full COUNT(*); use Login stats for summaries
+    show_full_result_count = False
+
+@admin.register(LoginStat)
+class LoginStatAdmin(admin.ModelAdmin):
+    list_display = ('user', 'granularity', 'bucket', 'successes', 'failures', 'score_mean', 'score_min', 'distinct_ips')
+    list_filter = ('granularity',)
+    search_fields = ('user__username',)
+    date_hierarchy = 'bucket'
+    list_select_related = ('user',)
+    
+    def score_mean(self, obj):
+        return round(obj.score_mean, 3) if obj.score_mean is not None else None
+    
+    def distinct_ips(self, obj):
+        return f"{obj.distinct_ips}+" if obj.ips_truncated else obj.distinct_ips
 
 @admin.register(DigitalSignature)
 class DigitalSignatureAdmin(admin.ModelAdmin):
@@ -0,0 +1,233 @@
+"""Approximate nearest-neighbour search over face encodings
+
+An inverted-file (IVF) index partitions the encodings into ``nlist`` k-means
+cells and only scans the ``nprobe`` cells closest to a probe. Cells either
+hold the raw vectors or, with product quantization (PQ), ``m`` one-byte codes
+per vector whose distances are looked up from a per-probe table.
+
+Only the trained quantizers are persisted; inverted lists are rebuilt from the
+gallery on load, so the saved file never goes stale when profiles change.
+"""
+import numpy as np
+
+CHUNK_SIZE = 65536
+
+
+def nearest_centroids(vectors, centroids, count=1):
+    """Return the indices of the ``count`` closest centroids for each vector"""
+    centroid_sq = np.einsum('ij,ij->i', centroids, centroids)
+    result = np.empty((len(vectors), count), dtype=np.int64)
+    for start in range(0, len(vectors), CHUNK_SIZE):
+        # |v|^2 is constant per row, so it does not change the ranking
+        scores = centroid_sq - 2.0 * (vectors[start:start + CHUNK_SIZE] @ centroids.T)
+        if count == 1:
+            result[start:start + CHUNK_SIZE, 0] = scores.argmin(axis=1)
+        else:
+            part = np.argpartition(scores, count - 1, axis=1)[:, :count]
+            order = np.take_along_axis(scores, part, axis=1).argsort(axis=1)
+            result[start:start + CHUNK_SIZE] = np.take_along_axis(part, order, axis=1)
+    return result
+
+
+def kmeans(vectors, k, iterations=20, seed=0, sample_size=None):
+    """Plain Lloyd's k-means; returns a ``(k, dim)`` float32 centroid matrix"""
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if sample_size and len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    if len(vectors) < k:
+        raise ValueError(f"Need at least {k} vectors to train {k} centroids, got {len(vectors)}")
+
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(vectors, centroids)[:, 0]
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty cells from random points so no centroid is wasted
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+    return centroids
+
+
+class ProductQuantizer:
+    """Split vectors into ``m`` sub-vectors, each coded by a 256-entry codebook"""
+
+    def __init__(self, dimension, m, codebooks=None):
+        if dimension % m:
+            raise ValueError(f"PQ sub-quantizer count {m} must divide dimension {dimension}")
+        self.dimension = dimension
+        self.m = m
+        self.sub_dimension = dimension // m
+        self.codebooks = codebooks  # (m, 256, sub_dimension)
+
+    def train(self, vectors, iterations=20, seed=0, sample_size=65536):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.codebooks = np.stack([
+            kmeans(self._split(vectors, j), 256, iterations, seed + j, sample_size)
+            for j in range(self.m)
+        ])
+        return self
+
+    def _split(self, vectors, j):
+        return vectors[:, j * self.sub_dimension:(j + 1) * self.sub_dimension]
+
+    def encode(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = nearest_centroids(self._split(vectors, j), self.codebooks[j])[:, 0]
+        return codes
+
+    def distance_table(self, vector):
+        """Squared distance from each sub-vector of ``vector`` to every code, shape ``(m, 256)``"""
+        sub_vectors = vector.reshape(self.m, 1, self.sub_dimension)
+        return ((self.codebooks - sub_vectors) ** 2).sum(axis=2)
+
+
+class _InvertedList:
+    """Growable arrays of ids and payloads (raw vectors or PQ codes) for one cell"""
+
+    def __init__(self, width, dtype):
+        self.ids = np.zeros(16, dtype=np.int64)
+        self.data = np.zeros((16, width), dtype=dtype)
+        self.size = 0
+
+    def append(self, item_id, payload):
+        if self.size == len(self.ids):
+            self.ids = np.resize(self.ids, 2 * self.size)
+            self.data = np.resize(self.data, (2 * self.size, self.data.shape[1]))
+        self.ids[self.size] = item_id
+        self.data[self.size] = payload
+        self.size += 1
+        return self.size - 1
+
+    def pop_swap(self, position):
+        """Remove ``position`` by moving the last entry into it; returns the moved id or None"""
+        last = self.size - 1
+        moved = None
+        if position != last:
+            self.ids[position] = self.ids[last]
+            self.data[position] = self.data[last]
+            moved = int(self.ids[position])
+        self.size = last
+        return moved
+
+
+class IVFIndex:
+    """Inverted-file index with optional product quantization
+
+    ``nprobe`` trades recall for latency at query time; ``nlist`` and ``pq_m``
+    are fixed when the quantizers are trained.
+    """
+
+    def __init__(self, centroids, pq=None, nprobe=8):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.dimension = self.centroids.shape[1]
+        self.pq = pq
+        self.nprobe = nprobe
+        self.clear()
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, vectors, nlist, pq_m=0, nprobe=8, iterations=20, seed=0, sample_size=262144):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        centroids = kmeans(vectors, nlist, iterations, seed, sample_size)
+        pq = None
+        if pq_m:
+            # PQ codes the residual from the cell centroid, which is far smaller than the vector
+            sample = vectors[:sample_size]
+            residuals = sample - centroids[nearest_centroids(sample, centroids)[:, 0]]
+            pq = ProductQuantizer(vectors.shape[1], pq_m).train(residuals, iterations, seed)
+        return cls(centroids, pq, nprobe)
+
+    def clear(self):
+        if self.pq is not None:
+            width, dtype = self.pq.m, np.uint8
+        else:
+            width, dtype = self.dimension, np.float32
+        self._lists = [_InvertedList(width, dtype) for _ in range(self.nlist)]
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, item_id):
+        return item_id in self._positions
+
+    def add(self, ids, vectors):
+        """Insert (or re-insert) a batch of vectors"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        cells = nearest_centroids(vectors, self.centroids)[:, 0]
+        if self.pq is not None:
+            payloads = self.pq.encode(vectors - self.centroids[cells])
+        else:
+            payloads = vectors
+        for item_id, cell, payload in zip(ids, cells, payloads):
+            item_id = int(item_id)
+            self.remove(item_id)
+            self._positions[item_id] = (int(cell), self._lists[cell].append(item_id, payload))
+
+    def remove(self, item_id):
+        location = self._positions.pop(item_id, None)
+        if location is None:
+            return False
+        cell, position = location
+        moved = self._lists[cell].pop_swap(position)
+        if moved is not None:
+            self._positions[moved] = (cell, position)
+        return True
+
+    def search(self, probe, k, nprobe=None):
+        """Return ``(ids, approximate squared distances)`` of up to ``k`` neighbours"""
+        probe = np.asarray(probe, dtype=np.float32).reshape(self.dimension)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        cells = nearest_centroids(probe[None, :], self.centroids, nprobe)[0]
+
+        found_ids, found_distances = [], []
+        for cell in cells:
+            inverted = self._lists[cell]
+            if not inverted.size:
+                continue
+            data = inverted.data[:inverted.size]
+            if self.pq is not None:
+                table = self.pq.distance_table(probe - self.centroids[cell])
+                distances = table[np.arange(self.pq.m), data].sum(axis=1)
+            else:
+                diff = data - probe
+                distances = np.einsum('ij,ij->i', diff, diff)
+            found_ids.append(inverted.ids[:inverted.size])
+            found_distances.append(distances)
+
+        if not found_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids = np.concatenate(found_ids)
+        distances = np.concatenate(found_distances)
+        k = min(k, len(ids))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return ids[nearest], distances[nearest]
+
+    def save(self, path):
+        """Persist the trained quantizers (not the inverted lists)"""
+        arrays = {'centroids': self.centroids}
+        if self.pq is not None:
+            arrays['pq_codebooks'] = self.pq.codebooks
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path, nprobe=8):
+        with np.load(path) as arrays:
+            centroids = arrays['centroids']
+            pq = None
+            if 'pq_codebooks' in arrays:
+                codebooks = arrays['pq_codebooks']
+                pq = ProductQuantizer(centroids.shape[1], len(codebooks), codebooks)
+        return cls(centroids, pq, nprobe)
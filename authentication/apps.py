@@ -5,4 +5,9 @@ class AuthenticationConfig(AppConfig):
     name = 'authentication'
     
     def ready(self):
-        import authentication.signals
\ No newline at end of file
+        import authentication.signals
+        # Registers the database query timer
+        import authentication.timing
+        # Lockouts kept in an evicting per-process cache could be lifted by flooding it
+        from authentication.rate_limit import check_cache_backend
+        check_cache_backend()
\ No newline at end of file
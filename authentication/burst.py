@@ -0,0 +1,124 @@
+"""Verify a short burst of webcam frames against one user's enrolled face templates
+
+Frames are compared one at a time, in the order they arrive, and the burst
+stops as soon as a decision is reached:
+
+* a frame matches within ``FACE_BURST_ACCEPT_DISTANCE`` (stricter than the
+  tolerance): confident match;
+* a frame with a face is further than ``FACE_BURST_REJECT_DISTANCE``: a
+  different person, more frames will not help;
+* ``FACE_BURST_MAX_FRAMES`` frames were compared or ``FACE_BURST_TIME_BUDGET``
+  seconds have passed: the best frame so far decides, under the usual tolerance.
+
+Frames are pulled lazily from an iterator, so frames after the decision are
+never decoded (and, for a streamed body, never read). Blurry frames without a
+face only cost their own detection pass.
+"""
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .face_pool import run_face_task, run_face_task_async
+from .face_utils import match_face_data, match_image_data
+
+frames_compared = metrics.counter('face_burst_frames', "Burst frames compared, by outcome")
+bursts_finished = metrics.counter('face_burst_decisions', "Bursts verified, by the reason they stopped")
+
+
+class BurstResult:
+    """Per-frame outcomes of a burst and the decision they led to"""
+
+    def __init__(self):
+        tolerance = getattr(settings, 'FACE_RECOGNITION_TOLERANCE', 0.6)
+        self.accept_score = 1 - getattr(settings, 'FACE_BURST_ACCEPT_DISTANCE', tolerance - 0.1)
+        self.reject_score = 1 - getattr(settings, 'FACE_BURST_REJECT_DISTANCE', tolerance + 0.2)
+        self.max_frames = getattr(settings, 'FACE_BURST_MAX_FRAMES', 5)
+        self.deadline = time.monotonic() + getattr(settings, 'FACE_BURST_TIME_BUDGET', 3.0)
+        self.frames = []
+        self.best = None
+        self.encoding = None
+        self.faces = 0  # Frames compared that showed a face
+        self.stopped = None
+
+    def budget_left(self):
+        if len(self.frames) >= self.max_frames:
+            self.stopped = 'max_frames'
+        elif time.monotonic() >= self.deadline:
+            self.stopped = 'time_budget'
+        return self.stopped is None
+
+    def add(self, match, score, error, encoding=None):
+        """Record one frame's comparison; return True once a decision is reached"""
+        frame = {'index': len(self.frames), 'match': bool(match), 'score': float(score), 'error': error}
+        self.frames.append(frame)
+        # Only comparisons that found a face return its encoding
+        has_face = encoding is not None
+        self.faces += has_face
+        frames_compared.inc(outcome='match' if match else 'mismatch' if has_face else 'no_face')
+        if has_face and (self.best is None or frame['score'] > self.best['score']):
+            self.best = frame
+            # The best frame's encoding, so a login capture can become a template
+            self.encoding = encoding
+        if match and frame['score'] >= self.accept_score:
+            self.stopped = 'confident_match'
+        elif has_face and frame['score'] < self.reject_score:
+            self.stopped = 'confident_mismatch'
+        return self.stopped is not None
+
+    def finish(self):
+        if self.stopped is None:
+            self.stopped = 'frames_exhausted'
+        bursts_finished.inc(reason=self.stopped)
+        return self
+
+    @property
+    def match(self):
+        return self.best is not None and self.best['match']
+
+    @property
+    def score(self):
+        """Score of the best frame with a face, 0.0 when no frame had one"""
+        return self.best['score'] if self.best else 0.0
+
+    @property
+    def error(self):
+        """Why the burst failed, or None when it matched"""
+        if self.match:
+            return None
+        if self.best is not None:
+            return self.best['error']
+        if self.frames:
+            return self.frames[-1]['error']
+        return "No frames received."
+
+
+def _task(frame):
+    # Webcam data URLs and uploaded image bytes take different decoders
+    return match_image_data if isinstance(frame, bytes) else match_face_data
+
+
+def verify_burst(templates, frames, endpoint='burst'):
+    """Compare frames from an iterable until a decision is reached; returns a BurstResult"""
+    result = BurstResult()
+    frames = iter(frames)
+    while result.budget_left():
+        frame = next(frames, None)
+        if frame is None:
+            break
+        if result.add(*run_face_task(_task(frame), templates, frame, endpoint)):
+            break
+    return result.finish()
+
+
+async def averify_burst(templates, frames, endpoint='burst'):
+    """verify_burst for async views: each frame is awaited without holding the event loop"""
+    result = BurstResult()
+    frames = iter(frames)
+    while result.budget_left():
+        frame = next(frames, None)
+        if frame is None:
+            break
+        if result.add(*await run_face_task_async(_task(frame), templates, frame, endpoint)):
+            break
+    return result.finish()
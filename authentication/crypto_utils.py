@@ -1,88 +1,221 @@
-from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
-from Crypto.Hash import SHA256
 import base64
+import hashlib
+import json
+import logging
+import secrets
+import threading
+import time
 import uuid
 import datetime
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa, padding
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.backends import default_backend
 
-def generate_key_pair():
+from .timing import span
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ALGORITHM = 'rsa-pkcs1v15'
+
+# Session key holding a stateless login challenge until the next request verifies it
+CHALLENGE_SESSION_KEY = '_login_challenge'
+
+
+class SignatureAlgorithm:
+    """Key generation, signing and verification for one signature scheme"""
+
+    name = None
+
+    def generate_private_key(self):
+        raise NotImplementedError
+
+    def sign(self, private_key, data):
+        raise NotImplementedError
+
+    def verify(self, public_key, signature, data):
+        """Raise InvalidSignature unless ``signature`` is valid for ``data``"""
+        raise NotImplementedError
+
+
+class RSAPKCS1v15(SignatureAlgorithm):
+    """RSA-2048 with PKCS#1 v1.5 padding and SHA-256; slow to generate and sign"""
+
+    name = 'rsa-pkcs1v15'
+
+    def generate_private_key(self):
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def sign(self, private_key, data):
+        return private_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+
+    def verify(self, public_key, signature, data):
+        public_key.verify(signature, data, padding.PKCS1v15(), hashes.SHA256())
+
+
+class Ed25519(SignatureAlgorithm):
+    """Ed25519: instant key generation, fast deterministic signatures"""
+
+    name = 'ed25519'
+
+    def generate_private_key(self):
+        return ed25519.Ed25519PrivateKey.generate()
+
+    def sign(self, private_key, data):
+        return private_key.sign(data)
+
+    def verify(self, public_key, signature, data):
+        public_key.verify(signature, data)
+
+
+class ECDSAP256(SignatureAlgorithm):
+    """ECDSA on NIST P-256 with SHA-256, for deployments that need a FIPS curve"""
+
+    name = 'ecdsa-p256'
+
+    def generate_private_key(self):
+        return ec.generate_private_key(ec.SECP256R1())
+
+    def sign(self, private_key, data):
+        return private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+
+    def verify(self, public_key, signature, data):
+        public_key.verify(signature, data, ec.ECDSA(hashes.SHA256()))
+
+
+SIGNATURE_ALGORITHMS = {
+    algorithm.name: algorithm()
+    for algorithm in (RSAPKCS1v15, Ed25519, ECDSAP256)
+}
+
+
+def get_algorithm(name=None):
+    """Return a signature algorithm by name, defaulting to SIGNATURE_ALGORITHM"""
+    name = name or preferred_algorithm()
+    try:
+        return SIGNATURE_ALGORITHMS[name]
+    except KeyError:
+        raise ValueError(f"Unknown signature algorithm '{name}'. Choose from: {', '.join(SIGNATURE_ALGORITHMS)}")
+
+
+def preferred_algorithm():
+    """Algorithm new key pairs are generated with; older profiles move to it at login"""
+    return getattr(settings, 'SIGNATURE_ALGORITHM', DEFAULT_ALGORITHM)
+
+
+class _ParsedKeyCache:
+    """LRU of parsed key objects keyed by ``(user_id, kind, fingerprint)``
+
+    The fingerprint is a hash of the PEM text, so a rotated key never hits a
+    stale entry even when the user id is the same.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+        value = loader()
+        if self.max_size > 0:
+            with self._lock:
+                self._entries[key] = value
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_key_cache = _ParsedKeyCache(getattr(settings, 'SIGNING_KEY_CACHE_SIZE', 10000))
+
+
+def key_fingerprint(pem):
+    return hashlib.sha256(pem.encode('utf-8')).hexdigest()
+
+
+def load_private_key(private_key_pem, user_id=None):
+    """Parse a PEM private key, reusing the parsed object on later calls"""
+    return _key_cache.get_or_load(
+        (user_id, 'private', key_fingerprint(private_key_pem)),
+        lambda: serialization.load_pem_private_key(private_key_pem.encode('utf-8'), password=None),
+    )
+
+
+def load_public_key(public_key_pem, user_id=None):
+    """Parse a PEM public key, reusing the parsed object on later calls"""
+    return _key_cache.get_or_load(
+        (user_id, 'public', key_fingerprint(public_key_pem)),
+        lambda: serialization.load_pem_public_key(public_key_pem.encode('utf-8')),
+    )
+
+
+def generate_key_pair(algorithm=None):
     """
-    Generate a new RSA key pair for digital signatures
-    
+    Generate a new key pair for digital signatures
+
+    Args:
+        algorithm: name of a SIGNATURE_ALGORITHMS entry (default: SIGNATURE_ALGORITHM)
+
     Returns:
         tuple: (public_key_pem, private_key_pem) as PEM string format
     """
-    # Generate a private key
-    private_key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048,
-        backend=default_backend()
-    )
-    
-    # Get the public key
-    public_key = private_key.public_key()
-    
+    with span('keygen'):
+        private_key = get_algorithm(algorithm).generate_private_key()
+
     # Serialize private key to PEM format
     private_key_pem = private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PrivateFormat.PKCS8,
         encryption_algorithm=serialization.NoEncryption()
     ).decode('utf-8')
-    
+
     # Serialize public key to PEM format
-    public_key_pem = public_key.public_bytes(
+    public_key_pem = private_key.public_key().public_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PublicFormat.SubjectPublicKeyInfo
     ).decode('utf-8')
-    
-    return public_key_pem, private_key_pem
 
-def generate_key_pair():
-    """Generate RSA key pair and return as PEM strings"""
-    key = RSA.generate(2048)
-    private_key = key.export_key().decode('utf-8')
-    public_key = key.publickey().export_key().decode('utf-8')
-    return public_key, private_key
+    return public_key_pem, private_key_pem
 
-def sign_data(private_key_pem, data):
+def sign_data(private_key_pem, data, algorithm=DEFAULT_ALGORITHM, user_id=None):
     """Sign data using private key"""
     try:
-        # Import the private key
-        key = RSA.import_key(private_key_pem)
-        
-        # Create hash of the data
-        h = SHA256.new(data.encode('utf-8'))
-        
-        # Sign the hash
-        signature = pkcs1_15.new(key).sign(h)
-        
+        with span('sign'):
+            key = load_private_key(private_key_pem, user_id)
+            signature = get_algorithm(algorithm).sign(key, data.encode('utf-8'))
+
         # Return base64 encoded signature
         return base64.b64encode(signature).decode('utf-8')
     except Exception as e:
-        print(f"Error signing data: {str(e)}")
+        logger.error(f"Error signing data: {str(e)}")
         return None
 
-def verify_signature(public_key_pem, data, signature):
+def verify_signature(public_key_pem, data, signature, algorithm=DEFAULT_ALGORITHM, user_id=None):
     """Verify signature using public key"""
     try:
         # Decode the signature from base64
         signature_bytes = base64.b64decode(signature)
-        
-        # Import the public key
-        key = RSA.import_key(public_key_pem)
-        
-        # Create hash of the data
-        h = SHA256.new(data.encode('utf-8'))
-        
-        # Verify the signature
-        pkcs1_15.new(key).verify(h, signature_bytes)
+
+        with span('verify'):
+            key = load_public_key(public_key_pem, user_id)
+            get_algorithm(algorithm).verify(key, signature_bytes, data.encode('utf-8'))
         return True
+    except InvalidSignature:
+        logger.warning("Signature verification failed: invalid signature")
+        return False
     except Exception as e:
-        print(f"Signature verification failed: {str(e)}")
+        logger.warning(f"Signature verification failed: {str(e)}")
         return False
 
 def generate_login_token(user):
@@ -99,13 +232,70 @@ def sign_login_challenge(user_profile, token):
     """Sign the login challenge with user's private key"""
     if not user_profile.private_key:
         return None
-    
-    signature = sign_data(user_profile.private_key, token)
+
+    signature = sign_data(user_profile.private_key, token, user_profile.key_algorithm, user_profile.user_id)
     return signature
 
 def verify_login_signature(user_profile, token, signature):
     """Verify the login signature with user's public key"""
     if not user_profile.public_key or not signature:
         return False
-    
-    return verify_signature(user_profile.public_key, token, signature)
\ No newline at end of file
+
+    return verify_signature(user_profile.public_key, token, signature, user_profile.key_algorithm, user_profile.user_id)
+
+# Stateless challenges: "<payload>.<signature>", both unpadded base64url. The
+# payload is compact JSON naming the user (u), a random nonce (n), the expiry as
+# a Unix timestamp (exp) and the signature algorithm (alg), so a challenge can be
+# checked with nothing but the user's public key.
+
+def _b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64url_decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def create_signed_challenge(user_profile, ttl_seconds=None):
+    """Create a self-describing login challenge signed with the user's private key"""
+    if not user_profile.private_key:
+        return None
+    if ttl_seconds is None:
+        ttl_seconds = getattr(settings, 'LOGIN_CHALLENGE_TTL_SECONDS', 300)
+
+    payload = {
+        'u': user_profile.user_id,
+        'n': secrets.token_hex(16),
+        'exp': int(time.time()) + ttl_seconds,
+        'alg': user_profile.key_algorithm,
+    }
+    payload_segment = _b64url_encode(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+    signature = sign_login_challenge(user_profile, payload_segment)
+    if not signature:
+        return None
+    return f"{payload_segment}.{_b64url_encode(base64.b64decode(signature))}"
+
+def verify_signed_challenge(user_profile, challenge, consume=True):
+    """Check a stateless challenge's signature, owner and expiry without touching the database
+
+    With ``consume`` the nonce is recorded in the cache until the challenge
+    expires, so each challenge verifies at most once.
+    """
+    try:
+        payload_segment, signature_segment = challenge.split('.')
+        payload = json.loads(_b64url_decode(payload_segment))
+        signature = base64.b64encode(_b64url_decode(signature_segment)).decode('ascii')
+    except (AttributeError, ValueError, TypeError) as e:
+        logger.warning(f"Malformed login challenge: {str(e)}")
+        return False
+
+    remaining = payload.get('exp', 0) - int(time.time())
+    if payload.get('u') != user_profile.user_id or payload.get('alg') != user_profile.key_algorithm or remaining <= 0:
+        return False
+    if not verify_login_signature(user_profile, payload_segment, signature):
+        return False
+
+    if consume:
+        cache = caches[getattr(settings, 'LOGIN_CHALLENGE_CACHE_ALIAS', 'default')]
+        if not cache.add(f"login-challenge:{payload['n']}", True, timeout=remaining):
+            logger.warning(f"Replayed login challenge for user {user_profile.user_id}")
+            return False
+    return True
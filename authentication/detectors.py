@@ -0,0 +1,154 @@
+"""Interchangeable CPU face detector backends
+
+Every backend returns boxes as ``(top, right, bottom, left)`` tuples in the
+coordinates of the image it was given, the same convention as
+``face_recognition.face_locations``, so any of them can feed
+``face_recognition.face_encodings``.
+
+Backends are chosen per endpoint with ``FACE_DETECTOR_BACKENDS`` and
+configured with ``FACE_DETECTOR_OPTIONS``; instances (and any model files they
+load) are created once per process.
+"""
+import os
+import threading
+
+import face_recognition
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+class FaceDetector:
+    """Common interface for face detectors"""
+
+    name = None
+
+    def __init__(self, **options):
+        self.options = options
+
+    def detect(self, image, upsample=0):
+        """Return face boxes found in an RGB uint8 image
+
+        ``upsample`` asks for extra passes over an enlarged image to find
+        small faces; backends that are scale-invariant may ignore it.
+        """
+        raise NotImplementedError
+
+
+class HogDetector(FaceDetector):
+    """dlib HOG + linear SVM: the fastest CPU option, best on frontal faces"""
+
+    name = 'hog'
+
+    def detect(self, image, upsample=0):
+        return face_recognition.face_locations(image, upsample, model='hog')
+
+
+class CnnDetector(FaceDetector):
+    """dlib MMOD CNN: more robust to pose and lighting, much slower on CPU"""
+
+    name = 'cnn'
+
+    def detect(self, image, upsample=0):
+        return face_recognition.face_locations(image, upsample, model='cnn')
+
+
+class _OpenCVDetector(FaceDetector):
+    """Shared plumbing for detectors backed by an OpenCV model file"""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        model_path = options.get('model_path')
+        if not model_path or not os.path.exists(model_path):
+            raise ImproperlyConfigured(f"The '{self.name}' face detector needs FACE_DETECTOR_OPTIONS"
+                                       f"['{self.name}']['model_path'] pointing at a model file (got {model_path!r})")
+        import cv2
+        self.cv2 = cv2
+        self.score_threshold = options.get('score_threshold', 0.9)
+        # OpenCV network objects hold per-call state and are not thread-safe
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _box(x, y, w, h, width, height):
+        left, top = max(0, int(round(x))), max(0, int(round(y)))
+        right, bottom = min(width, int(round(x + w))), min(height, int(round(y + h)))
+        return top, right, bottom, left
+
+
+class YuNetDetector(_OpenCVDetector):
+    """OpenCV's YuNet ONNX detector (``cv2.FaceDetectorYN``); fast and handles any scale"""
+
+    name = 'yunet'
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._detector = self.cv2.FaceDetectorYN.create(
+            self.options['model_path'], '', (320, 320),
+            self.score_threshold,
+            self.options.get('nms_threshold', 0.3),
+            self.options.get('top_k', 50),
+        )
+
+    def detect(self, image, upsample=0):
+        height, width = image.shape[:2]
+        bgr = self.cv2.cvtColor(image, self.cv2.COLOR_RGB2BGR)
+        with self._lock:
+            self._detector.setInputSize((width, height))
+            _, faces = self._detector.detect(bgr)
+        if faces is None:
+            return []
+        return [self._box(x, y, w, h, width, height) for x, y, w, h in faces[:, :4]]
+
+
+class OpenCVDNNDetector(_OpenCVDetector):
+    """OpenCV DNN single-shot detector, e.g. the res10 300x300 Caffe face model"""
+
+    name = 'opencv_dnn'
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        config_path = self.options.get('config_path', '')
+        self.input_size = tuple(self.options.get('input_size', (300, 300)))
+        self.mean = tuple(self.options.get('mean', (104.0, 177.0, 123.0)))
+        self._net = self.cv2.dnn.readNet(self.options['model_path'], config_path)
+
+    def detect(self, image, upsample=0):
+        height, width = image.shape[:2]
+        bgr = self.cv2.cvtColor(image, self.cv2.COLOR_RGB2BGR)
+        blob = self.cv2.dnn.blobFromImage(bgr, 1.0, self.input_size, self.mean)
+        with self._lock:
+            self._net.setInput(blob)
+            detections = self._net.forward()
+        # Rows are [image_id, class_id, confidence, x1, y1, x2, y2] in relative coordinates
+        detections = detections.reshape(-1, 7)
+        detections = detections[detections[:, 2] >= self.score_threshold]
+        scale = np.array([width, height, width, height])
+        boxes = []
+        for x1, y1, x2, y2 in detections[:, 3:7] * scale:
+            boxes.append(self._box(x1, y1, x2 - x1, y2 - y1, width, height))
+        return boxes
+
+
+DETECTOR_BACKENDS = {
+    backend.name: backend
+    for backend in (HogDetector, CnnDetector, YuNetDetector, OpenCVDNNDetector)
+}
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def get_detector(endpoint='default'):
+    """Return the detector configured for an endpoint (falling back to 'default')"""
+    backends = getattr(settings, 'FACE_DETECTOR_BACKENDS', {})
+    name = backends.get(endpoint) or backends.get('default') or 'hog'
+    if name not in DETECTOR_BACKENDS:
+        raise ImproperlyConfigured(f"Unknown face detector backend '{name}' for endpoint '{endpoint}'. "
+                                   f"Choose from: {', '.join(DETECTOR_BACKENDS)}")
+
+    with _instances_lock:
+        detector = _instances.get(name)
+        if detector is None:
+            options = getattr(settings, 'FACE_DETECTOR_OPTIONS', {}).get(name, {})
+            detector = _instances[name] = DETECTOR_BACKENDS[name](**options)
+    return detector
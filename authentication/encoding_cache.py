@@ -0,0 +1,162 @@
+"""Per-user cache of decoded face templates
+
+Login and the face precheck both need the stored templates of one user, usually
+within seconds of each other. Instead of fetching the template blobs and
+unpacking them on every request, decoded ``FaceTemplates`` are kept in an
+in-process LRU (``FACE_ENCODING_CACHE_SIZE`` entries, ``FACE_ENCODING_CACHE_TTL``
+seconds), in front of an optional shared Django cache (``FACE_ENCODING_CACHE_ALIAS``)
+that holds the packed bytes for every worker.
+
+Entries are invalidated by the ``post_save``/``post_delete`` signal handlers
+when a user's mean encoding changes, which every template change causes. Other
+processes only see the invalidation through the shared tier, so their local
+entries may be up to the TTL old.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+from .encoding_format import make_templates, pack_templates, unpack_encoding, unpack_templates
+
+cache_hits = metrics.counter('face_encoding_cache_hits', "Stored face templates served from cache, by tier")
+cache_misses = metrics.counter('face_encoding_cache_misses', "Stored face templates read from the database")
+
+SHARED_KEY_PREFIX = 'face-templates'
+
+
+class EncodingCache:
+    """Thread-safe LRU of ``user_id -> templates`` with a per-entry time to live"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, encoding = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return encoding
+
+    def set(self, user_id, encoding):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, encoding)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_local = None
+_local_lock = threading.Lock()
+
+
+def get_local_cache():
+    global _local
+    with _local_lock:
+        if _local is None:
+            _local = EncodingCache(
+                getattr(settings, 'FACE_ENCODING_CACHE_SIZE', 10000),
+                getattr(settings, 'FACE_ENCODING_CACHE_TTL', 60),
+            )
+        return _local
+
+
+def _shared_cache():
+    alias = getattr(settings, 'FACE_ENCODING_CACHE_ALIAS', None)
+    return caches[alias] if alias else None
+
+
+def _shared_key(user_id):
+    return f"{SHARED_KEY_PREFIX}:{user_id}"
+
+
+def _read_templates(user_id):
+    from .models import FaceTemplate, UserProfile
+    rows = FaceTemplate.objects.filter(user_id=user_id).values_list('encoding', flat=True)
+    encodings = [unpack_encoding(bytes(encoding_bytes)) for encoding_bytes in rows]
+    if not encodings:
+        # Encodings written straight to the profile (bulk tools, older data) act as one template
+        encoding_bytes = (UserProfile.objects.filter(user_id=user_id)
+                          .values_list('face_encoding', flat=True).first())
+        if not encoding_bytes:
+            return None
+        encodings = [unpack_encoding(bytes(encoding_bytes))]
+    return make_templates(encodings)
+
+
+def _load(user_id):
+    """Fetch templates from the shared tier or the database and cache them locally"""
+    shared = _shared_cache()
+    if shared is not None:
+        templates_bytes = shared.get(_shared_key(user_id))
+        if templates_bytes is not None:
+            cache_hits.inc(tier='shared')
+            templates = unpack_templates(templates_bytes)
+            get_local_cache().set(user_id, templates)
+            return templates
+
+    cache_misses.inc()
+    templates = _read_templates(user_id)
+    if templates is None:
+        return None
+    get_local_cache().set(user_id, templates)
+    if shared is not None:
+        shared.set(_shared_key(user_id), pack_templates(templates), getattr(settings, 'FACE_ENCODING_CACHE_TTL', 60))
+    return templates
+
+
+def get_user_templates(user_id):
+    """Return a user's FaceTemplates, or None if they have not enrolled a face"""
+    templates = get_local_cache().get(user_id)
+    if templates is not None:
+        cache_hits.inc(tier='local')
+        return templates
+    return _load(user_id)
+
+
+async def aget_user_templates(user_id):
+    """Async ``get_user_templates``: local hits never leave the event loop"""
+    templates = get_local_cache().get(user_id)
+    if templates is not None:
+        cache_hits.inc(tier='local')
+        return templates
+    return await sync_to_async(_load)(user_id)
+
+
+def get_user_encoding(user_id):
+    """Return a user's mean template, or None if they have not enrolled a face"""
+    templates = get_user_templates(user_id)
+    return templates.mean if templates is not None else None
+
+
+def invalidate(user_id):
+    """Forget a user's cached templates in this process and in the shared tier"""
+    get_local_cache().invalidate(user_id)
+    shared = _shared_cache()
+    if shared is not None:
+        shared.delete(_shared_key(user_id))
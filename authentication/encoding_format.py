@@ -0,0 +1,73 @@
+"""Versioned raw binary format for stored face encodings
+
+Layout (little-endian): 4-byte magic ``FENC``, 1-byte format version, 1-byte
+dtype code, 2-byte dimension, then ``dimension`` float32 values. A 128-d
+encoding is 520 bytes, versus ~1.2 KB for a pickled float64 array, and
+decoding is a zero-copy ``np.frombuffer`` instead of ``pickle.loads``.
+
+A user's set of templates is packed the same way as one long encoding: the
+mean template first, then each template, ``dimension`` values apiece.
+"""
+import struct
+from typing import NamedTuple
+
+import numpy as np
+
+MAGIC = b'FENC'
+VERSION = 1
+DTYPE_FLOAT32 = 1
+HEADER = struct.Struct('<4sBBH')
+
+_DTYPES = {DTYPE_FLOAT32: np.dtype('<f4')}
+
+
+class EncodingFormatError(ValueError):
+    """Raised when stored bytes are not a face encoding in a supported format"""
+
+
+def pack_encoding(encoding):
+    """Serialize a face encoding to the versioned float32 format"""
+    values = np.ascontiguousarray(encoding, dtype='<f4').ravel()
+    return HEADER.pack(MAGIC, VERSION, DTYPE_FLOAT32, len(values)) + values.tobytes()
+
+
+def is_packed_encoding(data):
+    return data is not None and bytes(data[:4]) == MAGIC
+
+
+def unpack_encoding(data):
+    """Return a stored encoding as a read-only float32 array without copying"""
+    if data is None or len(data) < HEADER.size:
+        raise EncodingFormatError("Face encoding is missing or truncated.")
+    magic, version, dtype_code, dimension = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise EncodingFormatError("Face encoding is not in a supported format.")
+    if version != VERSION or dtype_code not in _DTYPES:
+        raise EncodingFormatError(f"Unsupported face encoding version {version} (dtype {dtype_code}).")
+    dtype = _DTYPES[dtype_code]
+    if len(data) != HEADER.size + dimension * dtype.itemsize:
+        raise EncodingFormatError("Face encoding length does not match its header.")
+    return np.frombuffer(data, dtype=dtype, count=dimension, offset=HEADER.size)
+
+
+class FaceTemplates(NamedTuple):
+    """A user's enrolled encodings, one per row, and their mean"""
+    mean: np.ndarray
+    encodings: np.ndarray
+
+
+def make_templates(encodings):
+    """Build a FaceTemplates from a sequence of encodings"""
+    encodings = np.vstack(encodings).astype('<f4', copy=False)
+    return FaceTemplates(encodings.mean(axis=0), encodings)
+
+
+def pack_templates(templates):
+    """Serialize a FaceTemplates, mean first"""
+    return pack_encoding(np.vstack([templates.mean, templates.encodings]))
+
+
+def unpack_templates(data, dimension=128):
+    """Inverse of pack_templates"""
+    rows = unpack_encoding(data).reshape(-1, dimension)
+    return FaceTemplates(rows[0], rows[1:])
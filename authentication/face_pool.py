@@ -0,0 +1,232 @@
+"""Bounded process pool for CPU-bound face detection and encoding
+
+Face work runs in a dedicated pool of pre-warmed worker processes instead of
+the request thread, so a burst of logins is limited to
+``FACE_POOL_WORKERS`` cores per Django process and cannot starve cheap pages. At most
+``FACE_POOL_MAX_QUEUE`` tasks wait for a free worker; beyond that ``run``
+fails fast with ``FacePoolBusy`` and the view answers with a retryable 503.
+
+With ``FACE_POOL_WORKERS = 0`` tasks run inline in the calling thread.
+
+Async views use ``run_face_task_async``: the task is awaited rather than
+blocking a thread, and at most ``FACE_ASYNC_CONCURRENCY`` face computations per
+event loop are outstanding at once.
+"""
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+
+from . import metrics, timing
+
+tasks_submitted = metrics.counter('face_pool_submitted', "Face tasks accepted by the pool")
+tasks_rejected = metrics.counter('face_pool_rejected', "Face tasks rejected because the queue was full or timed out")
+tasks_completed = metrics.counter('face_pool_completed', "Face tasks that finished")
+wait_seconds = metrics.counter('face_pool_wait_seconds', "Total time face tasks spent queued before a worker picked them up")
+
+
+class FacePoolBusy(Exception):
+    """Raised when the face work queue is full or a task waited too long"""
+
+
+def _init_worker():
+    """Set up Django and load the dlib models once, before the first real task"""
+    import django
+    django.setup()
+    from .face_utils import warm_up
+    warm_up()
+
+
+def _call(func, args, kwargs):
+    """Run a task in a worker, reporting when it actually started and its spans"""
+    started = time.time()
+    with timing.collect() as spans:
+        result = func(*args, **kwargs)
+    return started, result, spans
+
+
+def _noop():
+    return None
+
+
+class FaceWorkPool:
+    def __init__(self, workers, max_queue, timeout=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        return max(0, self._in_flight - self.workers)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: workers must not inherit request threads, locks or DB connections
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                )
+            return self._executor
+
+    def prewarm(self):
+        """Start every worker process now rather than on the first requests"""
+        executor = self._get_executor()
+        for future in [executor.submit(_noop) for _ in range(self.workers)]:
+            future.result()
+
+    def _release(self, future=None):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _submit(self, func, args, kwargs):
+        """Claim a queue slot and hand the task to a worker; return ``(future, submitted)``"""
+        if not self._slots.acquire(blocking=False):
+            tasks_rejected.inc(reason='queue_full')
+            raise FacePoolBusy("Face processing queue is full")
+        with self._lock:
+            self._in_flight += 1
+        tasks_submitted.inc()
+
+        submitted = time.time()
+        try:
+            future = self._get_executor().submit(_call, func, args, kwargs)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future, submitted
+
+    def _finish(self, submitted, outcome):
+        started, result, spans = outcome
+        waited = max(0.0, started - submitted)
+        wait_seconds.inc(waited)
+        tasks_completed.inc()
+        # The worker's spans belong to the request that submitted the task
+        timing.record('face_queue', waited)
+        timing.merge(spans)
+        return result
+
+    def run(self, func, *args, **kwargs):
+        """Run ``func(*args, **kwargs)`` in a worker and return its result
+
+        Raises FacePoolBusy without waiting when the queue is full, or when
+        the task has not finished within ``FACE_POOL_TIMEOUT`` seconds.
+        """
+        future, submitted = self._submit(func, args, kwargs)
+        try:
+            outcome = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # The slot stays taken until the worker finishes, which keeps the bound honest
+            tasks_rejected.inc(reason='timeout')
+            raise FacePoolBusy("Face processing timed out waiting for a worker")
+        return self._finish(submitted, outcome)
+
+    async def run_async(self, func, *args, **kwargs):
+        """Awaitable ``run``: the event loop keeps serving other requests meanwhile"""
+        future, submitted = self._submit(func, args, kwargs)
+        try:
+            # On timeout the wrapped future is cancelled, which frees a still-queued slot
+            outcome = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            tasks_rejected.inc(reason='timeout')
+            raise FacePoolBusy("Face processing timed out waiting for a worker")
+        return self._finish(submitted, outcome)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_face_pool():
+    """Return the process-wide face pool, or None when face work runs inline"""
+    global _pool
+    workers = getattr(settings, 'FACE_POOL_WORKERS', 0)
+    if not workers:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = FaceWorkPool(
+                workers,
+                getattr(settings, 'FACE_POOL_MAX_QUEUE', 2 * workers),
+                getattr(settings, 'FACE_POOL_TIMEOUT', 10),
+            )
+            metrics.gauge('face_pool_in_flight', "Face tasks running or queued", lambda: _pool.in_flight)
+            metrics.gauge('face_pool_queue_depth', "Face tasks waiting for a free worker", lambda: _pool.queue_depth)
+    return _pool
+
+
+def run_face_task(func, *args, **kwargs):
+    """Run face work in the pool when one is configured, otherwise inline"""
+    pool = get_face_pool()
+    if pool is None:
+        return func(*args, **kwargs)
+    return pool.run(func, *args, **kwargs)
+
+
+_async_limits = weakref.WeakKeyDictionary()
+
+
+def _async_limit():
+    """Return the semaphore capping face computations on the running event loop"""
+    loop = asyncio.get_running_loop()
+    semaphore = _async_limits.get(loop)
+    if semaphore is None:
+        limit = getattr(settings, 'FACE_ASYNC_CONCURRENCY', None) or os.cpu_count() or 1
+        semaphore = _async_limits[loop] = asyncio.Semaphore(limit)
+    return semaphore
+
+
+async def run_face_task_async(func, *args, **kwargs):
+    """Await face work without holding the event loop
+
+    Waits up to ``FACE_POOL_TIMEOUT`` seconds for one of the
+    ``FACE_ASYNC_CONCURRENCY`` slots, then runs the task in the process pool,
+    or in the loop's default thread executor when face work runs inline.
+    """
+    semaphore = _async_limit()
+    try:
+        await asyncio.wait_for(semaphore.acquire(), getattr(settings, 'FACE_POOL_TIMEOUT', 10))
+    except asyncio.TimeoutError:
+        tasks_rejected.inc(reason='async_limit')
+        raise FacePoolBusy("Too many face computations in progress")
+    try:
+        pool = get_face_pool()
+        if pool is None:
+            loop = asyncio.get_running_loop()
+            # run_in_executor does not carry context variables; the request's spans should follow
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+        return await pool.run_async(func, *args, **kwargs)
+    finally:
+        semaphore.release()
+
+
+def prewarm_face_pool():
+    """Start the pool's workers at server start-up when FACE_POOL_PREWARM is set"""
+    pool = get_face_pool()
+    if pool is not None and getattr(settings, 'FACE_POOL_PREWARM', True):
+        threading.Thread(target=pool.prewarm, name='face-pool-prewarm', daemon=True).start()
@@ -0,0 +1,103 @@
+"""Several enrolled face templates per user
+
+A user's templates are their enrollment captures (registration, the profile
+page, ``enroll_faces``) plus login captures learned automatically. Matching
+takes the nearest template, so a capture with glasses or in different light
+stops being rejected once one like it is enrolled.
+
+``UserProfile.face_encoding`` holds the mean of the templates. The 1:N gallery
+and ANN index keep one vector per user by indexing it, and 1:1 comparisons try
+it before the individual templates (see ``face_utils.template_distance``).
+Change templates only through these functions so the mean stays in step.
+
+A successful login whose capture is confidently the user
+(``FACE_TEMPLATE_LEARN_MAX_DISTANCE``) yet unlike every template so far
+(``FACE_TEMPLATE_LEARN_MIN_DISTANCE``) is kept as a ``login`` template. At most
+``FACE_TEMPLATES_PER_USER`` are kept: the oldest login captures are evicted
+first, and enrollment templates only when no other login capture is left.
+"""
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
+
+from . import metrics
+from .encoding_format import make_templates, pack_encoding, unpack_encoding
+from .face_utils import template_distance
+from .models import FaceTemplate, UserProfile
+
+logger = logging.getLogger(__name__)
+
+templates_added = metrics.counter('face_templates_added', "Face templates stored, by source")
+templates_evicted = metrics.counter('face_templates_evicted', "Face templates dropped to stay under the per-user cap")
+
+
+def refresh_mean(user_id, profile=None):
+    """Recompute a user's mean template onto their profile (None once no template is left)
+
+    Pass the caller's ``profile`` instance, if it has one, so that its flag
+    fields stay current for a later save.
+    """
+    rows = FaceTemplate.objects.filter(user_id=user_id).values_list('encoding', flat=True)
+    encodings = [unpack_encoding(bytes(encoding_bytes)) for encoding_bytes in rows]
+    if profile is None:
+        profile = UserProfile.objects.defer(*UserProfile.HEAVY_FIELDS).get(user_id=user_id)
+    profile.face_encoding = pack_encoding(make_templates(encodings).mean) if encodings else None
+    # The post_save handler refreshes the gallery and drops the cached templates
+    profile.save(update_fields=['face_encoding'])
+
+
+def _evict(user_id, keep_id):
+    limit = getattr(settings, 'FACE_TEMPLATES_PER_USER', 8)
+    ids = list(
+        FaceTemplate.objects
+        .filter(user_id=user_id)
+        .exclude(id=keep_id)
+        .order_by(Case(When(source='login', then=Value(0)), default=Value(1), output_field=IntegerField()),
+                  'created_at')
+        .values_list('id', flat=True)
+    )
+    excess = len(ids) + 1 - limit
+    if excess > 0:
+        FaceTemplate.objects.filter(id__in=ids[:excess]).delete()
+        templates_evicted.inc(excess)
+
+
+def add_template(user_id, encoding, source='enrollment', profile=None):
+    """Store a new template for a user, evicting beyond the cap, and update their mean"""
+    with transaction.atomic():
+        template = FaceTemplate.objects.create(user_id=user_id, encoding=pack_encoding(encoding), source=source)
+        _evict(user_id, template.id)
+        refresh_mean(user_id, profile)
+    templates_added.inc(source=source)
+    return template
+
+
+def replace_templates(user_id, encoding, profile=None):
+    """Drop all of a user's templates and enroll ``encoding`` as the only one"""
+    with transaction.atomic():
+        FaceTemplate.objects.filter(user_id=user_id).delete()
+        return add_template(user_id, encoding, profile=profile)
+
+
+def learn_from_login(user_id, encoding, templates):
+    """Keep a successful login's capture as a template if it adds something; return whether it did
+
+    ``templates`` are the FaceTemplates the login was matched against. The
+    capture's distance to the nearest of them decides, not the login score,
+    which may be the distance to their mean.
+    """
+    if encoding is None or templates is None or not getattr(settings, 'FACE_TEMPLATE_LEARNING', True):
+        return False
+    distance = template_distance(templates.encodings, encoding)
+    if not (getattr(settings, 'FACE_TEMPLATE_LEARN_MIN_DISTANCE', 0.3) <= distance
+            <= getattr(settings, 'FACE_TEMPLATE_LEARN_MAX_DISTANCE', 0.45)):
+        return False
+    try:
+        add_template(user_id, encoding, source='login')
+        return True
+    except Exception as e:
+        # The login itself succeeded; a template that could not be stored is only a missed improvement
+        logger.error(f"Storing login capture as a face template failed: {str(e)}")
+        return False
@@ -1,20 +1,104 @@
 import face_recognition
 import numpy as np
-import pickle
-import os
-import cv2
+import base64
+import logging
+import math
 from django.conf import settings
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps
 
-def process_face_image(image_file):
-    """Process uploaded image file and extract face encoding"""
+from .detectors import get_detector
+from .encoding_format import FaceTemplates, pack_encoding, unpack_encoding
+from .gallery_store import get_gallery_file
+from .timing import span
+
+logger = logging.getLogger(__name__)
+
+def decode_face_data(face_data, max_dimension=None):
+    """Decode a base64 image data URL straight into an RGB numpy array"""
+    # Strip the "data:image/jpeg;base64," prefix sent by the webcam
+    if ';base64,' in face_data:
+        face_data = face_data.split(';base64,', 1)[1]
+    with span('decode'):
+        return decode_image_bytes(base64.b64decode(face_data), max_dimension)
+
+def decode_image_bytes(data, max_dimension=None):
+    """Decode encoded image bytes (JPEG, PNG, ...) into an RGB numpy array"""
+    if max_dimension is None:
+        max_dimension = getattr(settings, 'FACE_IMAGE_MAX_DIMENSION', 800)
+    img = Image.open(BytesIO(data))
+    
+    # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when the frame is larger
+    # than detection needs, instead of decoding everything and resizing
+    if img.format == 'JPEG' and max_dimension:
+        scale = max_dimension / max(img.size)
+        if scale < 1:
+            img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+    
+    # Photos from phones and cameras may be stored rotated with an EXIF hint
+    img = ImageOps.exif_transpose(img)
+    
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return np.array(img)
+
+def _downscale(image, max_dimension):
+    """Return a copy no larger than ``max_dimension`` on its long side, and the scale used"""
+    height, width = image.shape[:2]
+    scale = max_dimension / max(height, width)
+    if scale >= 1:
+        return image, 1.0
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return np.asarray(Image.fromarray(image).resize(size, Image.BILINEAR)), scale
+
+def detect_faces(image, endpoint='default'):
+    """Find face boxes, trying a cheap downscaled pass before the full-resolution frame
+    
+    Boxes are (top, right, bottom, left) in full-resolution coordinates, ready
+    for face_recognition.face_encodings on the original image. The detector
+    backend is the one configured for ``endpoint`` in FACE_DETECTOR_BACKENDS.
+    """
+    detector = get_detector(endpoint)
+    max_dimension = getattr(settings, 'FACE_DETECTION_MAX_DIMENSION', 320)
+    first_upsample = getattr(settings, 'FACE_DETECTION_UPSAMPLE', 1)
+    fallback_upsample = getattr(settings, 'FACE_DETECTION_FALLBACK_UPSAMPLE', 1)
+    
+    height, width = image.shape[:2]
+    if max_dimension and max(height, width) > max_dimension:
+        with span('detect_downscaled'):
+            small, scale = _downscale(image, max_dimension)
+            face_locations = detector.detect(small, first_upsample)
+        if face_locations:
+            # Map boxes back to the full-resolution frame
+            return [
+                (max(0, int(top / scale)), min(width, int(right / scale)),
+                 min(height, int(bottom / scale)), max(0, int(left / scale)))
+                for top, right, bottom, left in face_locations
+            ]
+        if fallback_upsample is None:
+            return []
+        with span('detect_fallback'):
+            return detector.detect(image, fallback_upsample)
+    
+    # Frame is already small enough: the full-resolution pass is the only one
+    with span('detect'):
+        return detector.detect(image, fallback_upsample if fallback_upsample is not None else first_upsample)
+
+def _load_image(image):
+    """Accept either a decoded RGB array or anything load_image_file can open"""
+    if isinstance(image, np.ndarray):
+        return image
+    with span('decode'):
+        return face_recognition.load_image_file(image)
+
+def extract_face_encoding(image, endpoint='default'):
+    """Return the encoding of the single face in an image as a numpy array"""
     try:
         # Read the image file
-        image = face_recognition.load_image_file(image_file)
+        image = _load_image(image)
         
         # Find faces in the image
-        face_locations = face_recognition.face_locations(image)
+        face_locations = detect_faces(image, endpoint)
         
         if not face_locations:
             return None, "No face detected in the image. Please try again."
@@ -23,74 +107,143 @@ def process_face_image(image_file):
             return None, "Multiple faces detected. Please upload an image with only your face."
         
         # Get the encoding of the first face
-        face_encoding = face_recognition.face_encodings(image, face_locations)[0]
-        
-        # Convert numpy array to bytes for storage
-        encoding_bytes = pickle.dumps(face_encoding)
-        
-        return encoding_bytes, None
+        with span('encode'):
+            face_encoding = face_recognition.face_encodings(image, face_locations)[0]
+        return face_encoding, None
     except Exception as e:
         return None, f"Error processing face image: {str(e)}"
 
-def compare_faces(known_encoding_bytes, image_file, tolerance=None):
-    """Compare face in uploaded image with stored encoding"""
+def process_face_image(image, endpoint='default'):
+    """Extract the face encoding from an RGB image array or image file"""
+    face_encoding, error = extract_face_encoding(image, endpoint)
+    if error:
+        return None, error
+    
+    # Convert numpy array to the versioned binary format for storage
+    return pack_encoding(face_encoding), None
+
+def template_distance(known, encoding):
+    """Distance from ``encoding`` to the nearest known encoding
+    
+    ``known`` is one encoding, an (n, d) array of templates or a FaceTemplates.
+    All templates are measured in one vectorized pass; for a FaceTemplates the
+    mean is tried first, and when it is within FACE_TEMPLATE_MEAN_ACCEPT_DISTANCE
+    its distance is returned without looking at the individual templates.
+    """
+    if isinstance(known, FaceTemplates):
+        accept = getattr(settings, 'FACE_TEMPLATE_MEAN_ACCEPT_DISTANCE', None)
+        if accept is not None and len(known.encodings) > 1:
+            distance = float(np.linalg.norm(known.mean - encoding))
+            if distance <= accept:
+                return distance
+        known = known.encodings
+    return float(np.linalg.norm(np.atleast_2d(known) - encoding, axis=1).min())
+
+def _match_faces(known_encoding, image, tolerance, endpoint):
+    """compare_faces, also returning the probe's encoding (None when no face was found)"""
     if tolerance is None:
         tolerance = getattr(settings, 'FACE_RECOGNITION_TOLERANCE', 0.6)
         
     try:
-        # Load the known face encoding
-        known_face_encoding = pickle.loads(known_encoding_bytes)
+        # Load the known face encoding(s)
+        if isinstance(known_encoding, (np.ndarray, FaceTemplates)):
+            known_face_encoding = known_encoding
+        else:
+            known_face_encoding = unpack_encoding(known_encoding)
         
         # Load the image to check
-        image = face_recognition.load_image_file(image_file)
+        image = _load_image(image)
         
         # Find faces in the image
-        face_locations = face_recognition.face_locations(image)
+        face_locations = detect_faces(image, endpoint)
         
         if not face_locations:
-            return False, 0.0, "No face detected in the provided image."
+            return False, 0.0, "No face detected in the provided image.", None
             
         # Get the encoding of the face
-        face_encoding = face_recognition.face_encodings(image, face_locations)[0]
+        with span('encode'):
+            face_encoding = face_recognition.face_encodings(image, face_locations)[0]
         
-        # Compare the faces
-        face_distances = face_recognition.face_distance([known_face_encoding], face_encoding)
-        match_score = 1 - float(face_distances[0])
-        match = face_distances[0] <= tolerance
+        # Compare against the nearest of the user's templates
+        distance = template_distance(known_face_encoding, face_encoding)
+        match_score = 1 - distance
         
-        if match:
-            return True, match_score, None
+        if distance <= tolerance:
+            return True, match_score, None, face_encoding
         else:
-            return False, match_score, "Face does not match the registered user."
+            return False, match_score, "Face does not match the registered user.", face_encoding
             
     except Exception as e:
-        return False, 0.0, f"Error comparing faces: {str(e)}"
+        return False, 0.0, f"Error comparing faces: {str(e)}", None
+
+def compare_faces(known_encoding, image, tolerance=None, endpoint='default'):
+    """Compare face in an RGB image array or image file with stored encoding(s)
+    
+    ``known_encoding`` may be packed bytes, one decoded encoding, an (n, d)
+    array of templates or a FaceTemplates; the nearest template decides.
+    """
+    return _match_faces(known_encoding, image, tolerance, endpoint)[:3]
+
+# Entry points for the face pool: they take the raw data URL so that decoding
+# also happens in the worker process, and only return small picklable results.
+
+def encode_face_data(face_data, endpoint='default'):
+    """Decode a webcam data URL and return (encoding_bytes, error)"""
+    return process_face_image(decode_face_data(face_data), endpoint=endpoint)
+
+def extract_face_data(face_data, endpoint='default'):
+    """Decode a webcam data URL and return (encoding array, error)"""
+    return extract_face_encoding(decode_face_data(face_data), endpoint=endpoint)
+
+def compare_face_data(known_encoding, face_data, endpoint='default'):
+    """Decode a webcam data URL and return (match, score, error) against a stored encoding"""
+    return compare_faces(known_encoding, decode_face_data(face_data), endpoint=endpoint)
+
+def compare_image_data(known_encoding, data, endpoint='default'):
+    """Decode uploaded image bytes and return (match, score, error) against a stored encoding"""
+    with span('decode'):
+        image = decode_image_bytes(data)
+    return compare_faces(known_encoding, image, endpoint=endpoint)
+
+def match_face_data(known_encoding, face_data, endpoint='default'):
+    """compare_face_data, plus the probe encoding so a login capture can become a template"""
+    return _match_faces(known_encoding, decode_face_data(face_data), None, endpoint)
+
+def match_image_data(known_encoding, data, endpoint='default'):
+    """compare_image_data, plus the probe encoding"""
+    with span('decode'):
+        image = decode_image_bytes(data)
+    return _match_faces(known_encoding, image, None, endpoint)
+
+def warm_up():
+    """Load the detector and encoder models so the first real request is not slow"""
+    blank = np.zeros((64, 64, 3), dtype=np.uint8)
+    for endpoint in getattr(settings, 'FACE_DETECTOR_BACKENDS', {}) or ['default']:
+        get_detector(endpoint).detect(blank)
+    face_recognition.face_encodings(blank, [(0, 64, 64, 0)])
 
 def save_face_encoding(user_profile, encoding_bytes):
-    """Save face encoding to file"""
-    filepath = user_profile.get_face_encoding_path()
+    """Append a user's face encoding to the shared gallery file"""
+    store = get_gallery_file()
     
-    if not filepath:
+    if store is None or not encoding_bytes:
         return False
     
     try:
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'wb') as f:
-            f.write(encoding_bytes)
+        store.append(user_profile.user_id, unpack_encoding(encoding_bytes))
         return True
     except Exception:
         return False
 
 def load_face_encoding(user_profile):
-    """Load face encoding from file"""
-    filepath = user_profile.get_face_encoding_path()
+    """Load a user's face encoding from the shared gallery file"""
+    store = get_gallery_file()
     
-    if not filepath or not os.path.exists(filepath):
+    if store is None:
         return None
     
     try:
-        with open(filepath, 'rb') as f:
-            encoding_bytes = f.read()
-        return encoding_bytes
+        encoding = store.get(user_profile.user_id)
+        return pack_encoding(encoding) if encoding is not None else None
     except Exception:
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,280 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .ann import IVFIndex
+from .encoding_format import unpack_encoding
+from .gallery_store import get_gallery_file
+
+logger = logging.getLogger(__name__)
+
+ENCODING_DIMENSION = 128
+
+
+class FaceGallery:
+    """Every enrolled face encoding held in one contiguous matrix for 1:N search
+
+    Rows are kept packed at the front of the matrix; removing a user moves the
+    last row into the freed slot so a probe is always a single matrix-vector
+    product over ``matrix[:size]``. When an approximate index is attached,
+    large galleries are searched through it and only its candidates are
+    re-scored exactly against the matrix.
+    """
+
+    def __init__(self, dimension=ENCODING_DIMENSION, capacity=1024):
+        self.dimension = dimension
+        self._lock = threading.RLock()
+        self._matrix = np.zeros((capacity, dimension), dtype=np.float32)
+        self._sq_norms = np.zeros(capacity, dtype=np.float32)
+        self._user_ids = np.zeros(capacity, dtype=np.int64)
+        self._rows = {}
+        self._size = 0
+        self.index = None
+        self.loaded_at = None
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, user_id):
+        return user_id in self._rows
+
+    def _grow(self, minimum):
+        capacity = max(minimum, 2 * len(self._matrix))
+        matrix = np.zeros((capacity, self.dimension), dtype=np.float32)
+        sq_norms = np.zeros(capacity, dtype=np.float32)
+        user_ids = np.zeros(capacity, dtype=np.int64)
+        matrix[:self._size] = self._matrix[:self._size]
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        user_ids[:self._size] = self._user_ids[:self._size]
+        self._matrix, self._sq_norms, self._user_ids = matrix, sq_norms, user_ids
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._size = 0
+            self.loaded_at = None
+
+    def update(self, user_id, encoding):
+        """Insert or replace the encoding for a user"""
+        encoding = np.asarray(encoding, dtype=np.float32).reshape(self.dimension)
+        with self._lock:
+            row = self._rows.get(user_id)
+            if row is None:
+                if self._size == len(self._matrix):
+                    self._grow(self._size + 1)
+                row = self._size
+                self._rows[user_id] = row
+                self._user_ids[row] = user_id
+                self._size += 1
+            self._matrix[row] = encoding
+            self._sq_norms[row] = encoding @ encoding
+            if self.index is not None:
+                self.index.add([user_id], encoding[None, :])
+
+    def remove(self, user_id):
+        """Drop a user's encoding, keeping the matrix packed"""
+        with self._lock:
+            row = self._rows.pop(user_id, None)
+            if row is None:
+                return False
+            if self.index is not None:
+                self.index.remove(user_id)
+            last = self._size - 1
+            if row != last:
+                moved_user = int(self._user_ids[last])
+                self._matrix[row] = self._matrix[last]
+                self._sq_norms[row] = self._sq_norms[last]
+                self._user_ids[row] = moved_user
+                self._rows[moved_user] = row
+            self._size = last
+            return True
+
+    def load(self, items):
+        """Replace the gallery contents with ``(user_id, encoding)`` pairs"""
+        items = list(items)
+        user_ids = np.fromiter((user_id for user_id, _ in items), dtype=np.int64, count=len(items))
+        encodings = np.asarray([encoding for _, encoding in items], dtype=np.float32).reshape(-1, self.dimension)
+        self.load_arrays(user_ids, encodings)
+
+    def load_arrays(self, user_ids, encodings):
+        """Replace the gallery contents with parallel arrays of ids and encodings"""
+        # Build off to the side so concurrent searches never see a partial load
+        size = len(user_ids)
+        capacity = max(size + size // 4, 1024)
+        matrix = np.zeros((capacity, self.dimension), dtype=np.float32)
+        matrix[:size] = encodings
+        sq_norms = np.zeros(capacity, dtype=np.float32)
+        sq_norms[:size] = np.einsum('ij,ij->i', matrix[:size], matrix[:size])
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[:size] = user_ids
+        rows = {user_id: row for row, user_id in enumerate(ids[:size].tolist())}
+        with self._lock:
+            self._matrix, self._sq_norms, self._user_ids = matrix, sq_norms, ids
+            self._rows, self._size = rows, size
+            # The index lists describe the old contents; callers re-attach one
+            self.index = None
+            self.loaded_at = time.monotonic()
+
+    def attach_index(self, index):
+        """Search through an approximate index, filling its lists from the matrix"""
+        with self._lock:
+            if index is not None:
+                index.clear()
+                index.add(self._user_ids[:self._size], self._matrix[:self._size])
+            self.index = index
+
+    def search(self, probe, k=5, nprobe=None, rerank=None, exact=False):
+        """Return the ``k`` closest ``(user_id, distance)`` pairs to a probe encoding"""
+        probe = np.asarray(probe, dtype=np.float32).reshape(self.dimension)
+        if rerank is None:
+            rerank = getattr(settings, 'FACE_ANN_RERANK', 4)
+        with self._lock:
+            size = self._size
+            if not size or k <= 0:
+                return []
+            if self.index is not None and not exact:
+                # Re-score the index's shortlist exactly against the stored rows
+                candidate_ids, _ = self.index.search(probe, k * max(rerank, 1), nprobe)
+                rows = np.fromiter((self._rows[int(i)] for i in candidate_ids), dtype=np.int64, count=len(candidate_ids))
+                if not len(rows):
+                    return []
+            else:
+                rows = slice(0, size)
+            # |m - p|^2 = |m|^2 - 2 m.p + |p|^2, one BLAS call for the whole gallery
+            sq_distances = self._sq_norms[rows] - 2.0 * (self._matrix[rows] @ probe) + probe @ probe
+            user_ids = self._user_ids[rows].copy()
+
+        k = min(k, len(user_ids))
+        nearest = np.argpartition(sq_distances, k - 1)[:k]
+        nearest = nearest[np.argsort(sq_distances[nearest])]
+        distances = np.sqrt(np.maximum(sq_distances[nearest], 0.0))
+        return [(int(user_ids[i]), float(d)) for i, d in zip(nearest, distances)]
+
+
+_gallery = FaceGallery()
+
+# How far this process has read the gallery file. Only read or moved under
+# _sync_lock, so concurrent requests never apply the file's changes twice or
+# roll the position back past a reload.
+_store_position = None
+_sync_lock = threading.Lock()
+
+
+def iter_enrolled_encodings():
+    """Yield ``(user_id, encoding)`` for every profile with face data, from the database"""
+    from .models import UserProfile
+    rows = (UserProfile.objects
+            .filter(has_face_data=True)
+            .values_list('user_id', 'face_encoding')
+            .iterator(chunk_size=2000))
+    for user_id, encoding_bytes in rows:
+        if encoding_bytes:
+            yield user_id, unpack_encoding(encoding_bytes)
+
+
+def get_index_path():
+    return getattr(settings, 'FACE_ANN_INDEX_PATH', os.path.join(settings.FACE_STATE_DIR, 'face_ann_index.npz'))
+
+
+def _load_index():
+    """Load the trained ANN quantizers if enabled, built, and worth using for this gallery size"""
+    if not getattr(settings, 'FACE_ANN_ENABLED', True):
+        return None
+    if len(_gallery) < getattr(settings, 'FACE_ANN_MIN_GALLERY_SIZE', 20000):
+        return None
+    path = get_index_path()
+    if not os.path.exists(path):
+        logger.warning(f"Face gallery has {len(_gallery)} entries but no ANN index at {path}; "
+                       "run 'manage.py rebuild_face_index'")
+        return None
+    try:
+        return IVFIndex.load(path, nprobe=getattr(settings, 'FACE_ANN_NPROBE', 16))
+    except Exception as e:
+        logger.error(f"Could not load face ANN index: {str(e)}")
+        return None
+
+
+def _load_gallery(store):
+    """Fill the gallery from the mapped gallery file, or the database without one; hold _sync_lock"""
+    global _store_position
+    if store is None:
+        _gallery.load(iter_enrolled_encodings())
+    else:
+        if not os.path.exists(store.path):
+            # First load since the gallery file was enabled: seed it from the database
+            store.compact(iter_enrolled_encodings())
+        _store_position = store.position()
+        _gallery.load_arrays(*store.snapshot())
+    _gallery.attach_index(_load_index())
+
+
+def get_gallery():
+    """Return the process-wide gallery, bringing it up to date first
+
+    Signal handlers keep the gallery current for saves made in this process.
+    With a gallery file, records appended by other workers are applied from
+    the mapping on each call; the periodic full reload also picks up any ANN
+    index rebuilt since the last load.
+    """
+    global _store_position
+    store = get_gallery_file()
+    max_age = getattr(settings, 'FACE_GALLERY_MAX_AGE_SECONDS', 300)
+    # Searches only take the gallery's own lock, so they carry on during a refresh
+    with _sync_lock:
+        loaded_at = _gallery.loaded_at
+        if loaded_at is None or (max_age and time.monotonic() - loaded_at > max_age):
+            _load_gallery(store)
+        elif store is not None:
+            _store_position, changed = store.changes_since(_store_position)
+            if changed is None:
+                # The file was compacted or rebuilt
+                _load_gallery(store)
+            else:
+                for user_id in changed:
+                    encoding = store.get(user_id)
+                    if encoding is None:
+                        _gallery.remove(user_id)
+                    else:
+                        _gallery.update(user_id, encoding)
+    return _gallery
+
+
+def update_user_encoding(user_id, encoding_bytes):
+    """Record a user's new stored face encoding in the gallery file and loaded gallery"""
+    encoding = unpack_encoding(encoding_bytes) if encoding_bytes else None
+    store = get_gallery_file()
+    if store is not None:
+        if encoding is None:
+            store.delete(user_id)
+        else:
+            store.append(user_id, encoding)
+    if _gallery.loaded_at is None:
+        # Nothing loaded yet; the first search reads everything anyway
+        return
+    if encoding is None:
+        _gallery.remove(user_id)
+    else:
+        _gallery.update(user_id, encoding)
+
+
+def remove_user(user_id):
+    """Drop a user from the gallery file and loaded gallery"""
+    store = get_gallery_file()
+    if store is not None:
+        store.delete(user_id)
+    _gallery.remove(user_id)
+
+
+def identify_face(encoding, k=None, tolerance=None):
+    """Return up to ``k`` ``(user_id, distance)`` candidates within tolerance"""
+    if k is None:
+        k = getattr(settings, 'FACE_IDENTIFY_TOP_K', 5)
+    if tolerance is None:
+        tolerance = getattr(settings, 'FACE_RECOGNITION_TOLERANCE', 0.6)
+
+    candidates = get_gallery().search(encoding, k)
+    return [(user_id, distance) for user_id, distance in candidates if distance <= tolerance]
@@ -0,0 +1,222 @@
+"""Append-only, memory-mapped gallery file of face encodings indexed by user id
+
+Every enrollment change appends one fixed-width record (user id, flags,
+float32 encoding); the latest record for a user wins and a record without the
+LIVE flag is a deletion. Workers map the file read-only, so the page cache is
+shared between them, and refreshing only has to scan records appended since
+the last look. ``compact()`` rewrites the file keeping one record per live user.
+"""
+import os
+import struct
+import threading
+
+import numpy as np
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX development machines
+    fcntl = None
+
+MAGIC = b'FGAL'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')
+HEADER_SIZE = 64
+FLAG_LIVE = 1
+
+
+def record_dtype(dimension):
+    return np.dtype([
+        ('user_id', '<i8'),
+        ('flags', '<u4'),
+        ('reserved', '<u4'),
+        ('encoding', '<f4', (dimension,)),
+    ])
+
+
+class GalleryFile:
+    """Reader/writer for one gallery file"""
+
+    def __init__(self, path, dimension=128):
+        self.path = path
+        self.dimension = dimension
+        self.dtype = record_dtype(dimension)
+        self._lock = threading.Lock()
+        self._records = None
+        self._inode = None
+        self._rows = {}
+
+    def _header_bytes(self):
+        header = HEADER.pack(MAGIC, VERSION, self.dimension, self.dtype.itemsize)
+        return header.ljust(HEADER_SIZE, b'\0')
+
+    def _check_header(self, header):
+        magic, version, dimension, record_size = HEADER.unpack_from(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{self.path} is not a version {VERSION} face gallery file")
+        if dimension != self.dimension or record_size != self.dtype.itemsize:
+            raise ValueError(f"{self.path} holds {dimension}-d records, expected {self.dimension}-d")
+
+    def _open_locked(self):
+        """Open the current file for appending under an exclusive lock"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        while True:
+            f = open(self.path, 'ab')
+            if fcntl is None:
+                return f
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # compact() may have swapped the file while we waited for the lock
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def _write_records(self, records):
+        f = self._open_locked()
+        try:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                f.write(self._header_bytes())
+            else:
+                # Drop a torn record left by a crashed writer so records stay aligned
+                torn = (size - HEADER_SIZE) % self.dtype.itemsize
+                if torn:
+                    f.truncate(size - torn)
+            f.write(records.tobytes())
+            f.flush()
+        finally:
+            f.close()
+
+    def append(self, user_id, encoding):
+        """Record a user's current encoding"""
+        record = np.zeros(1, dtype=self.dtype)
+        record['user_id'] = user_id
+        record['flags'] = FLAG_LIVE
+        record['encoding'] = np.asarray(encoding, dtype='<f4').reshape(self.dimension)
+        self._write_records(record)
+
+    def delete(self, user_id):
+        """Record that a user no longer has an encoding"""
+        record = np.zeros(1, dtype=self.dtype)
+        record['user_id'] = user_id
+        self._write_records(record)
+
+    def refresh(self):
+        """Map any records appended (or a compacted file written) since the last call"""
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                stat = None
+            if stat is None or stat.st_size < HEADER_SIZE:
+                self._records, self._inode, self._rows = None, None, {}
+                return
+            count = max(stat.st_size - HEADER_SIZE, 0) // self.dtype.itemsize
+            if stat.st_ino != self._inode:
+                # New or replaced file: start over
+                with open(self.path, 'rb') as f:
+                    self._check_header(f.read(HEADER_SIZE))
+                self._records, self._inode, self._rows = None, stat.st_ino, {}
+            seen = 0 if self._records is None else len(self._records)
+            if count == seen:
+                return
+            self._records = np.memmap(self.path, dtype=self.dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+            new = self._records[seen:count]
+            for offset, (user_id, flags) in enumerate(zip(new['user_id'].tolist(), new['flags'].tolist())):
+                if flags & FLAG_LIVE:
+                    self._rows[user_id] = seen + offset
+                else:
+                    self._rows.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def position(self):
+        """Opaque marker of how much of the file has been read"""
+        return self._inode, 0 if self._records is None else len(self._records)
+
+    def changes_since(self, position):
+        """Return ``(new_position, user_ids)`` for records appended after ``position``
+
+        ``user_ids`` is None when the file was replaced and must be re-read.
+        """
+        self.refresh()
+        current = self.position()
+        if position is None or position[0] != current[0]:
+            return current, None
+        if position[1] == current[1]:
+            return current, []
+        changed = self._records['user_id'][position[1]:current[1]]
+        return current, list(dict.fromkeys(changed.tolist()))
+
+    def get(self, user_id):
+        """Return a read-only view of a user's latest encoding, or None"""
+        self.refresh()
+        row = self._rows.get(user_id)
+        if row is None:
+            return None
+        return self._records['encoding'][row]
+
+    def snapshot(self):
+        """Return ``(user_ids, encodings)`` for every live user
+
+        When the file has been compacted the encodings are a zero-copy view of
+        the mapping; otherwise superseded records are skipped with one gather.
+        """
+        self.refresh()
+        if not self._rows:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.dimension), dtype='<f4')
+        rows = np.fromiter(self._rows.values(), dtype=np.int64, count=len(self._rows))
+        rows.sort()
+        if len(rows) == len(self._records):
+            records = self._records
+        else:
+            records = self._records[rows]
+        return records['user_id'], records['encoding']
+
+    def compact(self, items=None):
+        """Rewrite the file with one record per live user
+
+        ``items`` (``(user_id, encoding)`` pairs) replaces the contents
+        entirely, e.g. when rebuilding from the database.
+        """
+        # Hold the writers' lock so no append lands in the file being replaced
+        lock_file = self._open_locked()
+        try:
+            if items is None:
+                user_ids, encodings = self.snapshot()
+                items = zip(user_ids.tolist(), encodings)
+            items = list(items)
+            records = np.zeros(len(items), dtype=self.dtype)
+            if items:
+                records['user_id'] = [user_id for user_id, _ in items]
+                records['flags'] = FLAG_LIVE
+                records['encoding'] = np.asarray([encoding for _, encoding in items], dtype='<f4')
+
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(self._header_bytes())
+                f.write(records.tobytes())
+            os.replace(temp_path, self.path)
+        finally:
+            lock_file.close()
+        self.refresh()
+        return len(records)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_gallery_file():
+    """Return the process-wide gallery file, or None when it is disabled"""
+    global _store
+    path = getattr(settings, 'FACE_GALLERY_FILE', None)
+    if not path:
+        return None
+    with _store_lock:
+        if _store is None or _store.path != path:
+            _store = GalleryFile(path)
+    return _store
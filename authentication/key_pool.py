@@ -0,0 +1,118 @@
+"""Reservoir of pre-generated key pairs
+
+Generating an RSA-2048 key takes hundreds of milliseconds of prime search with
+a long tail, so registration (and login for accounts without keys) claims a
+pair generated ahead of time instead. Pairs are pooled per signature
+algorithm; requests claim pairs for ``SIGNATURE_ALGORITHM``. The pool is topped up to
+``KEY_POOL_TARGET`` pairs by the ``fill_key_pool`` management command and, when
+``KEY_POOL_BACKGROUND_REFILL`` is set, by a background thread started whenever
+a claim leaves fewer than ``KEY_POOL_LOW_WATER`` pairs. An empty pool falls
+back to generating inline.
+
+A pair is claimed by deleting its row: only the request whose DELETE removed
+the row uses it, so no pair is ever handed out twice, on any database backend.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from . import metrics
+from .crypto_utils import generate_key_pair, preferred_algorithm
+from .models import PregeneratedKeyPair
+
+logger = logging.getLogger(__name__)
+
+pairs_claimed = metrics.counter('key_pool_claimed', "Key pairs taken from the pre-generated pool")
+pairs_generated_inline = metrics.counter('key_pool_generated_inline', "Key pairs generated during a request because the pool was empty")
+pairs_added = metrics.counter('key_pool_added', "Key pairs added to the pre-generated pool")
+
+# Rows looked at per claim attempt, so concurrent claims rarely race for the same one
+CLAIM_CANDIDATES = 8
+
+_refill_thread = None
+_refill_lock = threading.Lock()
+
+
+def pool_size(algorithm=None):
+    return PregeneratedKeyPair.objects.filter(algorithm=algorithm or preferred_algorithm()).count()
+
+
+def store_key_pairs(pairs, algorithm=None):
+    """Add ``(public_key, private_key)`` pairs of one algorithm to the pool"""
+    algorithm = algorithm or preferred_algorithm()
+    objs = [
+        PregeneratedKeyPair(algorithm=algorithm, public_key=public_key, private_key=private_key)
+        for public_key, private_key in pairs
+    ]
+    PregeneratedKeyPair.objects.bulk_create(objs)
+    pairs_added.inc(len(objs))
+    return len(objs)
+
+
+def fill_key_pool(target=None, algorithm=None, batch_size=10):
+    """Generate pairs in this thread until the pool holds ``target``; return how many were added"""
+    if target is None:
+        target = getattr(settings, 'KEY_POOL_TARGET', 100)
+    algorithm = algorithm or preferred_algorithm()
+    added = 0
+    missing = target - pool_size(algorithm)
+    while missing > 0:
+        count = min(batch_size, missing)
+        added += store_key_pairs((generate_key_pair(algorithm) for _ in range(count)), algorithm)
+        missing -= count
+    return added
+
+
+def _take_pooled_pair(algorithm):
+    """Atomically remove one pair from the pool, or return None if it is empty"""
+    while True:
+        candidates = list(
+            PregeneratedKeyPair.objects.filter(algorithm=algorithm).order_by('id')
+            .values_list('id', 'public_key', 'private_key')[:CLAIM_CANDIDATES]
+        )
+        if not candidates:
+            return None
+        for pair_id, public_key, private_key in candidates:
+            deleted, _ = PregeneratedKeyPair.objects.filter(id=pair_id).delete()
+            if deleted:
+                return public_key, private_key
+        # Every candidate was claimed by someone else meanwhile; look again
+
+
+def _refill(algorithm):
+    try:
+        added = fill_key_pool(algorithm=algorithm)
+        logger.info(f"Refilled key pool with {added} {algorithm} key pairs")
+    except Exception as e:
+        logger.error(f"Key pool refill failed: {str(e)}")
+    finally:
+        connection.close()
+
+
+def _maybe_refill(algorithm):
+    """Start a background refill when the pool has fallen below the low-water mark"""
+    global _refill_thread
+    if not getattr(settings, 'KEY_POOL_BACKGROUND_REFILL', True):
+        return
+    if pool_size(algorithm) >= getattr(settings, 'KEY_POOL_LOW_WATER', 20):
+        return
+    with _refill_lock:
+        if _refill_thread is not None and _refill_thread.is_alive():
+            return
+        _refill_thread = threading.Thread(target=_refill, args=(algorithm,), name='key-pool-refill', daemon=True)
+        _refill_thread.start()
+
+
+def claim_key_pair(algorithm=None):
+    """Return a fresh ``(public_key_pem, private_key_pem)``, from the pool when possible"""
+    algorithm = algorithm or preferred_algorithm()
+    pair = _take_pooled_pair(algorithm)
+    if pair is not None:
+        pairs_claimed.inc(algorithm=algorithm)
+    else:
+        pairs_generated_inline.inc(algorithm=algorithm)
+        pair = generate_key_pair(algorithm)
+    _maybe_refill(algorithm)
+    return pair
@@ -0,0 +1,253 @@
+"""Buffered, batched writer for LoginLog records
+
+Login attempts are queued in memory and written with one ``bulk_create`` when
+``LOGIN_LOG_BATCH_SIZE`` records are waiting or ``LOGIN_LOG_FLUSH_SECONDS``
+have passed, by a background thread rather than the request. Pending records
+are flushed at interpreter exit.
+
+If a flush fails (database locked, restarting, unreachable) the batch is
+appended to ``LOGIN_LOG_SPOOL_FILE`` as JSON lines and replayed after the next
+successful flush, so audit records survive short outages. Spool files a
+crashed process had claimed for replay are picked up by the next process to
+flush, skipping records that already reached the database.
+
+Each written batch is also folded into the LoginStat rollups.
+
+With ``LOGIN_LOG_BUFFERED = False`` records are written synchronously.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import metrics
+from .login_stats import apply_rollup
+from .models import LoginLog
+
+logger = logging.getLogger(__name__)
+
+records_written = metrics.counter('login_log_written', "Login log records written to the database")
+records_spooled = metrics.counter('login_log_spooled', "Login log records written to the spool file after a failed flush")
+
+
+class LoginLogWriter:
+    def __init__(self, batch_size=100, flush_interval=1.0, spool_path=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self._pid = os.getpid()
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._recovered = False
+        metrics.gauge('login_log_pending', "Login log records waiting to be written", lambda: len(self._buffer))
+
+    def _ensure_thread(self):
+        if os.getpid() != self._pid:
+            # Forked after records were queued: they belong to the parent
+            self._pid = os.getpid()
+            self._buffer = []
+            self._thread = None
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='login-log-writer', daemon=True)
+            self._thread.start()
+
+    def record(self, **fields):
+        """Queue one LoginLog record; ``fields`` are LoginLog field values"""
+        fields.setdefault('timestamp', timezone.now())
+        with self._lock:
+            self._ensure_thread()
+            self._buffer.append(fields)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write every queued record now; return how many reached the database"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            try:
+                LoginLog.objects.bulk_create([LoginLog(**fields) for fields in batch])
+            except Exception as e:
+                logger.error(f"Writing {len(batch)} login log records failed, spooling them: {str(e)}")
+                self._spool(batch)
+                connection.close()
+                return 0
+            records_written.inc(len(batch))
+            _roll_up(batch)
+            self._replay_spool()
+            return len(batch)
+
+    def _spool(self, batch):
+        if not self.spool_path:
+            logger.error(f"No LOGIN_LOG_SPOOL_FILE configured; {len(batch)} login log records lost")
+            return
+        with open(self.spool_path, 'a') as f:
+            for fields in batch:
+                f.write(json.dumps({**fields, 'timestamp': fields['timestamp'].isoformat()}) + '\n')
+        records_spooled.inc(len(batch))
+
+    def _replay_spool(self):
+        """Move spooled records into the database after a flush has succeeded"""
+        if not self.spool_path:
+            return
+        if not self._recovered:
+            self._recovered = True
+            self._replay_abandoned()
+        if not os.path.exists(self.spool_path):
+            return
+        # Claim the file first so concurrent writers start a fresh spool
+        claimed = f"{self.spool_path}.{os.getpid()}.replay"
+        try:
+            os.replace(self.spool_path, claimed)
+        except FileNotFoundError:
+            return
+        self._replay_file(claimed)
+
+    def _replay_abandoned(self):
+        """Replay spool files claimed by a process that died before it finished them"""
+        for path in glob.glob(f"{glob.escape(self.spool_path)}.*.replay"):
+            pid = path[len(self.spool_path) + 1:-len('.replay')]
+            if not pid.isdigit() or _process_alive(int(pid)):
+                continue
+            claimed = f"{self.spool_path}.{os.getpid()}.replay"
+            try:
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                # Another process claimed it first
+                continue
+            logger.warning(f"Replaying login log spool {path} left behind by process {pid}")
+            self._replay_file(claimed, partly_written=True)
+
+    def _replay_file(self, path, partly_written=False):
+        """Insert the records of a claimed spool file, then delete it"""
+        batch = []
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    fields = json.loads(line)
+                except ValueError:
+                    # Cut short by a crash while spooling
+                    logger.error(f"Dropping unreadable spooled login log record: {line!r}")
+                    continue
+                fields['timestamp'] = parse_datetime(fields['timestamp'])
+                batch.append(fields)
+        if partly_written:
+            batch = _not_yet_written(batch)
+        try:
+            LoginLog.objects.bulk_create([LoginLog(**fields) for fields in batch], batch_size=500)
+        except Exception as e:
+            logger.error(f"Replaying {len(batch)} spooled login log records failed, retrying one by one: {str(e)}")
+            self._replay_individually(batch)
+        else:
+            records_written.inc(len(batch))
+            _roll_up(batch)
+            logger.info(f"Replayed {len(batch)} spooled login log records")
+        os.unlink(path)
+
+    def _replay_individually(self, batch):
+        """Insert records one at a time, dropping those that can never be written"""
+        retry, written = [], []
+        for fields in batch:
+            try:
+                LoginLog.objects.create(**fields)
+                records_written.inc()
+                written.append(fields)
+            except IntegrityError as e:
+                # e.g. the user was deleted meanwhile; spooling it again would loop forever
+                logger.error(f"Dropping spooled login log record {fields}: {str(e)}")
+            except Exception:
+                retry.append(fields)
+        _roll_up(written)
+        if retry:
+            self._spool(retry)
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+
+
+def _process_alive(pid):
+    # This process finishes each file it claims before flush returns, so a file
+    # carrying its pid was left by an earlier process that had the same pid
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _not_yet_written(batch):
+    """Drop records a crashed replay had already inserted
+
+    A user and the attempt's microsecond timestamp identify a record.
+    """
+    if not batch:
+        return batch
+    timestamps = [fields['timestamp'] for fields in batch]
+    written = set(LoginLog.objects.filter(
+        user_id__in={fields['user_id'] for fields in batch},
+        timestamp__range=(min(timestamps), max(timestamps)),
+    ).values_list('user_id', 'timestamp'))
+    return [fields for fields in batch if (fields['user_id'], fields['timestamp']) not in written]
+
+
+def _roll_up(batch):
+    try:
+        apply_rollup(batch)
+    except Exception as e:
+        # The logs themselves are stored; backfill_login_stats can rebuild the rollup
+        logger.error(f"Updating login stats for {len(batch)} records failed: {str(e)}")
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = LoginLogWriter(
+                getattr(settings, 'LOGIN_LOG_BATCH_SIZE', 100),
+                getattr(settings, 'LOGIN_LOG_FLUSH_SECONDS', 1.0),
+                getattr(settings, 'LOGIN_LOG_SPOOL_FILE', None),
+            )
+            atexit.register(_writer.close)
+        return _writer
+
+
+def record_login(**fields):
+    """Record a login attempt, buffered unless LOGIN_LOG_BUFFERED is off"""
+    if not getattr(settings, 'LOGIN_LOG_BUFFERED', True):
+        fields.setdefault('timestamp', timezone.now())
+        LoginLog.objects.create(**fields)
+        _roll_up([fields])
+        return
+    get_writer().record(**fields)
@@ -0,0 +1,142 @@
+"""Incremental per-user hourly and daily rollups of login attempts
+
+Every batch of LoginLog records the log writer stores is folded into
+``LoginStat`` rows, so the dashboard and admin read a handful of pre-aggregated
+rows instead of scanning the raw log table. ``manage.py backfill_login_stats``
+rebuilds the rollups from existing logs.
+
+Each row keeps at most ``LOGIN_STAT_MAX_IPS`` distinct client IPs, so a bucket
+hit from a botnet stays small; a full bucket is flagged ``ips_truncated`` and
+keeps the addresses it saw first.
+"""
+from collections import defaultdict
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .models import LoginStat
+
+GRANULARITIES = ('hour', 'day')
+# Rollup keys looked up per query (bounded by SQLite's bound-parameter limit)
+ROLLUP_LOOKUP_CHUNK = 300
+
+
+def bucket_start(timestamp, granularity):
+    """Truncate a timestamp to the start of its UTC hour or day"""
+    timestamp = timestamp.astimezone(dt_timezone.utc)
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _accumulate(records):
+    """Group login records into ``{(user_id, granularity, bucket): totals}``"""
+    totals = defaultdict(lambda: {'successes': 0, 'failures': 0, 'score_sum': 0.0, 'score_count': 0,
+                                  'score_min': None, 'ips': set()})
+    for record in records:
+        for granularity in GRANULARITIES:
+            entry = totals[(record['user_id'], granularity, bucket_start(record['timestamp'], granularity))]
+            entry['successes' if record.get('successful') else 'failures'] += 1
+            score = record.get('face_match_score')
+            if score is not None:
+                entry['score_sum'] += score
+                entry['score_count'] += 1
+                entry['score_min'] = score if entry['score_min'] is None else min(entry['score_min'], score)
+            if record.get('ip_address'):
+                entry['ips'].add(record['ip_address'])
+    return totals
+
+
+def _lock_existing(keys):
+    """Lock and return the rollup rows that already exist for ``keys``
+
+    Keys are looked up in sorted chunks by user, granularity and bucket range
+    rather than one OR'ed condition per key, which SQLite cannot parse for
+    large batches; rows inside a chunk's range but not in ``keys`` are dropped.
+    """
+    existing = {}
+    keys = sorted(keys)
+    for start in range(0, len(keys), ROLLUP_LOOKUP_CHUNK):
+        chunk = keys[start:start + ROLLUP_LOOKUP_CHUNK]
+        wanted = set(chunk)
+        rows = LoginStat.objects.select_for_update().filter(
+            user_id__in={user_id for user_id, _, _ in chunk},
+            granularity__in={granularity for _, granularity, _ in chunk},
+            bucket__range=(min(bucket for _, _, bucket in chunk), max(bucket for _, _, bucket in chunk)),
+        )
+        for stat in rows:
+            key = (stat.user_id, stat.granularity, stat.bucket)
+            if key in wanted:
+                existing[key] = stat
+    return existing
+
+
+def _apply(totals):
+    max_ips = getattr(settings, 'LOGIN_STAT_MAX_IPS', 50)
+    with transaction.atomic():
+        existing = _lock_existing(totals)
+        created, updated = [], []
+        for key, entry in totals.items():
+            stat = existing.get(key)
+            if stat is None:
+                user_id, granularity, bucket = key
+                stat = LoginStat(user_id=user_id, granularity=granularity, bucket=bucket)
+                created.append(stat)
+            else:
+                updated.append(stat)
+            stat.successes += entry['successes']
+            stat.failures += entry['failures']
+            stat.score_sum += entry['score_sum']
+            stat.score_count += entry['score_count']
+            if entry['score_min'] is not None:
+                stat.score_min = entry['score_min'] if stat.score_min is None else min(stat.score_min, entry['score_min'])
+            kept = stat.ip_addresses[:max_ips]
+            new_ips = sorted(entry['ips'].difference(stat.ip_addresses))
+            room = max_ips - len(kept)
+            if len(kept) < len(stat.ip_addresses) or len(new_ips) > room:
+                stat.ips_truncated = True
+            stat.ip_addresses = sorted(kept + new_ips[:room])
+        LoginStat.objects.bulk_create(created)
+        LoginStat.objects.bulk_update(updated, ['successes', 'failures', 'score_sum', 'score_count',
+                                               'score_min', 'ip_addresses', 'ips_truncated'])
+
+
+def apply_rollup(records):
+    """Add a batch of login records (dicts of LoginLog fields) to the rollup table"""
+    totals = _accumulate(records)
+    if not totals:
+        return 0
+    try:
+        _apply(totals)
+    except IntegrityError:
+        # Another writer created one of our new buckets after we looked; the
+        # rollback undid all of this batch, and a second pass finds and
+        # increments that row instead of inserting it
+        _apply(totals)
+    return len(totals)
+
+
+def summarize(user, since):
+    """Totals of a user's daily rollups from ``since`` onwards"""
+    rows = LoginStat.objects.filter(user=user, granularity='day', bucket__gte=bucket_start(since, 'day')).values_list(
+        'successes', 'failures', 'score_sum', 'score_count', 'ip_addresses', 'ips_truncated')
+    successes = failures = score_count = 0
+    score_sum = 0.0
+    ips = set()
+    ips_truncated = False
+    for row_successes, row_failures, row_score_sum, row_score_count, ip_addresses, row_ips_truncated in rows:
+        successes += row_successes
+        failures += row_failures
+        score_sum += row_score_sum
+        score_count += row_score_count
+        ips.update(ip_addresses)
+        ips_truncated = ips_truncated or row_ips_truncated
+    return {
+        'successes': successes,
+        'failures': failures,
+        'score_mean': score_sum / score_count if score_count else None,
+        # A lower bound when any day had more IPs than it keeps
+        'distinct_ips': len(ips),
+        'distinct_ips_truncated': ips_truncated,
+    }
@@ -0,0 +1,48 @@
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.login_stats import apply_rollup, bucket_start
+from authentication.models import LoginLog, LoginStat
+
+
+class Command(BaseCommand):
+    help = "Rebuild the hourly and daily LoginStat rollups from the raw login logs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Only rebuild from this date (YYYY-MM-DD, UTC); default: everything")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Login logs read per batch")
+
+    def handle(self, *args, **options):
+        logs = LoginLog.objects.all()
+        stats = LoginStat.objects.all()
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d').replace(tzinfo=dt_timezone.utc)
+            except ValueError:
+                raise CommandError("--since must be a date in YYYY-MM-DD format.")
+            since = bucket_start(since, 'day')
+            logs = logs.filter(timestamp__gte=since)
+            stats = stats.filter(bucket__gte=since)
+
+        started = time.perf_counter()
+        removed, _ = stats.delete()
+        self.stdout.write(f"Removed {removed} existing rollup rows")
+
+        total, last_pk = 0, 0
+        fields = ('pk', 'user_id', 'timestamp', 'successful', 'face_match_score', 'ip_address')
+        while True:
+            batch = list(logs.filter(pk__gt=last_pk).order_by('pk').values(*fields)[:options['batch_size']])
+            if not batch:
+                break
+            apply_rollup(batch)
+            total += len(batch)
+            last_pk = batch[-1]['pk']
+            if options['verbosity'] > 1:
+                self.stdout.write(f"  {total} login logs rolled up")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Rolled up {total} login logs into {LoginStat.objects.count()} rows in {elapsed:.1f}s"
+        ))
@@ -0,0 +1,111 @@
+import json
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from authentication.ann import IVFIndex
+from authentication.gallery import FaceGallery, iter_enrolled_encodings
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def synthetic_encodings(size, queries, seed=0):
+    """Gallery and probe sets shaped like dlib encodings
+
+    Identities are spread like real 128-d encodings (typical inter-person
+    distance ~0.9) and probes are noisy re-captures of enrolled identities
+    (distance ~0.35), so recall reflects a realistic login workload.
+    """
+    rng = np.random.default_rng(seed)
+    gallery = rng.normal(0.0, 0.056, size=(size, 128))
+    targets = rng.choice(size, queries, replace=False)
+    probes = gallery[targets] + rng.normal(0.0, 0.03, size=(queries, 128))
+    return gallery, probes
+
+
+class Command(BaseCommand):
+    help = "Measure ANN recall and latency against exact brute-force search over the face gallery"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=100000, help="Synthetic gallery size")
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--k', type=int, default=getattr(settings, 'FACE_IDENTIFY_TOP_K', 5))
+        parser.add_argument('--nlist', type=_int_list, default=[getattr(settings, 'FACE_ANN_NLIST', 1024)],
+                            help="Comma-separated cell counts to try")
+        parser.add_argument('--nprobe', type=_int_list, default=[1, 4, 8, 16, 32, 64],
+                            help="Comma-separated probe counts to try")
+        parser.add_argument('--pq-m', type=_int_list, default=[0, 16, 32],
+                            help="Comma-separated PQ sub-quantizer counts (0 = raw vectors)")
+        parser.add_argument('--rerank', type=int, default=getattr(settings, 'FACE_ANN_RERANK', 4))
+        parser.add_argument('--from-db', action='store_true',
+                            help="Benchmark the enrolled encodings instead of synthetic data")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', dest='json_path', help="Also write results to this JSON file")
+
+    def _time_queries(self, gallery, probes, k, **search_kwargs):
+        latencies, results = [], []
+        for probe in probes:
+            started = time.perf_counter()
+            results.append(gallery.search(probe, k, **search_kwargs))
+            latencies.append(time.perf_counter() - started)
+        latencies = np.array(latencies) * 1000
+        return results, {
+            'mean_ms': round(float(latencies.mean()), 3),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+            'qps': round(len(latencies) / (latencies.sum() / 1000), 1),
+        }
+
+    def handle(self, *args, **options):
+        k = options['k']
+        tolerance = getattr(settings, 'FACE_RECOGNITION_TOLERANCE', 0.6)
+        if options['from_db']:
+            vectors = np.asarray([encoding for _, encoding in iter_enrolled_encodings()])
+            rng = np.random.default_rng(options['seed'])
+            picks = rng.choice(len(vectors), min(options['queries'], len(vectors)), replace=False)
+            probes = vectors[picks] + rng.normal(0.0, 0.03, size=(len(picks), vectors.shape[1]))
+        else:
+            vectors, probes = synthetic_encodings(options['size'], options['queries'], options['seed'])
+
+        gallery = FaceGallery(capacity=len(vectors))
+        gallery.load(enumerate(vectors))
+        exact, baseline = self._time_queries(gallery, probes, k, exact=True)
+        self.stdout.write(f"Gallery {len(vectors)} x {vectors.shape[1]}, {len(probes)} queries, k={k}")
+        # What identify_face would actually return: exact neighbours within tolerance
+        exact_ids = [{user_id for user_id, _ in found} for found in exact]
+        exact_matches = [{user_id for user_id, distance in found if distance <= tolerance} for found in exact]
+        self.stdout.write(f"{'exact':>30}  recall@k=1.000  match_recall=1.000  mean={baseline['mean_ms']:.3f}ms  "
+                          f"p99={baseline['p99_ms']:.3f}ms  qps={baseline['qps']}")
+
+        report = {'size': len(vectors), 'queries': len(probes), 'k': k, 'rerank': options['rerank'],
+                  'tolerance': tolerance,
+                  'exact': baseline, 'runs': []}
+        for nlist in options['nlist']:
+            for pq_m in options['pq_m']:
+                started = time.perf_counter()
+                index = IVFIndex.train(vectors, min(nlist, len(vectors)), pq_m=pq_m, seed=options['seed'])
+                gallery.attach_index(index)
+                build_seconds = time.perf_counter() - started
+                for nprobe in options['nprobe']:
+                    approx, timing = self._time_queries(gallery, probes, k, nprobe=nprobe, rerank=options['rerank'])
+                    approx_ids = [{user_id for user_id, _ in found} for found in approx]
+                    recall = np.mean([len(a & e) / max(len(e), 1) for a, e in zip(approx_ids, exact_ids)])
+                    match_recall = np.mean([len(a & e) / len(e) for a, e in zip(approx_ids, exact_matches) if e] or [1.0])
+                    run = {'nlist': nlist, 'pq_m': pq_m, 'nprobe': nprobe, 'recall_at_k': round(float(recall), 4),
+                           'match_recall': round(float(match_recall), 4),
+                           'build_seconds': round(build_seconds, 2), **timing}
+                    report['runs'].append(run)
+                    label = f"nlist={nlist} pq_m={pq_m} nprobe={nprobe}"
+                    self.stdout.write(f"{label:>30}  recall@k={recall:.3f}  match_recall={match_recall:.3f}  "
+                                      f"mean={timing['mean_ms']:.3f}ms  "
+                                      f"p99={timing['p99_ms']:.3f}ms  qps={timing['qps']}")
+                gallery.attach_index(None)
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
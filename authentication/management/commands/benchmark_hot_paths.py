@@ -0,0 +1,278 @@
+import json
+import os
+import platform
+import subprocess
+import time
+from importlib import metadata
+from io import BytesIO
+
+import face_recognition
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from PIL import Image
+
+from authentication.crypto_utils import SIGNATURE_ALGORITHMS, generate_key_pair, sign_data, verify_signature
+from authentication.face_utils import compare_faces, decode_image_bytes, detect_faces, process_face_image
+from authentication.gallery import FaceGallery
+from authentication.management.commands.benchmark_face_index import synthetic_encodings
+from authentication import timing
+
+GROUPS = ('face', 'gallery', 'crypto')
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+PACKAGES = ('Django', 'numpy', 'Pillow', 'face_recognition', 'dlib-bin', 'dlib', 'cryptography')
+
+
+def _resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def _list(convert):
+    return lambda value: [convert(v.strip()) for v in value.split(',') if v.strip()]
+
+
+def _summary(samples):
+    samples = np.asarray(samples)
+    return {
+        'runs': len(samples),
+        'min_ms': round(float(samples.min()), 4),
+        'median_ms': round(float(np.median(samples)), 4),
+        'mean_ms': round(float(samples.mean()), 4),
+        'p95_ms': round(float(np.percentile(samples, 95)), 4),
+    }
+
+
+def measure(func, repeat, warmup=1):
+    """Call ``func`` ``warmup`` + ``repeat`` times; summarize the timed calls in milliseconds"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return _summary(samples)
+
+
+def synthetic_image(width, height, seed=0):
+    """Deterministic textured RGB frame: exercises decode and detection without a real face"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 / max(width - 1, 1), y * 255 / max(height - 1, 1),
+                     np.full((height, width), 128.0)], axis=-1)
+    noise = rng.normal(0, 12, size=(height, width, 3))
+    return np.clip(base + noise, 0, 255).astype(np.uint8)
+
+
+def to_jpeg(image, quality=90):
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def fit(image, width, height):
+    """Resize a sample image to the benchmark resolution"""
+    if image.shape[1] == width and image.shape[0] == height:
+        return image
+    return np.asarray(Image.fromarray(image).resize((width, height), Image.BILINEAR))
+
+
+def environment():
+    """Interpreter, hardware, package and settings details stored with every report"""
+    packages = {}
+    for name in PACKAGES:
+        try:
+            packages[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            pass
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'timestamp': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'git_commit': commit,
+        'packages': packages,
+        'settings': {
+            name: getattr(settings, name, None)
+            for name in ('FACE_IMAGE_MAX_DIMENSION', 'FACE_DETECTION_MAX_DIMENSION', 'FACE_DETECTION_UPSAMPLE',
+                         'FACE_DETECTION_FALLBACK_UPSAMPLE', 'FACE_DETECTOR_BACKENDS', 'SIGNATURE_ALGORITHM')
+        },
+    }
+
+
+def compare_reports(current, baseline, threshold, floor_ms):
+    """Return ``(rows, regressions)`` comparing median times of benchmarks present in both reports
+
+    A benchmark regresses when its median grew by more than ``threshold``
+    (a fraction) and by more than ``floor_ms``, so tiny timings do not flag noise.
+    """
+    previous = {result['name']: result for result in baseline['results']}
+    rows, regressions = [], []
+    for result in current['results']:
+        before = previous.get(result['name'])
+        if before is None:
+            continue
+        change = result['median_ms'] / before['median_ms'] - 1 if before['median_ms'] else 0.0
+        regressed = change > threshold and result['median_ms'] - before['median_ms'] > floor_ms
+        row = {'name': result['name'], 'baseline_ms': before['median_ms'], 'current_ms': result['median_ms'],
+               'change': round(change, 4), 'regressed': regressed}
+        rows.append(row)
+        if regressed:
+            regressions.append(row)
+    return rows, regressions
+
+
+class Command(BaseCommand):
+    help = "Time the face pipeline stages, gallery search and signature operations, and compare against a baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', type=_list(str), default=list(GROUPS),
+                            help=f"Comma-separated groups to run ({', '.join(GROUPS)})")
+        parser.add_argument('--resolutions', type=_list(_resolution), default=_list(_resolution)('320x240,640x480,1280x720,1920x1080'),
+                            help="Comma-separated WIDTHxHEIGHT frame sizes")
+        parser.add_argument('--images', help="Directory of sample face images (default: synthetic frames only)")
+        parser.add_argument('--gallery-sizes', type=_list(int), default=[1000, 10000, 100000],
+                            help="Comma-separated gallery sizes for exact search")
+        parser.add_argument('--algorithms', type=_list(str), default=list(SIGNATURE_ALGORITHMS),
+                            help="Comma-separated signature algorithms")
+        parser.add_argument('--repeat', type=int, default=20, help="Timed runs per benchmark")
+        parser.add_argument('--keygen-repeat', type=int, default=5, help="Timed key pair generations per algorithm")
+        parser.add_argument('--endpoint', default='default', help="FACE_DETECTOR_BACKENDS entry to benchmark")
+        parser.add_argument('--json', dest='json_path', help="Write the report to this JSON file")
+        parser.add_argument('--compare', help="Baseline JSON report to check for regressions")
+        parser.add_argument('--threshold', type=float, default=0.10,
+                            help="Median slowdown, as a fraction, that counts as a regression")
+        parser.add_argument('--floor-ms', type=float, default=0.05,
+                            help="Ignore slowdowns smaller than this many milliseconds")
+
+    def handle(self, *args, **options):
+        unknown = set(options['only']) - set(GROUPS)
+        if unknown:
+            raise CommandError(f"Unknown group(s): {', '.join(sorted(unknown))}. Choose from: {', '.join(GROUPS)}")
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        self.repeat = options['repeat']
+        self.report = {'environment': environment(), 'repeat': self.repeat, 'results': []}
+        if 'face' in options['only']:
+            self._face(options['resolutions'], options['images'], options['endpoint'])
+        if 'gallery' in options['only']:
+            self._gallery(options['gallery_sizes'])
+        if 'crypto' in options['only']:
+            self._crypto(options['algorithms'], options['keygen_repeat'])
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(self.report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
+
+        if baseline is not None:
+            self._compare(baseline, options['threshold'], options['floor_ms'])
+
+    def _record(self, name, group, params, summary):
+        result = {'name': name, 'group': group, 'params': params, **summary}
+        self.report['results'].append(result)
+        self.stdout.write(f"{name:>44}  median={summary['median_ms']:>10.3f}ms  "
+                          f"p95={summary['p95_ms']:>10.3f}ms  min={summary['min_ms']:>10.3f}ms")
+
+    def _samples(self, directory):
+        """``(label, RGB array)`` pairs: the sample images if given, else one synthetic frame"""
+        if not directory:
+            return [('synthetic', None)]
+        samples = []
+        for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+            name, extension = os.path.splitext(entry.name)
+            if entry.is_file() and extension.lower() in IMAGE_EXTENSIONS:
+                samples.append((name, face_recognition.load_image_file(entry.path)))
+        if not samples:
+            raise CommandError(f"No images found in {directory}.")
+        return samples
+
+    def _face(self, resolutions, directory, endpoint):
+        # Load the detector and encoder models outside the timed runs
+        face_recognition.face_encodings(np.zeros((64, 64, 3), dtype=np.uint8), [(0, 64, 64, 0)])
+        for label, sample in self._samples(directory):
+            for width, height in resolutions:
+                image = synthetic_image(width, height) if sample is None else fit(sample, width, height)
+                jpeg = to_jpeg(image)
+                decoded = decode_image_bytes(jpeg)
+                params = {'image': label, 'width': width, 'height': height, 'jpeg_bytes': len(jpeg),
+                          'decoded': f"{decoded.shape[1]}x{decoded.shape[0]}"}
+                suffix = f"[{label} {width}x{height}]"
+
+                self._record(f"decode{suffix}", 'face', params, measure(lambda: decode_image_bytes(jpeg), self.repeat))
+                self._record(f"detect{suffix}", 'face', params,
+                             measure(lambda: detect_faces(decoded, endpoint=endpoint), self.repeat))
+
+                # Encode the detected face, or a centred box when the frame has none
+                boxes = detect_faces(decoded, endpoint=endpoint)
+                side = min(decoded.shape[:2]) // 2
+                top, left = (decoded.shape[0] - side) // 2, (decoded.shape[1] - side) // 2
+                box = boxes[0] if boxes else (top, left + side, top + side, left)
+                self._record(f"encode{suffix}", 'face', {**params, 'face_found': bool(boxes)},
+                             measure(lambda: face_recognition.face_encodings(decoded, [box]), self.repeat))
+
+                # End to end, with the per-stage split from the pipeline's own spans
+                known = face_recognition.face_encodings(decoded, [box])[0]
+                for name, func in (
+                    ('process_face_image', lambda: process_face_image(decoded, endpoint)),
+                    ('compare_faces', lambda: compare_faces(known, decoded, endpoint=endpoint)),
+                ):
+                    stages = {}
+                    def run():
+                        with timing.collect() as spans:
+                            func()
+                        for stage, seconds in spans.items():
+                            stages.setdefault(stage, []).append(seconds * 1000)
+                    summary = measure(run, self.repeat, warmup=0)
+                    summary['stages'] = {stage: _summary(samples) for stage, samples in stages.items()}
+                    self._record(f"{name}{suffix}", 'face', {**params, 'face_found': bool(boxes)}, summary)
+
+    def _gallery(self, sizes):
+        for size in sizes:
+            vectors, probes = synthetic_encodings(size, min(self.repeat, size))
+            gallery = FaceGallery(capacity=size)
+            gallery.load(enumerate(vectors))
+            queries = iter(np.resize(probes, (self.repeat + 1, probes.shape[1])))
+            self._record(f"gallery_search[{size}]", 'gallery', {'size': size},
+                         measure(lambda: gallery.search(next(queries), exact=True), self.repeat))
+            self._record(f"face_distance[{size}]", 'gallery', {'size': size},
+                         measure(lambda: face_recognition.face_distance(vectors, probes[0]), self.repeat))
+
+    def _crypto(self, algorithms, keygen_repeat):
+        message = '5f0c2b0e-8a57-4a5c-9c43-0c1d7f6a2b1e'
+        for algorithm in algorithms:
+            if algorithm not in SIGNATURE_ALGORITHMS:
+                raise CommandError(f"Unknown signature algorithm '{algorithm}'. Choose from: {', '.join(SIGNATURE_ALGORITHMS)}")
+            params = {'algorithm': algorithm}
+            self._record(f"generate_key_pair[{algorithm}]", 'crypto', params,
+                         measure(lambda: generate_key_pair(algorithm), keygen_repeat))
+            public_pem, private_pem = generate_key_pair(algorithm)
+            signature = sign_data(private_pem, message, algorithm)
+            self._record(f"sign_data[{algorithm}]", 'crypto', params,
+                         measure(lambda: sign_data(private_pem, message, algorithm), self.repeat))
+            self._record(f"verify_signature[{algorithm}]", 'crypto', params,
+                         measure(lambda: verify_signature(public_pem, message, signature, algorithm), self.repeat))
+
+    def _compare(self, baseline, threshold, floor_ms):
+        rows, regressions = compare_reports(self.report, baseline, threshold, floor_ms)
+        commit = baseline.get('environment', {}).get('git_commit')
+        self.stdout.write(f"\nAgainst baseline {commit or 'report'} (threshold +{threshold:.0%}):")
+        for row in rows:
+            line = (f"{row['name']:>44}  {row['baseline_ms']:>10.3f}ms -> {row['current_ms']:>10.3f}ms  "
+                    f"{row['change']:>+8.1%}")
+            self.stdout.write(self.style.ERROR(f"{line}  REGRESSION") if row['regressed'] else line)
+        if regressions:
+            raise CommandError(f"{len(regressions)} of {len(rows)} benchmarks regressed by more than {threshold:.0%}")
+        self.stdout.write(self.style.SUCCESS(f"No regressions in {len(rows)} benchmarks"))
@@ -0,0 +1,76 @@
+import base64
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from cryptography.hazmat.primitives import serialization
+
+from authentication.crypto_utils import SIGNATURE_ALGORITHMS, generate_key_pair, get_algorithm, load_private_key, load_public_key
+
+
+def _rate(func, iterations):
+    """Run ``func`` ``iterations`` times; return operations per second"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = time.perf_counter() - started
+    return round(iterations / elapsed, 1) if elapsed else float('inf')
+
+
+class Command(BaseCommand):
+    help = "Compare key generation, signing and verification speed of the login signature algorithms"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--algorithms', default=','.join(SIGNATURE_ALGORITHMS),
+                            help="Comma-separated algorithms to compare")
+        parser.add_argument('--iterations', type=int, default=500, help="Sign/verify operations per measurement")
+        parser.add_argument('--keygen', type=int, default=5, help="Key pairs generated per algorithm")
+        parser.add_argument('--json', dest='json_path', help="Also write results to this JSON file")
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        message = b'5f0c2b0e-8a57-4a5c-9c43-0c1d7f6a2b1e'
+        report = {'iterations': iterations, 'algorithms': []}
+
+        self.stdout.write(f"{'algorithm':>14}  {'keygen':>10}  {'sign/s':>9}  {'sign/s (parse)':>14}  "
+                          f"{'verify/s':>9}  {'verify/s (parse)':>16}  {'sig bytes':>9}")
+        for name in [n.strip() for n in options['algorithms'].split(',') if n.strip()]:
+            algorithm = get_algorithm(name)
+
+            started = time.perf_counter()
+            for _ in range(options['keygen']):
+                public_pem, private_pem = generate_key_pair(name)
+            keygen_ms = (time.perf_counter() - started) * 1000 / options['keygen']
+
+            private_key = load_private_key(private_pem)
+            public_key = load_public_key(public_pem)
+            signature = algorithm.sign(private_key, message)
+
+            def sign_parsing():
+                key = serialization.load_pem_private_key(private_pem.encode('utf-8'), password=None)
+                algorithm.sign(key, message)
+
+            def verify_parsing():
+                key = serialization.load_pem_public_key(public_pem.encode('utf-8'))
+                algorithm.verify(key, signature, message)
+
+            result = {
+                'algorithm': name,
+                'keygen_ms': round(keygen_ms, 3),
+                # Cached: what sign_data/verify_signature do after the first call for a user
+                'sign_per_second': _rate(lambda: algorithm.sign(load_private_key(private_pem), message), iterations),
+                'sign_per_second_parsing': _rate(sign_parsing, iterations),
+                'verify_per_second': _rate(lambda: algorithm.verify(load_public_key(public_pem), signature, message), iterations),
+                'verify_per_second_parsing': _rate(verify_parsing, iterations),
+                'signature_bytes': len(signature),
+                'signature_base64_chars': len(base64.b64encode(signature)),
+            }
+            report['algorithms'].append(result)
+            self.stdout.write(f"{name:>14}  {keygen_ms:>8.2f}ms  {result['sign_per_second']:>9}  "
+                              f"{result['sign_per_second_parsing']:>14}  {result['verify_per_second']:>9}  "
+                              f"{result['verify_per_second_parsing']:>16}  {len(signature):>9}")
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
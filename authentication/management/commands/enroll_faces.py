@@ -0,0 +1,232 @@
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from authentication import encoding_cache
+from authentication.crypto_utils import preferred_algorithm
+from authentication.face_pool import _init_worker
+from authentication.gallery import update_user_encoding
+from authentication.models import FaceTemplate, UserProfile
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+
+
+def iter_entries(source):
+    """Yield ``{'key', 'username', 'email', 'image'}`` dicts from a directory or CSV manifest
+
+    A directory enrolls ``<username>.<ext>`` image files; a manifest has
+    ``username``, ``image`` and optional ``email`` columns, with image paths
+    relative to the manifest.
+    """
+    if os.path.isdir(source):
+        with os.scandir(source) as entries:
+            for entry in entries:
+                username, extension = os.path.splitext(entry.name)
+                if entry.is_file() and extension.lower() in IMAGE_EXTENSIONS:
+                    yield {'key': entry.path, 'username': username, 'email': '', 'image': entry.path}
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, newline='') as f:
+        for row in csv.DictReader(f):
+            image = os.path.join(base_dir, row['image'])
+            yield {'key': image, 'username': row['username'].strip(),
+                   'email': (row.get('email') or '').strip(), 'image': image}
+
+
+def read_checkpoint(path):
+    """Return the keys recorded in a checkpoint, one JSON string per line
+
+    A line cut short by a crash mid-write is ignored, so that image is
+    processed again, and is ended so the next batch starts on a line of its own.
+    """
+    done = set()
+    with open(path, 'a+') as f:
+        f.seek(0)
+        line = ''
+        for line in f:
+            try:
+                done.add(json.loads(line))
+            except ValueError:
+                continue
+        if line and not line.endswith('\n'):
+            f.write('\n')
+    return done
+
+
+def encode_entry(entry, with_keys=True):
+    """Worker: encode one image (and generate a key pair); never raises"""
+    from authentication.crypto_utils import generate_key_pair
+    from authentication.face_utils import decode_image_bytes, process_face_image
+
+    try:
+        with open(entry['image'], 'rb') as f:
+            image = decode_image_bytes(f.read())
+        encoding_bytes, error = process_face_image(image, endpoint='enroll')
+        if error:
+            return entry, None, None, error
+        keys = generate_key_pair() if with_keys else None
+        return entry, encoding_bytes, keys, None
+    except Exception as e:
+        return entry, None, None, f"Error processing face image: {str(e)}"
+
+
+def _encode_with_keys(entry):
+    return encode_entry(entry, with_keys=True)
+
+
+def _encode_without_keys(entry):
+    return encode_entry(entry, with_keys=False)
+
+
+class Command(BaseCommand):
+    help = "Enroll faces for many users at once from a directory of images or a CSV manifest"
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help="Directory of <username>.<ext> images, or a CSV with username,email,image")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Encoding processes (0 = encode in this process)")
+        parser.add_argument('--batch-size', type=int, default=200, help="Users written per transaction")
+        parser.add_argument('--checkpoint', help="Progress file (default: <source>.checkpoint.jsonl)")
+        parser.add_argument('--report', help="CSV of images that failed (default: <source>.failures.csv)")
+        parser.add_argument('--restart', action='store_true', help="Ignore an existing checkpoint and start over")
+        parser.add_argument('--no-keys', action='store_true', help="Do not generate signing key pairs")
+        parser.add_argument('--update-existing', action='store_true',
+                            help="Replace the face of users that already exist (default: skip them)")
+
+    def handle(self, *args, **options):
+        source = options['source'].rstrip(os.sep)
+        if not os.path.exists(source):
+            raise CommandError(f"{source} does not exist.")
+        self.checkpoint_path = options['checkpoint'] or f"{source}.checkpoint.jsonl"
+        report_path = options['report'] or f"{source}.failures.csv"
+        self.update_existing = options['update_existing']
+        self.with_keys = not options['no_keys']
+
+        done = set()
+        if options['restart']:
+            for path in (self.checkpoint_path, report_path):
+                if os.path.exists(path):
+                    os.unlink(path)
+        elif os.path.exists(self.checkpoint_path):
+            done = read_checkpoint(self.checkpoint_path)
+            self.stdout.write(f"Resuming: {len(done)} images already processed")
+        self.done = done
+
+        pending = (entry for entry in iter_entries(source) if entry['key'] not in done)
+        worker = _encode_with_keys if self.with_keys else _encode_without_keys
+        self.counts = {'enrolled': 0, 'failed': 0, 'skipped': 0}
+        started = time.perf_counter()
+
+        write_header = not os.path.exists(report_path)
+        with open(report_path, 'a', newline='') as report_file, open(self.checkpoint_path, 'a') as checkpoint_file:
+            self.report = csv.writer(report_file)
+            if write_header:
+                self.report.writerow(['image', 'username', 'error'])
+
+            batch = []
+            for result in self._encode(worker, pending, options['workers']):
+                batch.append(result)
+                if len(batch) >= options['batch_size']:
+                    self._write_batch(batch, report_file, checkpoint_file)
+                    batch = []
+            if batch:
+                self._write_batch(batch, report_file, checkpoint_file)
+
+        elapsed = time.perf_counter() - started
+        processed = sum(self.counts.values())
+        rate = processed / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Enrolled {self.counts['enrolled']}, skipped {self.counts['skipped']} existing, "
+            f"failed {self.counts['failed']} (see {report_path}) in {elapsed:.1f}s ({rate:.1f} images/s)"
+        ))
+
+    def _encode(self, worker, entries, workers):
+        """Yield encoded results from a pool of spawned processes, or inline with no workers"""
+        if workers <= 0:
+            yield from map(worker, entries)
+            return
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers, initializer=_init_worker) as pool:
+            yield from pool.imap_unordered(worker, entries, chunksize=4)
+
+    def _write_batch(self, batch, report_file, checkpoint_file):
+        """Persist one batch of results, then record it in the checkpoint"""
+        succeeded = {}
+        for entry, encoding_bytes, keys, error in batch:
+            if error:
+                self.report.writerow([entry['image'], entry['username'], error])
+                self.counts['failed'] += 1
+            elif entry['username'] in succeeded:
+                self.report.writerow([entry['image'], entry['username'], "Duplicate username in input"])
+                self.counts['failed'] += 1
+            else:
+                succeeded[entry['username']] = (entry, encoding_bytes, keys)
+
+        written = []
+        with transaction.atomic():
+            existing = set(User.objects.filter(username__in=succeeded).values_list('username', flat=True))
+            if not self.update_existing:
+                for username in existing:
+                    self.counts['skipped'] += 1
+                    succeeded.pop(username)
+                existing = set()
+
+            new_users = []
+            for username, (entry, _, _) in succeeded.items():
+                if username not in existing:
+                    user = User(username=username, email=entry['email'])
+                    user.set_unusable_password()
+                    new_users.append(user)
+            # bulk_create skips post_save, so profiles are created alongside
+            User.objects.bulk_create(new_users, batch_size=500)
+            user_ids = dict(User.objects.filter(username__in=succeeded).values_list('username', 'id'))
+            UserProfile.objects.bulk_create(
+                [UserProfile(user_id=user_ids[user.username]) for user in new_users],
+                batch_size=500,
+            )
+
+            profiles = list(UserProfile.objects.filter(user_id__in=user_ids.values())
+                            .defer(*UserProfile.HEAVY_FIELDS).select_related('user'))
+            algorithm = preferred_algorithm()
+            for profile in profiles:
+                _, encoding_bytes, keys = succeeded[profile.user.username]
+                profile.face_encoding = encoding_bytes
+                if keys:
+                    profile.public_key, profile.private_key = keys
+                    profile.key_algorithm = algorithm
+                written.append((profile.user_id, encoding_bytes))
+            update_fields = ['face_encoding', 'public_key', 'private_key', 'key_algorithm'] if self.with_keys else ['face_encoding']
+            # bulk_update bypasses save(), which keeps the flag columns in step
+            flag_fields = set()
+            for profile in profiles:
+                flag_fields.update(profile.sync_metadata(update_fields))
+            UserProfile.objects.bulk_update(profiles, update_fields + sorted(flag_fields), batch_size=500)
+            # The enrolled image becomes each user's only template, and so also their mean
+            FaceTemplate.objects.filter(user_id__in=user_ids.values()).delete()
+            FaceTemplate.objects.bulk_create(
+                [FaceTemplate(user_id=user_id, encoding=encoding_bytes, source='enrollment')
+                 for user_id, encoding_bytes in written],
+                batch_size=500,
+            )
+
+        # bulk_update skips post_save too: feed the shared gallery file and cache directly
+        for user_id, encoding_bytes in written:
+            update_user_encoding(user_id, encoding_bytes)
+            encoding_cache.invalidate(user_id)
+        self.counts['enrolled'] += len(written)
+
+        report_file.flush()
+        # Append only this batch's keys: rewriting every key per batch would be quadratic
+        keys = [entry['key'] for entry, _, _, _ in batch]
+        checkpoint_file.writelines(json.dumps(key) + '\n' for key in keys)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+        self.done.update(keys)
+        self.stdout.write(f"  {len(self.done)} images processed")
@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from authentication.crypto_utils import SIGNATURE_ALGORITHMS, generate_key_pair, preferred_algorithm
+from authentication.key_pool import pool_size, store_key_pairs
+
+
+def _generate(algorithm):
+    return generate_key_pair(algorithm)
+
+
+class Command(BaseCommand):
+    help = "Top up the pool of pre-generated key pairs handed out at registration"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', type=int, default=None,
+                            help="Pairs to keep in the pool (default: KEY_POOL_TARGET)")
+        parser.add_argument('--algorithm', choices=sorted(SIGNATURE_ALGORITHMS), default=None,
+                            help="Signature algorithm of the pairs (default: SIGNATURE_ALGORITHM)")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--batch-size', type=int, default=50, help="Pairs written per insert")
+        parser.add_argument('--watch', action='store_true',
+                            help="Keep running, refilling whenever the pool drops below KEY_POOL_LOW_WATER")
+        parser.add_argument('--interval', type=float, default=5.0, help="Seconds between checks with --watch")
+
+    def handle(self, *args, **options):
+        target = options['target'] or getattr(settings, 'KEY_POOL_TARGET', 100)
+        low_water = getattr(settings, 'KEY_POOL_LOW_WATER', 20)
+        self.algorithm = options['algorithm'] or preferred_algorithm()
+
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(options['workers'], initializer=django.setup) as pool:
+            self._fill(pool, target, options['batch_size'])
+            while options['watch']:
+                time.sleep(options['interval'])
+                if pool_size(self.algorithm) < low_water:
+                    self._fill(pool, target, options['batch_size'])
+
+    def _fill(self, pool, target, batch_size):
+        missing = target - pool_size(self.algorithm)
+        if missing <= 0:
+            self.stdout.write(f"Key pool already holds {target} or more {self.algorithm} pairs")
+            return
+
+        started = time.perf_counter()
+        added, batch = 0, []
+        for pair in pool.imap_unordered(_generate, [self.algorithm] * missing):
+            batch.append(pair)
+            if len(batch) >= batch_size:
+                added += store_key_pairs(batch, self.algorithm)
+                batch = []
+        if batch:
+            added += store_key_pairs(batch, self.algorithm)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Added {added} {self.algorithm} key pairs in {elapsed:.1f}s ({added / elapsed if elapsed else 0:.1f}/s); "
+            f"pool now holds {pool_size(self.algorithm)}"
+        ))
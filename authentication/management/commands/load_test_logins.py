@@ -0,0 +1,389 @@
+import base64
+import http.cookiejar
+import json
+import random
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from authentication.crypto_utils import generate_key_pair, preferred_algorithm
+from authentication.encoding_format import pack_encoding
+from authentication.face_utils import extract_face_encoding
+from authentication.log_writer import get_writer
+from authentication.management.commands.benchmark_hot_paths import synthetic_image
+from authentication.models import UserProfile
+
+PASSWORD = 'load-test-password'
+
+# name: (endpoint, which users it targets, whether the server should accept it)
+SCENARIOS = {
+    'login_good': ('login', 'genuine', True),
+    'login_bad_password': ('login', 'genuine', False),
+    'login_bad_face': ('login', 'impostor', False),
+    'verify_good': ('verify', 'genuine', True),
+    'verify_bad_face': ('verify', 'impostor', False),
+}
+
+
+def _resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def frame_data_url(image, width, height, quality=85):
+    """Resize an RGB frame and encode it the way the webcam page sends it"""
+    buffer = BytesIO()
+    Image.fromarray(image).resize((width, height), Image.BILINEAR).save(buffer, format='JPEG', quality=quality)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def client_ip(index):
+    """A distinct address per user, so the per-IP login limit applies as it would in production"""
+    return f"10.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255}"
+
+
+def parse_server_timing(header):
+    """``{stage: seconds}`` from a Server-Timing header"""
+    spans = {}
+    for entry in filter(None, (part.strip() for part in (header or '').split(','))):
+        name, _, params = entry.partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                spans[name.strip()] = float(value) / 1000
+    return spans
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    if not len(values):
+        return {}
+    return {
+        'count': len(values),
+        'p50_ms': round(float(np.percentile(values, 50)), 2),
+        'p90_ms': round(float(np.percentile(values, 90)), 2),
+        'p99_ms': round(float(np.percentile(values, 99)), 2),
+        'max_ms': round(float(values.max()), 2),
+    }
+
+
+class ClientTarget:
+    """Requests through Django's test client, inside this process
+
+    The command runs it with ``SERVER_TIMING_HEADER`` switched on, so stage
+    timings come back whatever the settings say.
+    """
+
+    def __init__(self):
+        self.login_url = reverse('authentication:login')
+        self.verify_url = reverse('authentication:verify_face')
+        # Outside the test runner "testserver" is not an allowed host
+        self.host = next((host for host in settings.ALLOWED_HOSTS if host not in ('', '*') and not host.startswith('.')),
+                         'localhost')
+
+    def _client(self, ip):
+        return Client(REMOTE_ADDR=ip, HTTP_HOST=self.host)
+
+    def login(self, fields, ip):
+        response = self._client(ip).post(self.login_url, fields, secure=True)
+        return response.status_code, response.get('Server-Timing', ''), response.content
+
+    def verify(self, payload, ip):
+        response = self._client(ip).post(self.verify_url, json.dumps(payload), content_type='application/json',
+                                         headers={'X-Requested-With': 'XMLHttpRequest'}, secure=True)
+        return response.status_code, response.get('Server-Timing', ''), response.content
+
+    def close(self):
+        close_old_connections()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPTarget:
+    """Requests to a server already running on this machine, e.g. ``runserver`` or gunicorn
+
+    Each user's address goes in X-Forwarded-For; run the server with
+    ``TRUSTED_PROXY_COUNT=1`` so it counts failures per user address rather
+    than all of them against 127.0.0.1. Stage timings are only reported when
+    the server also has ``SERVER_TIMING_HEADER=True``.
+    """
+
+    def __init__(self, base_url, insecure=False):
+        self.base_url = base_url.rstrip('/')
+        self.login_url = self.base_url + reverse('authentication:login')
+        self.verify_url = self.base_url + reverse('authentication:verify_face')
+        self.context = ssl._create_unverified_context() if insecure else None
+
+    def _opener(self):
+        jar = http.cookiejar.CookieJar()
+        opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(jar), urllib.request.HTTPSHandler(context=self.context), _NoRedirect,
+        )
+        # Fetch the login page first for the CSRF cookie; it is not part of the timed request
+        opener.open(self.login_url, timeout=60).read()
+        token = next((cookie.value for cookie in jar if cookie.name == 'csrftoken'), '')
+        return opener, token
+
+    def _send(self, opener, request):
+        try:
+            with opener.open(request, timeout=60) as response:
+                return response.status, response.headers.get('Server-Timing', ''), response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get('Server-Timing', ''), e.read()
+
+    def login(self, fields, ip):
+        opener, token = self._opener()
+        body = urllib.parse.urlencode({**fields, 'csrfmiddlewaretoken': token}).encode('ascii')
+        request = urllib.request.Request(self.login_url, body, headers={'X-Forwarded-For': ip, 'Referer': self.login_url})
+        return self._send(opener, request)
+
+    def verify(self, payload, ip):
+        opener, token = self._opener()
+        request = urllib.request.Request(self.verify_url, json.dumps(payload).encode('utf-8'), headers={
+            'Content-Type': 'application/json', 'X-Requested-With': 'XMLHttpRequest', 'X-CSRFToken': token,
+            'X-Forwarded-For': ip, 'Referer': self.login_url,
+        })
+        return self._send(opener, request)
+
+    def close(self):
+        pass
+
+
+def classify(endpoint, status, body):
+    """Name the outcome of one response"""
+    if status == 429:
+        return 'locked'
+    if status == 503:
+        return 'busy'
+    if status >= 500:
+        return 'server_error'
+    if status >= 400:
+        return 'bad_request'
+    if endpoint == 'login':
+        return 'accepted' if status == 302 else 'rejected'
+    try:
+        return 'accepted' if json.loads(body).get('success') else 'rejected'
+    except ValueError:
+        return 'server_error'
+
+
+class Command(BaseCommand):
+    help = "Seed synthetic users and drive concurrent login and face verification traffic; report throughput and latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help="Synthetic users to seed")
+        parser.add_argument('--requests', type=int, default=500, help="Requests to send in total")
+        parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight at once")
+        parser.add_argument('--image', help="Face photo the synthetic users are enrolled with "
+                                            "(without one, users have no face and logins are password-only)")
+        parser.add_argument('--frame-size', type=_resolution, default=(640, 480), help="WIDTHxHEIGHT of submitted frames")
+        parser.add_argument('--bad-ratio', type=float, default=0.2,
+                            help="Fraction of requests that should be refused (wrong password or wrong face)")
+        parser.add_argument('--verify-ratio', type=float, default=0.3,
+                            help="Fraction of requests sent to the face verification endpoint instead of login")
+        parser.add_argument('--url', help="Base URL of a running server (default: the in-process test client)")
+        parser.add_argument('--insecure', action='store_true', help="Do not verify the server's TLS certificate")
+        parser.add_argument('--prefix', default='loadtest-', help="Username prefix of the seeded users")
+        parser.add_argument('--keep-users', action='store_true', help="Leave the seeded users in the database")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', dest='json_path', help="Also write the report to this JSON file")
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError("--users must be at least 2.")
+        rng = random.Random(options['seed'])
+        width, height = options['frame_size']
+
+        if options['image']:
+            import face_recognition
+            photo = face_recognition.load_image_file(options['image'])
+            frame = frame_data_url(photo, width, height)
+            encoding, error = extract_face_encoding(np.asarray(Image.fromarray(photo).resize((width, height))))
+            if error:
+                raise CommandError(f"{options['image']}: {error}")
+        else:
+            self.stdout.write(self.style.WARNING("No --image: users are seeded without faces, so logins are "
+                                                 "password-only and face verification is not exercised"))
+            frame = frame_data_url(synthetic_image(width, height), width, height)
+            encoding = None
+
+        users = self._seed(options['users'], options['prefix'], encoding, rng)
+        try:
+            plan = self._plan(options['requests'], options['bad_ratio'], options['verify_ratio'], encoding is not None, rng)
+            if options['url']:
+                target = HTTPTarget(options['url'], options['insecure'])
+                report = self._run(target, plan, users, frame, options['concurrency'], rng)
+            else:
+                # Stage timings are read from the Server-Timing header, which is off by default
+                with override_settings(SERVER_TIMING_HEADER=True):
+                    report = self._run(ClientTarget(), plan, users, frame, options['concurrency'], rng)
+        finally:
+            if not options['keep_users']:
+                self._cleanup(options['prefix'])
+
+        report.update({'users': options['users'], 'frame_size': f"{width}x{height}",
+                       'target': options['url'] or 'test-client', 'concurrency': options['concurrency']})
+        self._print(report)
+        if options['url'] and not report['stages']:
+            self.stdout.write(self.style.WARNING("No response carried a Server-Timing header, so there is no stage "
+                                                 "breakdown; start the server with SERVER_TIMING_HEADER=True"))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
+
+    def _seed(self, count, prefix, encoding, rng):
+        """Create ``count`` users; a fifth are impostors whose stored face is someone else's"""
+        self._cleanup(prefix)
+        password = make_password(PASSWORD)
+        impostors = max(1, count // 5) if encoding is not None else 0
+        algorithm = preferred_algorithm()
+        noise = np.random.default_rng(rng.randrange(2 ** 32))
+
+        started = time.perf_counter()
+        with transaction.atomic():
+            User.objects.bulk_create(
+                [User(username=f"{prefix}{i}", password=password) for i in range(count)], batch_size=500,
+            )
+            ids = dict(User.objects.filter(username__startswith=prefix).values_list('username', 'id'))
+            profiles = []
+            for i in range(count):
+                profile = UserProfile(user_id=ids[f"{prefix}{i}"], key_algorithm=algorithm)
+                profile.public_key, profile.private_key = generate_key_pair(algorithm)
+                if encoding is not None:
+                    if i < impostors:
+                        # A different identity: dlib encodings of two people are ~0.9 apart
+                        stored = noise.normal(0.0, 0.056, size=128)
+                    else:
+                        # Another capture of the same person
+                        stored = encoding + noise.normal(0.0, 0.005, size=128)
+                    profile.face_encoding = pack_encoding(stored)
+                profile.sync_metadata()
+                profiles.append(profile)
+            # bulk_create skips post_save, so no profile is created twice
+            UserProfile.objects.bulk_create(profiles, batch_size=500)
+        self.stdout.write(f"Seeded {count} users ({impostors} impostors) in {time.perf_counter() - started:.1f}s")
+
+        users = {'genuine': [], 'impostor': []}
+        for i in range(count):
+            users['impostor' if i < impostors else 'genuine'].append((f"{prefix}{i}", client_ip(i)))
+        return users
+
+    def _plan(self, total, bad_ratio, verify_ratio, with_faces, rng):
+        weights = {
+            'login_good': (1 - bad_ratio) * (1 - verify_ratio),
+            'login_bad_password': bad_ratio * (1 - verify_ratio) / (2 if with_faces else 1),
+            'login_bad_face': bad_ratio * (1 - verify_ratio) / 2,
+            'verify_good': (1 - bad_ratio) * verify_ratio,
+            'verify_bad_face': bad_ratio * verify_ratio,
+        }
+        if not with_faces:
+            weights = {name: weight for name, weight in weights.items() if name in ('login_good', 'login_bad_password')}
+        names = [name for name, weight in weights.items() if weight > 0]
+        return rng.choices(names, weights=[weights[name] for name in names], k=total)
+
+    def _run(self, target, plan, users, frame, concurrency, rng):
+        # Pick users up front so worker threads share no random state
+        jobs = [(scenario, rng.choice(users[SCENARIOS[scenario][1]])) for scenario in plan]
+        results = []
+        results_lock = threading.Lock()
+
+        def send(job):
+            scenario, (username, ip) = job
+            endpoint, _, expected = SCENARIOS[scenario]
+            password = 'wrong-password' if scenario == 'login_bad_password' else PASSWORD
+            started = time.perf_counter()
+            try:
+                if endpoint == 'login':
+                    status, timing_header, body = target.login(
+                        {'username': username, 'password': password, 'face_data': frame}, ip)
+                else:
+                    status, timing_header, body = target.verify({'username': username, 'face_data': frame}, ip)
+                outcome = classify(endpoint, status, body)
+            except Exception as e:
+                status, timing_header, outcome = None, '', f"exception: {type(e).__name__}"
+            elapsed = time.perf_counter() - started
+            result = {'scenario': scenario, 'status': status, 'outcome': outcome, 'seconds': elapsed,
+                      'as_expected': outcome == ('accepted' if expected else 'rejected'),
+                      'spans': parse_server_timing(timing_header)}
+            with results_lock:
+                results.append(result)
+
+        self.stdout.write(f"Sending {len(jobs)} requests, {concurrency} at a time")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(lambda job: (send(job), target.close()), jobs))
+        wall = time.perf_counter() - started
+
+        report = {'requests': len(results), 'seconds': round(wall, 2),
+                  'throughput_per_second': round(len(results) / wall, 2) if wall else None,
+                  'latency': percentiles([r['seconds'] for r in results]),
+                  'scenarios': {}, 'stages': {}}
+        for scenario in SCENARIOS:
+            subset = [r for r in results if r['scenario'] == scenario]
+            if not subset:
+                continue
+            outcomes = {}
+            for r in subset:
+                outcomes[r['outcome']] = outcomes.get(r['outcome'], 0) + 1
+            unexpected = sum(1 for r in subset if not r['as_expected'])
+            report['scenarios'][scenario] = {
+                **percentiles([r['seconds'] for r in subset]),
+                'outcomes': outcomes,
+                'unexpected': unexpected,
+                'error_rate': round(unexpected / len(subset), 4),
+            }
+        stage_names = sorted({name for r in results for name in r['spans']})
+        for stage in stage_names:
+            report['stages'][stage] = percentiles([r['spans'][stage] for r in results if stage in r['spans']])
+        # Requests that got no verdict at all: rate limited, pool busy, errors
+        failures = {}
+        for r in results:
+            if r['outcome'] not in ('accepted', 'rejected'):
+                failures[r['outcome']] = failures.get(r['outcome'], 0) + 1
+        report['failures'] = failures
+        return report
+
+    def _cleanup(self, prefix):
+        # Let buffered login logs for these users land before the users go
+        get_writer().flush()
+        deleted, _ = User.objects.filter(username__startswith=prefix).delete()
+        return deleted
+
+    def _print(self, report):
+        self.stdout.write(f"\n{report['requests']} requests in {report['seconds']}s: "
+                          f"{report['throughput_per_second']} req/s, "
+                          f"p50={report['latency']['p50_ms']}ms p99={report['latency']['p99_ms']}ms")
+        self.stdout.write(f"\n{'scenario':>20}  {'count':>6}  {'p50':>9}  {'p90':>9}  {'p99':>9}  {'errors':>7}  outcomes")
+        for scenario, row in report['scenarios'].items():
+            outcomes = ', '.join(f"{name}={count}" for name, count in sorted(row['outcomes'].items()))
+            line = (f"{scenario:>20}  {row['count']:>6}  {row['p50_ms']:>7.1f}ms  {row['p90_ms']:>7.1f}ms  "
+                    f"{row['p99_ms']:>7.1f}ms  {row['error_rate']:>7.1%}  {outcomes}")
+            self.stdout.write(self.style.ERROR(line) if row['unexpected'] else line)
+        if report['stages']:
+            self.stdout.write(f"\n{'stage':>20}  {'count':>6}  {'p50':>9}  {'p90':>9}  {'p99':>9}")
+            for stage, row in report['stages'].items():
+                self.stdout.write(f"{stage:>20}  {row['count']:>6}  {row['p50_ms']:>7.1f}ms  "
+                                  f"{row['p90_ms']:>7.1f}ms  {row['p99_ms']:>7.1f}ms")
+        if report['failures']:
+            self.stdout.write(self.style.WARNING(
+                "Failed responses: " + ', '.join(f"{name}={count}" for name, count in sorted(report['failures'].items()))
+            ))
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from authentication.retention import expired_signatures, old_login_logs, purge_in_chunks
+
+
+class Command(BaseCommand):
+    help = "Delete expired login challenges and login logs past their retention period, in small chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only count the rows that would be deleted")
+        parser.add_argument('--chunk-size', type=int, default=getattr(settings, 'RETENTION_CHUNK_SIZE', 1000),
+                            help="Rows deleted per transaction")
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help="Seconds to sleep between chunks, to leave room for other writers")
+        parser.add_argument('--log-days', type=int, default=getattr(settings, 'LOGIN_LOG_RETENTION_DAYS', 90),
+                            help="Keep login logs for this many days")
+        parser.add_argument('--only', choices=['signatures', 'logs'], help="Purge just one kind of record")
+
+    def handle(self, *args, **options):
+        targets = []
+        if options['only'] in (None, 'signatures'):
+            targets.append(('expired signatures', expired_signatures()))
+        if options['only'] in (None, 'logs'):
+            targets.append((f"login logs older than {options['log_days']} days", old_login_logs(days=options['log_days'])))
+
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        for label, queryset in targets:
+            rows, seconds = purge_in_chunks(
+                queryset,
+                chunk_size=options['chunk_size'],
+                pause=options['pause'],
+                dry_run=options['dry_run'],
+                progress=self._progress if options['verbosity'] > 1 else None,
+            )
+            rate = rows / seconds if seconds and not options['dry_run'] else 0
+            throughput = f" in {seconds:.1f}s ({rate:.0f} rows/s)" if not options['dry_run'] else ""
+            self.stdout.write(self.style.SUCCESS(f"{verb} {rows} {label}{throughput}"))
+
+    def _progress(self, total):
+        self.stdout.write(f"  {total} rows deleted")
@@ -0,0 +1,35 @@
+import glob
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.gallery import iter_enrolled_encodings
+from authentication.gallery_store import get_gallery_file
+
+
+class Command(BaseCommand):
+    help = "Rewrite the memory-mapped face gallery file from the database (or compact it in place)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compact-only', action='store_true',
+                            help="Drop superseded records from the existing file without reading the database")
+        parser.add_argument('--remove-legacy-files', action='store_true',
+                            help="Delete the old per-user user_*_face_encoding.pkl files from FACE_DATA_DIR")
+
+    def handle(self, *args, **options):
+        store = get_gallery_file()
+        if store is None:
+            raise CommandError("FACE_GALLERY_FILE is not configured.")
+
+        if options['compact_only']:
+            count = store.compact()
+        else:
+            count = store.compact(iter_enrolled_encodings())
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} encodings to {store.path}"))
+
+        if options['remove_legacy_files']:
+            legacy = glob.glob(os.path.join(settings.FACE_DATA_DIR, 'user_*_face_encoding.pkl'))
+            for path in legacy:
+                os.unlink(path)
+            self.stdout.write(f"Removed {len(legacy)} legacy encoding files")
@@ -0,0 +1,48 @@
+import os
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.ann import IVFIndex
+from authentication.gallery import iter_enrolled_encodings, get_index_path
+
+
+class Command(BaseCommand):
+    help = "Train the approximate nearest-neighbour index over all enrolled face encodings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nlist', type=int, default=getattr(settings, 'FACE_ANN_NLIST', 1024),
+                            help="Number of k-means cells (default: FACE_ANN_NLIST)")
+        parser.add_argument('--pq-m', type=int, default=getattr(settings, 'FACE_ANN_PQ_M', 0),
+                            help="PQ sub-quantizers; 0 stores raw vectors (default: FACE_ANN_PQ_M)")
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None, help="Index file (default: FACE_ANN_INDEX_PATH)")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        encodings = [encoding for _, encoding in iter_enrolled_encodings()]
+        if not encodings:
+            raise CommandError("No enrolled face encodings to index.")
+        vectors = np.asarray(encodings, dtype=np.float32)
+
+        nlist = min(options['nlist'], len(vectors))
+        self.stdout.write(f"Training IVF index: {len(vectors)} encodings, nlist={nlist}, pq_m={options['pq_m']}")
+        try:
+            index = IVFIndex.train(vectors, nlist, pq_m=options['pq_m'],
+                                   iterations=options['iterations'], seed=options['seed'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        # Write then rename so workers never read a half-written file
+        path = options['output'] or get_index_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        index.save(temp_path)
+        os.replace(temp_path, path)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Wrote {path} in {elapsed:.1f}s; "
+                                             "workers pick it up on their next gallery reload."))
@@ -0,0 +1,188 @@
+import logging
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth import logout
+from django.shortcuts import redirect
+
+from . import metrics, profiling, timing
+from .crypto_utils import CHALLENGE_SESSION_KEY, verify_signed_challenge
+
+logger = logging.getLogger(__name__)
+
+request_seconds = metrics.histogram('http_request_duration_seconds', "Time to produce a response, by view")
+responses = metrics.counter('http_responses', "Responses sent, by view and status class")
+
+
+class ServerTimingMiddleware:
+    """Time each request, aggregate it per view and report its stages in a Server-Timing header
+
+    Place it first in MIDDLEWARE so the total covers the other middleware too.
+    The header is only sent with ``SERVER_TIMING_HEADER = True`` (by default
+    only under DEBUG); the histograms are kept either way.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.header = getattr(settings, 'SERVER_TIMING_HEADER', settings.DEBUG)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+        with timing.collect() as spans:
+            started = time.perf_counter()
+            response = self.get_response(request)
+            return self._finish(request, response, spans, time.perf_counter() - started)
+
+    async def _acall(self, request):
+        with timing.collect() as spans:
+            started = time.perf_counter()
+            response = await self.get_response(request)
+            return self._finish(request, response, spans, time.perf_counter() - started)
+
+    def _finish(self, request, response, spans, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        request_seconds.observe(elapsed, view=view)
+        responses.inc(view=view, status=f"{response.status_code // 100}xx")
+        if self.header:
+            entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in spans.items()]
+            entries.append(f"total;dur={elapsed * 1000:.1f}")
+            response['Server-Timing'] = ', '.join(entries)
+        return response
+
+
+class ProfilingMiddleware:
+    """Profile the rest of the middleware stack and the view when a request is triggered
+
+    See ``authentication.profiling`` for the triggers and where profiles go.
+    Place it right after ServerTimingMiddleware so the stage timings reach the
+    profile's metadata.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.header = 'HTTP_' + getattr(settings, 'PROFILING_HEADER', 'X-Profile-Request').upper().replace('-', '_')
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+        self.poll_seconds = getattr(settings, 'PROFILING_TOGGLE_POLL_SECONDS', 5)
+        self._toggle = None
+        self._toggle_checked = float('-inf')
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _current_toggle(self):
+        # Read the shared toggle at most every poll_seconds, not on every request
+        now = time.monotonic()
+        if now - self._toggle_checked >= self.poll_seconds:
+            self._toggle_checked = now
+            try:
+                self._toggle = profiling.get_toggle()
+            except Exception as e:
+                logger.warning(f"Reading the profiling toggle failed: {str(e)}")
+                self._toggle = None
+        return self._toggle
+
+    def _trigger(self, request):
+        """Why this request should be profiled, or None"""
+        token = request.META.get(self.header)
+        if token and profiling.is_trigger_token(token):
+            return 'header'
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sample'
+        toggle = self._current_toggle()
+        if toggle and toggle['until'] > time.time():
+            if not toggle['username'] or toggle['username'] == profiling.request_username(request):
+                return 'toggle'
+        return None
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+        trigger = self._trigger(request)
+        if trigger is None:
+            return self.get_response(request)
+        session = profiling.start()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            session.stop()
+        session.save(request, response, trigger, time.perf_counter() - started)
+        return response
+
+    async def _acall(self, request):
+        trigger = self._trigger(request)
+        if trigger is None:
+            return await self.get_response(request)
+        session = profiling.start()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            session.stop()
+        session.save(request, response, trigger, time.perf_counter() - started)
+        return response
+
+
+class LoginChallengeMiddleware:
+    """Verify the signed login challenge on the first request after a stateless login
+
+    The login stores a challenge signed with the user's private key in the
+    session. The next request checks it against the public key, owner and
+    expiry and consumes its nonce; if that fails (tampered, expired or
+    replayed challenge, or keys replaced since) the session is ended.
+    Place it after AuthenticationMiddleware and MessageMiddleware.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+        return self._check(request) or self.get_response(request)
+
+    async def _acall(self, request):
+        return await sync_to_async(self._check)(request) or await self.get_response(request)
+
+    def _check(self, request):
+        """Return a response ending the session if its challenge does not verify, else None"""
+        challenge = request.session.pop(CHALLENGE_SESSION_KEY, None)
+        if challenge is None or not request.user.is_authenticated:
+            return None
+        from .log_writer import record_login
+        from .models import UserProfile
+        from .views import get_client_ip
+
+        user = request.user
+        profile = UserProfile.objects.only('user_id', 'public_key', 'key_algorithm').filter(user_id=user.pk).first()
+        if profile is not None and verify_signed_challenge(profile, challenge):
+            return None
+
+        logger.warning(f"Login challenge for user {user.username} did not verify; ending the session")
+        record_login(
+            user_id=user.pk,
+            successful=False,
+            ip_address=get_client_ip(request),
+            user_agent=request.META.get('HTTP_USER_AGENT', ''),
+            signature_verified=False
+        )
+        logout(request)
+        messages.error(request, "Your login could not be verified. Please log in again.")
+        return redirect('authentication:login')
@@ -0,0 +1,53 @@
+import pickle
+
+import numpy as np
+from django.db import migrations
+
+from authentication.encoding_format import is_packed_encoding, pack_encoding, unpack_encoding
+
+
+def _encoding_batches(UserProfile, batch_size=500):
+    """Yield ``(pk, face_encoding)`` rows in primary-key order, one batch at a time"""
+    last_pk = 0
+    while True:
+        batch = list(UserProfile.objects
+                     .filter(pk__gt=last_pk, face_encoding__isnull=False)
+                     .order_by('pk')
+                     .values_list('pk', 'face_encoding')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1][0]
+
+
+def pack_encodings(apps, schema_editor):
+    """Convert pickled numpy encodings to the versioned float32 format"""
+    UserProfile = apps.get_model('authentication', 'UserProfile')
+    for batch in _encoding_batches(UserProfile):
+        for pk, encoding_bytes in batch:
+            if not encoding_bytes or is_packed_encoding(encoding_bytes):
+                continue
+            # Legacy rows were written by this app, so unpickling them here is trusted
+            encoding = pickle.loads(bytes(encoding_bytes))
+            UserProfile.objects.filter(pk=pk).update(face_encoding=pack_encoding(encoding))
+
+
+def unpack_encodings(apps, schema_editor):
+    UserProfile = apps.get_model('authentication', 'UserProfile')
+    for batch in _encoding_batches(UserProfile):
+        for pk, encoding_bytes in batch:
+            if not encoding_bytes or not is_packed_encoding(encoding_bytes):
+                continue
+            encoding = np.array(unpack_encoding(bytes(encoding_bytes)), dtype=np.float64)
+            UserProfile.objects.filter(pk=pk).update(face_encoding=pickle.dumps(encoding))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(pack_encodings, unpack_encodings),
+    ]
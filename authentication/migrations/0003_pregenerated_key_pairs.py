@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0002_pack_face_encodings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PregeneratedKeyPair',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('public_key', models.TextField()),
+                ('private_key', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='digitalsignature',
+            name='signature',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0003_pregenerated_key_pairs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pregeneratedkeypair',
+            name='algorithm',
+            field=models.CharField(choices=[('rsa-pkcs1v15', 'RSA-2048 PKCS#1 v1.5'), ('ed25519', 'Ed25519'), ('ecdsa-p256', 'ECDSA P-256')], default='rsa-pkcs1v15', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='key_algorithm',
+            field=models.CharField(choices=[('rsa-pkcs1v15', 'RSA-2048 PKCS#1 v1.5'), ('ed25519', 'Ed25519'), ('ecdsa-p256', 'ECDSA P-256')], default='rsa-pkcs1v15', max_length=20),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0004_key_algorithms'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='digitalsignature',
+            index=models.Index(fields=['expires_at', 'used'], name='signature_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loginlog',
+            index=models.Index(fields=['user', '-timestamp'], name='loginlog_user_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loginlog',
+            index=models.Index(fields=['timestamp'], name='loginlog_timestamp_idx'),
+        ),
+    ]
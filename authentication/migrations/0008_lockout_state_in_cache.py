@@ -0,0 +1,25 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:08
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0007_login_stats'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='is_locked',
+        ),
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='last_failed_login',
+        ),
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='login_attempts',
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:12
+
+from django.db import migrations, models
+
+
+def fill_flags(apps, schema_editor):
+    """Derive the flags in the database, without reading the blobs into Python"""
+    UserProfile = apps.get_model('authentication', 'UserProfile')
+    (UserProfile.objects
+     .filter(face_encoding__isnull=False).exclude(face_encoding=b'')
+     .update(has_face_data=True, encoding_version=1))
+    (UserProfile.objects
+     .filter(public_key__isnull=False, private_key__isnull=False)
+     .exclude(public_key='').exclude(private_key='')
+     .update(has_keys=True))
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0008_lockout_state_in_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='encoding_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='has_face_data',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='has_keys',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(fill_flags, migrations.RunPython.noop),
+    ]
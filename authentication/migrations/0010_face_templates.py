@@ -0,0 +1,48 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:30
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def seed_templates(apps, schema_editor):
+    """Each enrolled profile's encoding becomes its first enrollment template"""
+    UserProfile = apps.get_model('authentication', 'UserProfile')
+    FaceTemplate = apps.get_model('authentication', 'FaceTemplate')
+    rows = (UserProfile.objects
+            .filter(has_face_data=True)
+            .values_list('user_id', 'face_encoding')
+            .iterator(chunk_size=2000))
+    batch = []
+    for user_id, encoding in rows:
+        if encoding:
+            batch.append(FaceTemplate(user_id=user_id, encoding=encoding, source='enrollment'))
+        if len(batch) >= 2000:
+            FaceTemplate.objects.bulk_create(batch)
+            batch = []
+    FaceTemplate.objects.bulk_create(batch)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0009_profile_metadata_flags'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FaceTemplate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('encoding', models.BinaryField()),
+                ('source', models.CharField(choices=[('enrollment', 'Enrollment'), ('login', 'Login capture')], default='enrollment', max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='face_templates', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'created_at'], name='facetemplate_user_idx')],
+            },
+        ),
+        migrations.RunPython(seed_templates, migrations.RunPython.noop),
+    ]
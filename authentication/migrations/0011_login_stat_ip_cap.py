@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:08
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def trim_ip_addresses(apps, schema_editor):
+    """Cut rollups that collected more than LOGIN_STAT_MAX_IPS addresses down to size"""
+    LoginStat = apps.get_model('authentication', 'LoginStat')
+    max_ips = getattr(settings, 'LOGIN_STAT_MAX_IPS', 50)
+    trimmed = []
+    for stat in LoginStat.objects.only('id', 'ip_addresses').iterator(chunk_size=2000):
+        if len(stat.ip_addresses) > max_ips:
+            stat.ip_addresses = stat.ip_addresses[:max_ips]
+            stat.ips_truncated = True
+            trimmed.append(stat)
+    LoginStat.objects.bulk_update(trimmed, ['ip_addresses', 'ips_truncated'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0010_face_templates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loginstat',
+            name='ips_truncated',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(trim_ip_addresses, migrations.RunPython.noop),
+    ]
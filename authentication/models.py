@@ -1,32 +1,99 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.conf import settings
-import os
+from django.utils import timezone
 import uuid
 
+KEY_ALGORITHM_CHOICES = [
+    ('rsa-pkcs1v15', 'RSA-2048 PKCS#1 v1.5'),
+    ('ed25519', 'Ed25519'),
+    ('ecdsa-p256', 'ECDSA P-256'),
+]
+
+TEMPLATE_SOURCE_CHOICES = [
+    ('enrollment', 'Enrollment'),
+    ('login', 'Login capture'),
+]
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
+    # Mean of the user's FaceTemplates, maintained by face_templates; the gallery indexes it
     face_encoding = models.BinaryField(null=True, blank=True)
     face_image = models.ImageField(upload_to='face_data/', null=True, blank=True)
     public_key = models.TextField(null=True, blank=True)
     private_key = models.TextField(null=True, blank=True)
-    login_attempts = models.IntegerField(default=0)
-    last_failed_login = models.DateTimeField(null=True, blank=True)
-    is_locked = models.BooleanField(default=False)
+    key_algorithm = models.CharField(max_length=20, choices=KEY_ALGORITHM_CHOICES, default='rsa-pkcs1v15')
+    # Kept in step with the columns above by save(), so listings can defer them
+    has_face_data = models.BooleanField(default=False, editable=False)
+    has_keys = models.BooleanField(default=False, editable=False)
+    encoding_version = models.PositiveIntegerField(default=0, editable=False)
+
+    # Columns to .defer() wherever only the flags are needed
+    HEAVY_FIELDS = ('face_encoding', 'public_key', 'private_key')
 
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
-    def get_face_encoding_path(self):
-        if not self.face_encoding:
-            return None
-        filename = f"user_{self.user.id}_face_encoding.pkl"
-        filepath = os.path.join(settings.FACE_DATA_DIR, filename)
-        return filepath
+    def sync_metadata(self, fields=None):
+        """Recompute the flag columns from the loaded heavy fields; return the flag names updated
+
+        Only ``fields`` are considered when given. Callers that bypass save(),
+        such as bulk_update(), must call this and write the returned fields too.
+        """
+        loaded = self.__dict__
+        fields = set(fields) if fields is not None else set(self.HEAVY_FIELDS)
+        updated = []
+        if 'face_encoding' in fields and 'face_encoding' in loaded:
+            self.has_face_data = bool(self.face_encoding)
+            if self.face_encoding_changed():
+                self.encoding_version += 1
+            updated += ['has_face_data', 'encoding_version']
+        if fields & {'public_key', 'private_key'} and 'public_key' in loaded and 'private_key' in loaded:
+            self.has_keys = bool(self.public_key and self.private_key)
+            updated.append('has_keys')
+        return updated
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        updated = self.sync_metadata(update_fields)
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | set(updated)
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored encoding so signal handlers can tell when it changes
+        instance._loaded_face_encoding = instance.__dict__.get('face_encoding')
+        return instance
+
+    def face_encoding_changed(self):
+        """Whether face_encoding differs from the value last read from or written to the database"""
+        if 'face_encoding' not in self.__dict__:
+            # Deferred and never assigned
+            return False
+        loaded = getattr(self, '_loaded_face_encoding', None)
+        return bytes(self.face_encoding or b'') != bytes(loaded or b'')
+
+class FaceTemplate(models.Model):
+    """One enrolled encoding of a user's face; a user has up to FACE_TEMPLATES_PER_USER"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='face_templates')
+    encoding = models.BinaryField()
+    source = models.CharField(max_length=20, choices=TEMPLATE_SOURCE_CHOICES, default='enrollment')
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    def __str__(self):
+        return f"{self.get_source_display()} template of {self.user.username}"
+
+    class Meta:
+        indexes = [
+            # A user's templates, oldest first, for matching and eviction
+            models.Index(fields=['user', 'created_at'], name='facetemplate_user_idx'),
+        ]
 
 class LoginLog(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='login_logs')
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the attempt happens, not when the buffered log writer inserts it
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     successful = models.BooleanField(default=False)
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.TextField(null=True, blank=True)
@@ -37,6 +104,14 @@ class LoginLog(models.Model):
         status = "Success" if self.successful else "Failed"
         return f"{status} login for {self.user.username} at {self.timestamp}"
 
+    class Meta:
+        indexes = [
+            # Recent logins of one user (dashboard, admin)
+            models.Index(fields=['user', '-timestamp'], name='loginlog_user_recent_idx'),
+            # Age-based retention
+            models.Index(fields=['timestamp'], name='loginlog_timestamp_idx'),
+        ]
+
 class DigitalSignature(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='signatures')
     token = models.UUIDField(default=uuid.uuid4, editable=False)
@@ -49,4 +124,53 @@ class DigitalSignature(models.Model):
         return f"Signature for {self.user.username} ({self.token})"
 
     class Meta:
-        ordering = ['-created_at']  
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            # Expired and used challenges are found for cleanup without a table scan
+            models.Index(fields=['expires_at', 'used'], name='signature_expiry_idx'),
+        ]
+
+class PregeneratedKeyPair(models.Model):
+    """Key pair generated ahead of time, waiting to be claimed by a new account"""
+    algorithm = models.CharField(max_length=20, choices=KEY_ALGORITHM_CHOICES, default='rsa-pkcs1v15')
+    public_key = models.TextField()
+    private_key = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Pre-generated {self.algorithm} key pair {self.pk}"
+
+class LoginStat(models.Model):
+    """Login attempts of one user rolled up per hour or per day"""
+    GRANULARITY_CHOICES = [('hour', 'Hour'), ('day', 'Day')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='login_stats')
+    granularity = models.CharField(max_length=4, choices=GRANULARITY_CHOICES)
+    bucket = models.DateTimeField()  # Start of the hour or day (UTC)
+    successes = models.PositiveIntegerField(default=0)
+    failures = models.PositiveIntegerField(default=0)
+    score_sum = models.FloatField(default=0)
+    score_count = models.PositiveIntegerField(default=0)
+    score_min = models.FloatField(null=True, blank=True)
+    ip_addresses = models.JSONField(default=list)  # Distinct client IPs seen in the bucket, up to LOGIN_STAT_MAX_IPS
+    ips_truncated = models.BooleanField(default=False)  # More distinct IPs were seen than are kept
+
+    def __str__(self):
+        return f"{self.user.username} {self.granularity} {self.bucket}"
+
+    @property
+    def score_mean(self):
+        return self.score_sum / self.score_count if self.score_count else None
+
+    @property
+    def distinct_ips(self):
+        """Distinct client IPs, a lower bound when ``ips_truncated``"""
+        return len(self.ip_addresses)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'granularity', 'bucket'], name='loginstat_unique_bucket'),
+        ]
+        indexes = [
+            models.Index(fields=['granularity', 'bucket'], name='loginstat_bucket_idx'),
+        ]
@@ -0,0 +1,283 @@
+"""On-demand profiling of individual production requests
+
+``ProfilingMiddleware`` profiles a request when one of these triggers it:
+
+* a ``PROFILING_HEADER`` header carrying a token from ``make_trigger_token``
+  (signed with SECRET_KEY, valid for ``PROFILING_TOKEN_MAX_AGE`` seconds);
+* the ``PROFILING_SAMPLE_RATE`` fraction of requests, chosen at random;
+* the admin toggle on the profiles page, optionally limited to one username.
+
+The profiler is ``cProfile`` (``PROFILING_MODE = 'cprofile'``, a ``.prof``
+file for pstats/snakeviz) or a stack sampler (``'sampling'``, collapsed stacks
+for flamegraph.pl/speedscope). Each profile is written to ``PROFILING_DIR``
+with a JSON metadata file: user, endpoint, status, image size, face-match
+outcome and stage timings. Only the newest ``PROFILING_MAX_PROFILES`` are kept.
+
+Requests that are not triggered pay a header lookup and a clock comparison;
+the toggle is re-read from the cache every ``PROFILING_TOGGLE_POLL_SECONDS``.
+Face work done in pool worker processes is not in the profile; it shows up as
+waiting, with the worker's stages in the metadata timings.
+"""
+import base64
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from io import BytesIO
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.utils import timezone
+from PIL import Image
+
+from . import metrics, timing
+
+logger = logging.getLogger(__name__)
+
+profiles_written = metrics.counter('request_profiles_written', "Request profiles written, by trigger")
+
+TOKEN_SALT = 'authentication.profiling'
+TOGGLE_KEY = 'profiling:toggle'
+PROFILE_NAME = re.compile(r'^\d+-[0-9a-f]{8}$')
+
+_notes = contextvars.ContextVar('profiling_notes', default=None)
+
+
+def make_trigger_token():
+    """Header value that makes the next requests carrying it be profiled"""
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign('profile')
+
+
+def is_trigger_token(value):
+    """Whether a header value is a trigger token that has not expired"""
+    try:
+        return signing.TimestampSigner(salt=TOKEN_SALT).unsign(
+            value, max_age=getattr(settings, 'PROFILING_TOKEN_MAX_AGE', 3600)) == 'profile'
+    except signing.BadSignature:
+        return False
+
+
+def note(**fields):
+    """Attach details (e.g. the face-match outcome) to the profile of the current request, if any"""
+    notes = _notes.get()
+    if notes is not None:
+        notes.update(fields)
+
+
+def _toggle_cache():
+    return caches[getattr(settings, 'PROFILING_CACHE_ALIAS', 'default')]
+
+
+def set_toggle(minutes, username=None):
+    """Profile every request (or only ``username``'s) for the next ``minutes``, in every process"""
+    toggle = {'until': time.time() + minutes * 60, 'username': username or None}
+    _toggle_cache().set(TOGGLE_KEY, toggle, timeout=int(minutes * 60) + 1)
+    return toggle
+
+
+def clear_toggle():
+    _toggle_cache().delete(TOGGLE_KEY)
+
+
+def get_toggle():
+    toggle = _toggle_cache().get(TOGGLE_KEY)
+    return toggle if toggle and toggle['until'] > time.time() else None
+
+
+class StackSampler:
+    """Statistical profiler: records one thread's call stack every ``interval`` seconds"""
+
+    extension = '.folded'
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._target = None
+
+    def enable(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump_stats(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class CProfiler(cProfile.Profile):
+    extension = '.prof'
+
+
+def new_profiler():
+    if getattr(settings, 'PROFILING_MODE', 'cprofile') == 'sampling':
+        return StackSampler(getattr(settings, 'PROFILING_SAMPLING_INTERVAL', 0.005))
+    return CProfiler()
+
+
+def _image_details(request):
+    """Size of the submitted face image, read from its header only"""
+    face_data = _submitted(request, 'face_data')
+    if not isinstance(face_data, str) or not face_data:
+        return {}
+    try:
+        data = base64.b64decode(face_data.split(';base64,', 1)[-1])
+        with Image.open(BytesIO(data)) as image:
+            return {'image_bytes': len(data), 'image_size': f"{image.width}x{image.height}",
+                    'image_format': image.format}
+    except Exception:
+        return {'image_bytes': len(face_data)}
+
+
+def _submitted(request, field):
+    """A field of the posted form or JSON body"""
+    if request.method != 'POST':
+        return None
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body).get(field)
+        except (ValueError, AttributeError):
+            return None
+    return request.POST.get(field)
+
+
+def request_username(request):
+    """The signed-in user, or the username a login or verification request is for"""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.get_username()
+    return _submitted(request, 'username')
+
+
+def profile_dir():
+    return str(getattr(settings, 'PROFILING_DIR', os.path.join(settings.BASE_DIR, 'profiles')))
+
+
+def _plain(value):
+    # numpy scores and flags from the face code
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+def save_profile(profiler, metadata):
+    """Write a profile and its metadata into the ring, dropping the oldest beyond the limit"""
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.time_ns()}-{secrets.token_hex(4)}"
+    data_path = os.path.join(directory, name + profiler.extension)
+    profiler.dump_stats(data_path)
+    metadata = {**metadata, 'name': name, 'file': os.path.basename(data_path), 'bytes': os.path.getsize(data_path)}
+    temp_path = os.path.join(directory, f".{name}.json.tmp")
+    with open(temp_path, 'w') as f:
+        json.dump(metadata, f, indent=2, default=_plain)
+    # The metadata file appears last, so listed profiles are always complete
+    os.replace(temp_path, os.path.join(directory, name + '.json'))
+    _prune(directory, getattr(settings, 'PROFILING_MAX_PROFILES', 50))
+    return name
+
+
+def _prune(directory, keep):
+    names = sorted(entry[:-5] for entry in os.listdir(directory) if entry.endswith('.json'))
+    for name in names[:max(0, len(names) - keep)]:
+        for entry in os.listdir(directory):
+            if entry.startswith(name + '.'):
+                try:
+                    os.unlink(os.path.join(directory, entry))
+                except FileNotFoundError:
+                    pass
+
+
+def list_profiles():
+    """Metadata of the stored profiles, newest first"""
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for entry in sorted(os.listdir(directory), reverse=True):
+        if entry.endswith('.json') and not entry.startswith('.'):
+            try:
+                with open(os.path.join(directory, entry)) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return profiles
+
+
+def profile_path(name):
+    """Path of a stored profile's data file, or None if there is no such profile"""
+    if not PROFILE_NAME.match(name or ''):
+        return None
+    directory = profile_dir()
+    try:
+        with open(os.path.join(directory, name + '.json')) as f:
+            return os.path.join(directory, json.load(f)['file'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class Session:
+    """One profiled request: the running profiler and the notes attached to it"""
+
+    def __init__(self):
+        self.notes = {}
+        self._token = _notes.set(self.notes)
+        self.profiler = new_profiler()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        _notes.reset(self._token)
+
+    def save(self, request, response, trigger, elapsed):
+        """Store the profile with the request's metadata; never fails the request"""
+        match = getattr(request, 'resolver_match', None)
+        spans = timing.current() or {}
+        metadata = {
+            'timestamp': timezone.now().isoformat(),
+            'trigger': trigger,
+            'mode': getattr(settings, 'PROFILING_MODE', 'cprofile'),
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 1),
+            'user': request_username(request),
+            **_image_details(request),
+            **self.notes,
+            'timings_ms': {name: round(seconds * 1000, 1) for name, seconds in spans.items()},
+        }
+        try:
+            save_profile(self.profiler, metadata)
+            profiles_written.inc(trigger=trigger)
+        except Exception as e:
+            logger.error(f"Saving request profile failed: {str(e)}")
+
+
+def start():
+    """Start profiling the current request"""
+    return Session()
@@ -0,0 +1,192 @@
+"""Cache-backed sliding-window login failure limits and lockouts
+
+Failed logins are counted per username and per client IP with atomic cache
+increments; nothing is written to the database. A sliding window of
+``LOGIN_FAILURE_WINDOW_SECONDS`` is approximated from the current and previous
+fixed windows, weighting the previous one by how much of it still overlaps.
+
+Reaching ``MAX_FAILED_LOGIN_ATTEMPTS`` failures for a username, or
+``LOGIN_IP_MAX_FAILED_ATTEMPTS`` for an IP, locks it for
+``LOCKOUT_TIME_MINUTES``. ``check_login_allowed`` only reads the lock keys, so
+locked requests are turned away before any password hashing or face work.
+A successful login clears the username's counters, as before.
+``check_identify_allowed`` uses the same counters to cap 1:N identification
+requests per user and per IP.
+
+Counters live in the ``LOGIN_RATE_LIMIT_CACHE_ALIAS`` cache, which must be a
+shared backend that does not evict live keys (Redis, database): an evicted
+lock key is a lifted lock. ``check_cache_backend`` refuses local-memory and
+dummy caches and runs when the app starts.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics
+
+lockouts = metrics.counter('login_lockouts', "Usernames or IPs locked after too many failed logins, by scope")
+rejected = metrics.counter('login_rate_limited', "Login attempts rejected because the username or IP was locked, by scope")
+identify_rejected = metrics.counter('face_identify_rate_limited', "1:N identification requests refused for exceeding the rate limit")
+
+
+# Per-process stores that evict (or never keep) keys: a lock held there can be lifted at will
+UNSAFE_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache')
+
+
+def _alias():
+    return getattr(settings, 'LOGIN_RATE_LIMIT_CACHE_ALIAS', 'rate_limit')
+
+
+def _cache():
+    return caches[_alias()]
+
+
+def check_cache_backend():
+    """Raise ImproperlyConfigured unless the rate-limit cache is shared and durable"""
+    alias = _alias()
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    if backend is None or backend in UNSAFE_BACKENDS:
+        raise ImproperlyConfigured(
+            f"LOGIN_RATE_LIMIT_CACHE_ALIAS '{alias}' must be a shared cache that does not evict live keys "
+            f"(Redis or DatabaseCache), not {backend or 'undefined'}: an evicted lock lifts the lockout."
+        )
+
+
+def _window():
+    return getattr(settings, 'LOGIN_FAILURE_WINDOW_SECONDS', None) or settings.LOCKOUT_TIME_MINUTES * 60
+
+
+def _lockout_seconds():
+    return settings.LOCKOUT_TIME_MINUTES * 60
+
+
+def _ident(scope, value):
+    # Hash so any username or IPv6 address makes a valid memcached key
+    return f"{scope}:{hashlib.sha256(str(value).encode('utf-8')).hexdigest()[:32]}"
+
+
+class SlidingWindowCounter:
+    """Approximate count of events in the last ``window`` seconds, per identifier"""
+
+    def __init__(self, cache, prefix, window):
+        self.cache = cache
+        self.prefix = prefix
+        self.window = window
+
+    def _keys(self, ident, now):
+        index = int(now // self.window)
+        return f"{self.prefix}:{ident}:{index}", f"{self.prefix}:{ident}:{index - 1}"
+
+    def _estimate(self, current, previous, now):
+        overlap = 1 - (now % self.window) / self.window
+        return current + previous * overlap
+
+    def hit(self, ident):
+        """Count one event and return the windowed total including it"""
+        now = time.time()
+        current_key, previous_key = self._keys(ident, now)
+        # add() is a no-op if the key exists; incr() is atomic on every shared backend
+        self.cache.add(current_key, 0, timeout=2 * self.window)
+        try:
+            current = self.cache.incr(current_key)
+        except ValueError:
+            # Expired between add() and incr()
+            self.cache.set(current_key, 1, timeout=2 * self.window)
+            current = 1
+        previous = self.cache.get(previous_key, 0)
+        return self._estimate(current, previous, now)
+
+    def count(self, ident):
+        now = time.time()
+        current_key, previous_key = self._keys(ident, now)
+        values = self.cache.get_many([current_key, previous_key])
+        return self._estimate(values.get(current_key, 0), values.get(previous_key, 0), now)
+
+    def reset(self, ident):
+        current_key, previous_key = self._keys(ident, time.time())
+        self.cache.delete_many([current_key, previous_key])
+
+
+def _failures():
+    return SlidingWindowCounter(_cache(), 'login-failures', _window())
+
+
+def _lock_key(ident):
+    return f"login-lock:{ident}"
+
+
+def check_login_allowed(username, ip_address):
+    """Return ``(allowed, scope, retry_after_seconds)`` for a login attempt
+
+    ``scope`` is ``'user'`` or ``'ip'`` when the attempt is refused.
+    """
+    idents = {'user': _ident('user', username)}
+    if ip_address:
+        idents['ip'] = _ident('ip', ip_address)
+    locks = _cache().get_many([_lock_key(ident) for ident in idents.values()])
+    now = time.time()
+    for scope, ident in idents.items():
+        locked_until = locks.get(_lock_key(ident))
+        if locked_until and locked_until > now:
+            rejected.inc(scope=scope)
+            return False, scope, int(locked_until - now) + 1
+    return True, None, 0
+
+
+def record_login_failure(username, ip_address):
+    """Count a failed login; return True if the username is now locked"""
+    counter = _failures()
+    cache = _cache()
+    lockout = _lockout_seconds()
+    limits = [('user', _ident('user', username), settings.MAX_FAILED_LOGIN_ATTEMPTS)]
+    if ip_address:
+        limits.append(('ip', _ident('ip', ip_address), getattr(settings, 'LOGIN_IP_MAX_FAILED_ATTEMPTS', 20)))
+
+    user_locked = False
+    for scope, ident, limit in limits:
+        if counter.hit(ident) >= limit:
+            if cache.add(_lock_key(ident), time.time() + lockout, timeout=lockout):
+                lockouts.inc(scope=scope)
+            # Start counting afresh once the lock expires
+            counter.reset(ident)
+            user_locked = user_locked or scope == 'user'
+    return user_locked
+
+
+def record_login_success(username):
+    """Forget a username's earlier failures"""
+    _failures().reset(_ident('user', username))
+
+
+def lockout_remaining(username):
+    """Seconds until a username's lock expires, or 0 if it is not locked"""
+    locked_until = _cache().get(_lock_key(_ident('user', username)))
+    return max(0, int(locked_until - time.time()) + 1) if locked_until and locked_until > time.time() else 0
+
+
+def unlock(username):
+    """Lift a username's lock and clear its failure count"""
+    ident = _ident('user', username)
+    _cache().delete(_lock_key(ident))
+    _failures().reset(ident)
+
+
+def check_identify_allowed(user_id, ip_address):
+    """Count a 1:N identification request; return ``(allowed, retry_after_seconds)``
+
+    Each user and each client IP may make ``FACE_IDENTIFY_RATE_LIMIT`` requests
+    per ``FACE_IDENTIFY_RATE_WINDOW_SECONDS``.
+    """
+    window = getattr(settings, 'FACE_IDENTIFY_RATE_WINDOW_SECONDS', 60)
+    limit = getattr(settings, 'FACE_IDENTIFY_RATE_LIMIT', 30)
+    counter = SlidingWindowCounter(_cache(), 'identify', window)
+    idents = [_ident('user', user_id)]
+    if ip_address:
+        idents.append(_ident('ip', ip_address))
+    if any(counter.hit(ident) > limit for ident in idents):
+        identify_rejected.inc()
+        return False, int(window - time.time() % window) + 1
+    return True, 0
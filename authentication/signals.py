@@ -1,7 +1,9 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
+from django.db import transaction
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from .models import UserProfile
+from . import encoding_cache, gallery
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -12,8 +14,33 @@ def create_user_profile(sender, instance, created, **kwargs):
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
     """Save UserProfile when User is saved"""
+    if kwargs.get('update_fields'):
+        # Partial saves such as login()'s last_login update leave the profile alone
+        return
     try:
         instance.profile.save()
     except UserProfile.DoesNotExist:
         # Create profile if it doesn't exist
-        UserProfile.objects.create(user=instance)
\ No newline at end of file
+        UserProfile.objects.create(user=instance)
+
+@receiver(post_save, sender=UserProfile)
+def sync_face_gallery(sender, instance, **kwargs):
+    """Keep the identification gallery and encoding cache in step with enrolled encodings"""
+    if not instance.face_encoding_changed():
+        return
+    user_id, encoding_bytes = instance.user_id, instance.face_encoding
+    instance._loaded_face_encoding = encoding_bytes
+    encoding_cache.invalidate(user_id)
+
+    def apply():
+        # Invalidate again: a reader may have cached the old value before the commit
+        encoding_cache.invalidate(user_id)
+        gallery.update_user_encoding(user_id, encoding_bytes)
+    transaction.on_commit(apply)
+
+@receiver(post_delete, sender=UserProfile)
+def remove_from_face_gallery(sender, instance, **kwargs):
+    """Drop a deleted profile from the identification gallery and encoding cache"""
+    user_id = instance.user_id
+    encoding_cache.invalidate(user_id)
+    transaction.on_commit(lambda: gallery.remove_user(user_id))
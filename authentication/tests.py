@@ -1,3 +1,1429 @@
-from django.test import TestCase
+import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import detectors, encoding_cache, face_pool, key_pool, login_stats, profiling
+from .ann import IVFIndex
+from .burst import verify_burst
+from .crypto_utils import (CHALLENGE_SESSION_KEY, _ParsedKeyCache, create_signed_challenge, generate_key_pair,
+                           get_algorithm, preferred_algorithm, sign_data, verify_signature, verify_signed_challenge)
+from .detectors import CnnDetector, FaceDetector, HogDetector, get_detector
+from .encoding_cache import EncodingCache
+from .encoding_format import (EncodingFormatError, make_templates, pack_encoding, pack_templates, unpack_encoding,
+                              unpack_templates)
+from .face_pool import FacePoolBusy, FaceWorkPool, get_face_pool, run_face_task
+from .face_templates import add_template, learn_from_login, replace_templates
+from .face_utils import decode_face_data, decode_image_bytes, detect_faces, template_distance
+from .gallery import FaceGallery, get_gallery
+from .gallery_store import HEADER_SIZE, GalleryFile, record_dtype
+from .key_pool import claim_key_pair, pool_size, store_key_pairs
+from .log_writer import LoginLogWriter
+from .login_stats import apply_rollup
+from .models import DigitalSignature, FaceTemplate, LoginLog, LoginStat, PregeneratedKeyPair, UserProfile
+from .rate_limit import (SlidingWindowCounter, check_cache_backend, check_login_allowed, lockout_remaining,
+                         record_login_failure, record_login_success, unlock)
+from .retention import expired_signatures, old_login_logs, purge_in_chunks
+from .views import get_client_ip
+
+
+# The rate-limit store's own queries depend on its backend (none with Redis), so
+# the budgets count the login's queries with the counters kept in memory
+@override_settings(FACE_POOL_WORKERS=0, LOGIN_CHALLENGE_MODE='stateless', MAX_FAILED_LOGIN_ATTEMPTS=5,
+                   LOGIN_RATE_LIMIT_CACHE_ALIAS='default')
+class LoginQueryBudgetTests(TestCase):
+    """Each login outcome runs a fixed number of queries; raise a budget only on purpose"""
+
+    # Success: user+profile, then login()'s session key check, session insert and
+    # last_login update, and the session middleware's save; under TestCase both
+    # session writes are also wrapped in a SAVEPOINT/RELEASE pair
+    SUCCESS_QUERIES = 9
+    # Bad password / face mismatch: the user+profile lookup only
+    FAILURE_QUERIES = 1
+    # Locked: refused from the cache before any lookup
+    LOCKED_QUERIES = 0
+
+    password = 'correct-horse-battery'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password=cls.password)
+        public_key, private_key = generate_key_pair()
+        UserProfile.objects.filter(user=cls.user).update(
+            public_key=public_key, private_key=private_key, key_algorithm=preferred_algorithm(),
+            has_keys=True, has_face_data=True,
+        )
+
+    def setUp(self):
+        caches['default'].clear()
+        self.url = reverse('authentication:login')
+        # Login logs go through the background writer; keep them out of the request's budget
+        patcher = mock.patch('authentication.views.record_login')
+        self.record_login = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, password=None, face_data='data:image/jpeg;base64,AAAA'):
+        return self.client.post(self.url, {
+            'username': 'alice',
+            'password': password or self.password,
+            'face_data': face_data,
+        }, secure=True)
+
+    def patch_face(self, match, score):
+        encoding = mock.patch('authentication.views.get_user_templates', return_value=make_templates([np.zeros(128)]))
+        compare = mock.patch('authentication.views.run_face_task', return_value=(match, score, None, np.zeros(128)))
+        encoding.start()
+        compare.start()
+        self.addCleanup(encoding.stop)
+        self.addCleanup(compare.stop)
+
+    def test_success(self):
+        self.patch_face(True, 0.8)
+        with self.assertNumQueries(self.SUCCESS_QUERIES):
+            response = self.post()
+        self.assertRedirects(response, reverse('authentication:dashboard'), fetch_redirect_response=False)
+        self.assertEqual(self.record_login.call_args.kwargs['successful'], True)
+
+    def test_success_signs_challenge_once(self):
+        self.patch_face(True, 0.8)
+        with mock.patch('authentication.crypto_utils.sign_data', wraps=sign_data) as sign, \
+                mock.patch('authentication.crypto_utils.verify_signature') as verify:
+            self.post()
+        self.assertEqual(sign.call_count, 1)
+        verify.assert_not_called()
+
+    def test_challenge_verified_on_next_request(self):
+        self.patch_face(True, 0.8)
+        self.post()
+        self.assertEqual(self.record_login.call_args.kwargs['signature_verified'], None)
+        self.assertIn(CHALLENGE_SESSION_KEY, self.client.session)
+        with mock.patch('authentication.log_writer.record_login') as record_failure:
+            response = self.client.get(reverse('authentication:dashboard'), secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(CHALLENGE_SESSION_KEY, self.client.session)
+        record_failure.assert_not_called()
+
+    def test_bad_challenge_ends_session(self):
+        self.patch_face(True, 0.8)
+        self.post()
+        session = self.client.session
+        payload, signature = session[CHALLENGE_SESSION_KEY].split('.')
+        session[CHALLENGE_SESSION_KEY] = f"{payload}.{signature[::-1]}"
+        session.save()
+        with mock.patch('authentication.log_writer.record_login') as record_failure, \
+                self.assertLogs('authentication.middleware', 'WARNING'):
+            response = self.client.get(reverse('authentication:dashboard'), secure=True)
+        self.assertRedirects(response, reverse('authentication:login'), fetch_redirect_response=False)
+        self.assertNotIn('_auth_user_id', self.client.session)
+        self.assertEqual(record_failure.call_args.kwargs['signature_verified'], False)
+
+    @override_settings(SIGNATURE_ALGORITHM='ecdsa-p256')
+    def test_old_algorithm_rekeyed_at_login(self):
+        old_public_key = UserProfile.objects.get(user=self.user).public_key
+        self.patch_face(True, 0.8)
+        self.post()
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(profile.key_algorithm, 'ecdsa-p256')
+        self.assertNotEqual(profile.public_key, old_public_key)
+        # The session's challenge was signed with the new key
+        self.assertTrue(verify_signed_challenge(profile, self.client.session[CHALLENGE_SESSION_KEY]))
+
+    def test_signed_challenge_verifies_once(self):
+        profile = UserProfile.objects.get(user=self.user)
+        challenge = create_signed_challenge(profile)
+        self.assertTrue(verify_signed_challenge(profile, challenge))
+        with self.assertLogs('authentication.crypto_utils', 'WARNING'):
+            self.assertFalse(verify_signed_challenge(profile, challenge))
+
+    def test_success_without_face(self):
+        UserProfile.objects.filter(user=self.user).update(has_face_data=False)
+        with mock.patch('authentication.views.get_user_templates') as get_user_templates:
+            with self.assertNumQueries(self.SUCCESS_QUERIES):
+                response = self.post(face_data='')
+        self.assertEqual(response.status_code, 302)
+        get_user_templates.assert_not_called()
+
+    def test_bad_password(self):
+        self.patch_face(True, 0.8)
+        with self.assertNumQueries(self.FAILURE_QUERIES):
+            response = self.post(password='wrong')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.record_login.call_args.kwargs['successful'], False)
+
+    def test_unknown_user(self):
+        with self.assertNumQueries(self.FAILURE_QUERIES):
+            response = self.client.post(self.url, {'username': 'nobody', 'password': 'x'}, secure=True)
+        self.assertEqual(response.status_code, 200)
+
+    def test_face_mismatch(self):
+        self.patch_face(False, 0.2)
+        with self.assertNumQueries(self.FAILURE_QUERIES):
+            response = self.post()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.record_login.call_args.kwargs['face_match_score'], 0.2)
+
+    def test_locked(self):
+        self.patch_face(True, 0.8)
+        for _ in range(5):
+            self.post(password='wrong')
+        with mock.patch.object(User, 'check_password') as check_password:
+            with self.assertNumQueries(self.LOCKED_QUERIES):
+                response = self.post()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        check_password.assert_not_called()
+
+    def test_dashboard_does_not_load_blobs(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('authentication:dashboard'), secure=True)
+        self.assertEqual(response.status_code, 200)
+        profile_queries = [q['sql'] for q in queries if 'authentication_userprofile' in q['sql']]
+        self.assertEqual(len(profile_queries), 1)
+        for column in UserProfile.HEAVY_FIELDS:
+            self.assertNotIn(f'"{column}"', profile_queries[0])
+
+    def test_login_does_not_resave_profile(self):
+        self.patch_face(True, 0.8)
+        with mock.patch.object(UserProfile, 'save') as save:
+            self.post()
+        save.assert_not_called()
+
+
+@override_settings(FACE_POOL_WORKERS=0, FACE_ASYNC_CONCURRENCY=1, FACE_POOL_TIMEOUT=0.05)
+class AsyncViewTests(TestCase):
+    """The ASGI login and precheck views match faces, and shed load with a retryable 503"""
+
+    password = 'correct-horse-battery'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password=cls.password)
+        public_key, private_key = generate_key_pair()
+        UserProfile.objects.filter(user=cls.user).update(
+            public_key=public_key, private_key=private_key, key_algorithm=preferred_algorithm(),
+            has_keys=True, has_face_data=True,
+        )
+
+    def setUp(self):
+        caches['default'].clear()
+        templates = mock.patch('authentication.views.aget_user_templates', new=mock.AsyncMock(
+            return_value=make_templates([np.zeros(128)])))
+        templates.start()
+        self.addCleanup(templates.stop)
+        for target in ('authentication.views.record_login', 'authentication.views.learn_from_login'):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def login(self):
+        return await self.async_client.post(reverse('authentication:login_async'), {
+            'username': 'alice',
+            'password': self.password,
+            'face_data': 'data:image/jpeg;base64,AAAA',
+        }, secure=True)
+
+    async def verify(self):
+        return await self.async_client.post(reverse('authentication:verify_face_async'),
+                                            data=json.dumps({'username': 'alice', 'face_data': 'frame'}),
+                                            content_type='application/json',
+                                            headers={'X-Requested-With': 'XMLHttpRequest'}, secure=True)
+
+    async def test_login_success(self):
+        with mock.patch('authentication.views.run_face_task_async',
+                        new=mock.AsyncMock(return_value=(True, 0.8, None, np.zeros(128)))):
+            response = await self.login()
+        self.assertRedirects(response, reverse('authentication:dashboard'), fetch_redirect_response=False)
+
+    async def test_login_shed(self):
+        with mock.patch('authentication.views.run_face_task_async', new=mock.AsyncMock(side_effect=FacePoolBusy)):
+            response = await self.login()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '2')
+
+    async def test_verify_success(self):
+        with mock.patch('authentication.views.compare_face_data', return_value=(True, 0.8, None)) as compare:
+            response = await self.verify()
+        self.assertEqual(response.json(), {'success': True, 'score': 80.0})
+        self.assertEqual(compare.call_args.args[1:], ('frame', 'verify'))
+
+    async def test_verify_concurrency_limit(self):
+        # Every face computation slot on this event loop is taken by another request
+        semaphore = face_pool._async_limit()
+        await semaphore.acquire()
+        with mock.patch('authentication.views.compare_face_data', return_value=(True, 0.8, None)) as compare:
+            response = await self.verify()
+            self.assertEqual(response.status_code, 503)
+            self.assertTrue(response.json()['retry'])
+            compare.assert_not_called()
+            semaphore.release()
+            response = await self.verify()
+        self.assertEqual(response.status_code, 200)
+        compare.assert_called_once()
+
+
+class UserProfileMetadataTests(TestCase):
+    """The flag columns follow the encoding and key columns on every save path"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('bob', password='x')
+        self.profile = UserProfile.objects.get(user=self.user)
+
+    def test_flags_follow_save(self):
+        self.assertFalse(self.profile.has_face_data)
+        self.profile.face_encoding = b'encoding-1'
+        self.profile.public_key, self.profile.private_key = 'public', 'private'
+        self.profile.save()
+        self.profile.refresh_from_db()
+        self.assertTrue(self.profile.has_face_data)
+        self.assertTrue(self.profile.has_keys)
+        self.assertEqual(self.profile.encoding_version, 1)
+
+        self.profile.face_encoding = None
+        self.profile.save()
+        self.profile.refresh_from_db()
+        self.assertFalse(self.profile.has_face_data)
+        self.assertEqual(self.profile.encoding_version, 2)
+
+    def test_flags_follow_update_fields_on_deferred_instance(self):
+        profile = UserProfile.objects.defer(*UserProfile.HEAVY_FIELDS).get(pk=self.profile.pk)
+        profile.face_encoding = b'encoding-1'
+        profile.save(update_fields=['face_encoding'])
+        profile = UserProfile.objects.get(pk=self.profile.pk)
+        self.assertTrue(profile.has_face_data)
+        self.assertEqual(profile.encoding_version, 1)
+        self.assertFalse(profile.has_keys)
+
+    def test_unchanged_encoding_keeps_version(self):
+        self.profile.face_encoding = b'encoding-1'
+        self.profile.save()
+        profile = UserProfile.objects.get(pk=self.profile.pk)
+        profile.save()
+        profile.refresh_from_db()
+        self.assertEqual(profile.encoding_version, 1)
+
+
+@override_settings(FACE_POOL_WORKERS=0, PROFILING_MAX_PROFILES=2, PROFILING_SAMPLE_RATE=0,
+                   PROFILING_TOGGLE_POLL_SECONDS=0)
+class RequestProfilingTests(TestCase):
+    """Requests are profiled only when triggered, into a bounded ring"""
+
+    def setUp(self):
+        caches['default'].clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(PROFILING_DIR=directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.url = reverse('authentication:login')
+
+    def test_untriggered_request_is_not_profiled(self):
+        self.client.get(self.url, secure=True)
+        self.client.get(self.url, secure=True, HTTP_X_PROFILE_REQUEST='forged')
+        self.assertEqual(profiling.list_profiles(), [])
+
+    def test_signed_header_profiles_request(self):
+        with mock.patch('authentication.views.record_login'), \
+                mock.patch('authentication.views.get_user_templates', return_value=np.zeros(128)), \
+                mock.patch('authentication.views.run_face_task', return_value=(np.False_, np.float64(0.3), None, None)):
+            User.objects.create_user('alice', password='pw')
+            UserProfile.objects.filter(user__username='alice').update(has_face_data=True)
+            self.client.post(self.url, {'username': 'alice', 'password': 'pw', 'face_data': 'data:image/jpeg;base64,AAAA'},
+                             secure=True, HTTP_X_PROFILE_REQUEST=profiling.make_trigger_token())
+        [profile] = profiling.list_profiles()
+        self.assertEqual(profile['trigger'], 'header')
+        self.assertEqual(profile['view'], 'authentication:login')
+        self.assertEqual(profile['user'], 'alice')
+        self.assertIs(profile['face_match'], False)
+        self.assertEqual(profile['face_score'], 0.3)
+        self.assertTrue(os.path.exists(profiling.profile_path(profile['name'])))
+
+    def test_ring_keeps_newest_profiles(self):
+        profiling.set_toggle(1)
+        for _ in range(3):
+            self.client.get(self.url, secure=True)
+        profiles = profiling.list_profiles()
+        self.assertEqual(len(profiles), 2)
+        self.assertEqual(len(os.listdir(profiling.profile_dir())), 4)
+        self.assertTrue(all(profile['trigger'] == 'toggle' for profile in profiles))
+
+    def test_toggle_limited_to_username(self):
+        profiling.set_toggle(1, 'bob')
+        self.client.post(self.url, {'username': 'alice', 'password': 'x'}, secure=True)
+        self.assertEqual(profiling.list_profiles(), [])
+        self.client.post(self.url, {'username': 'bob', 'password': 'x'}, secure=True)
+        self.assertEqual(len(profiling.list_profiles()), 1)
+
+    def test_download_is_staff_only(self):
+        profiling.set_toggle(1)
+        self.client.get(self.url, secure=True)
+        profiling.clear_toggle()
+        [profile] = profiling.list_profiles()
+        download = reverse('authentication:profile_download', args=[profile['name']])
+        self.assertEqual(self.client.get(download, secure=True).status_code, 302)
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        response = self.client.get(download, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertEqual(self.client.get(reverse('authentication:profiles'), secure=True).status_code, 200)
+        self.assertEqual(self.client.get(reverse('authentication:profile_download', args=['..etc']),
+                                         secure=True).status_code, 404)
+
+
+@override_settings(FACE_POOL_WORKERS=0, FACE_RECOGNITION_TOLERANCE=0.6, FACE_BURST_ACCEPT_DISTANCE=0.5,
+                   FACE_BURST_REJECT_DISTANCE=0.8, FACE_BURST_MAX_FRAMES=3, FACE_BURST_TIME_BUDGET=10,
+                   KEY_POOL_BACKGROUND_REFILL=False)
+class BurstVerificationTests(TestCase):
+    """A burst stops at the first conclusive frame and never touches the frames after it"""
+
+    NO_FACE = (False, 0.0, "No face detected in the provided image.", None)
+    WEAK_MATCH = (True, 0.45, None, np.zeros(128))
+    STRONG_MATCH = (True, 0.7, None, np.zeros(128))
+    STRANGER = (False, 0.1, "Face does not match the registered user.", np.zeros(128))
+    # A face at distance 1.0 scores exactly 0.0 but is still a face
+    FAR_STRANGER = (False, 0.0, "Face does not match the registered user.", np.zeros(128))
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def compare(self, *outcomes):
+        patcher = mock.patch('authentication.burst.run_face_task', side_effect=outcomes)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def frames(self, count):
+        self.consumed = []
+        for index in range(count):
+            self.consumed.append(index)
+            yield f'data:image/jpeg;base64,frame{index}'
+
+    def test_stops_at_confident_match(self):
+        compare = self.compare(self.NO_FACE, self.STRONG_MATCH)
+        result = verify_burst(np.zeros(128), self.frames(5))
+        self.assertTrue(result.match)
+        self.assertEqual(result.stopped, 'confident_match')
+        self.assertEqual(compare.call_count, 2)
+        self.assertEqual(self.consumed, [0, 1])
+
+    def test_stops_at_confident_mismatch(self):
+        self.compare(self.STRANGER)
+        result = verify_burst(np.zeros(128), self.frames(5))
+        self.assertFalse(result.match)
+        self.assertEqual(result.stopped, 'confident_mismatch')
+        self.assertEqual(result.error, self.STRANGER[2])
+
+    def test_face_scoring_zero_is_a_mismatch(self):
+        compare = self.compare(self.FAR_STRANGER, self.STRONG_MATCH)
+        result = verify_burst(np.zeros(128), self.frames(5))
+        self.assertEqual(result.stopped, 'confident_mismatch')
+        self.assertEqual(result.faces, 1)
+        self.assertEqual(compare.call_count, 1)
+
+    def test_best_frame_decides_when_budget_runs_out(self):
+        self.compare(self.NO_FACE, self.WEAK_MATCH, self.NO_FACE)
+        result = verify_burst(np.zeros(128), self.frames(5))
+        self.assertEqual(result.stopped, 'max_frames')
+        self.assertEqual(self.consumed, [0, 1, 2])
+        self.assertTrue(result.match)
+        self.assertEqual(result.score, 0.45)
+
+    def test_no_face_in_any_frame(self):
+        self.compare(self.NO_FACE, self.NO_FACE)
+        result = verify_burst(np.zeros(128), self.frames(2))
+        self.assertEqual(result.stopped, 'frames_exhausted')
+        self.assertFalse(result.match)
+        self.assertEqual(result.error, self.NO_FACE[2])
+
+    def test_ndjson_endpoint_reports_frames(self):
+        User.objects.create_user('alice')
+        self.compare(self.NO_FACE, self.STRONG_MATCH)
+        lines = [{'username': 'alice'}] + [{'face_data': f'data:image/jpeg;base64,frame{i}'} for i in range(4)]
+        with mock.patch('authentication.views.get_user_templates', return_value=np.zeros(128)):
+            response = self.client.post(
+                reverse('authentication:verify_face_burst'), '\n'.join(json.dumps(line) for line in lines),
+                content_type='application/x-ndjson', secure=True, headers={'X-Requested-With': 'XMLHttpRequest'},
+            )
+        body = response.json()
+        self.assertTrue(body['success'])
+        self.assertEqual(body['stopped'], 'confident_match')
+        self.assertEqual([frame['score'] for frame in body['frames']], [0.0, 70.0])
+
+    def test_login_with_several_frames(self):
+        user = User.objects.create_user('alice', password='pw')
+        UserProfile.objects.filter(user=user).update(has_face_data=True)
+        self.compare(self.NO_FACE, self.STRONG_MATCH)
+        response = self.login()
+        self.assertRedirects(response, reverse('authentication:dashboard'), fetch_redirect_response=False)
+
+    @override_settings(MAX_FAILED_LOGIN_ATTEMPTS=3)
+    def test_each_mismatched_face_counts_toward_lockout(self):
+        user = User.objects.create_user('alice', password='pw')
+        UserProfile.objects.filter(user=user).update(has_face_data=True)
+        near_miss = (False, 0.3, "Face does not match the registered user.", np.zeros(128))
+        self.compare(near_miss, near_miss, near_miss)
+        response = self.login()
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(check_login_allowed('alice', None)[0])
+
+    def login(self):
+        with mock.patch('authentication.views.record_login'), \
+                mock.patch('authentication.views.get_user_templates', return_value=make_templates([np.zeros(128)])):
+            return self.client.post(reverse('authentication:login'), {
+                'username': 'alice', 'password': 'pw',
+                'face_data': ['data:image/jpeg;base64,blurry', 'data:image/jpeg;base64,sharp', 'data:image/jpeg;base64,late'],
+            }, secure=True)
+
+
+@override_settings(FACE_TEMPLATES_PER_USER=3, FACE_TEMPLATE_MEAN_ACCEPT_DISTANCE=0.3,
+                   FACE_TEMPLATE_LEARN_MIN_DISTANCE=0.3, FACE_TEMPLATE_LEARN_MAX_DISTANCE=0.45,
+                   FACE_ENCODING_CACHE_ALIAS=None)
+class FaceTemplateTests(TestCase):
+    """Templates are capped, the profile keeps their mean, and the nearest one decides"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        encoding_cache.get_local_cache().clear()
+
+    def vector(self, value):
+        encoding = np.zeros(128, dtype=np.float32)
+        encoding[0] = value
+        return encoding
+
+    def sources(self):
+        return list(FaceTemplate.objects.filter(user=self.user).order_by('created_at').values_list('source', flat=True))
+
+    def test_profile_holds_mean(self):
+        add_template(self.user.id, self.vector(0.2))
+        add_template(self.user.id, self.vector(0.6))
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertTrue(profile.has_face_data)
+        self.assertEqual(profile.encoding_version, 2)
+        self.assertAlmostEqual(float(unpack_encoding(profile.face_encoding)[0]), 0.4, places=6)
+        templates = encoding_cache.get_user_templates(self.user.id)
+        self.assertEqual(templates.encodings.shape, (2, 128))
+        self.assertAlmostEqual(float(templates.mean[0]), 0.4, places=6)
+
+    def test_cached_templates_follow_changes(self):
+        add_template(self.user.id, self.vector(0.1))
+        self.assertEqual(len(encoding_cache.get_user_templates(self.user.id).encodings), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            add_template(self.user.id, self.vector(0.5))
+        self.assertEqual(len(encoding_cache.get_user_templates(self.user.id).encodings), 2)
+
+    def test_login_captures_evicted_first(self):
+        add_template(self.user.id, self.vector(0.1))
+        add_template(self.user.id, self.vector(0.2), source='login')
+        add_template(self.user.id, self.vector(0.3), source='login')
+        add_template(self.user.id, self.vector(0.4))
+        self.assertEqual(self.sources(), ['enrollment', 'login', 'enrollment'])
+        # The new login capture is kept; the only other one goes
+        add_template(self.user.id, self.vector(0.5), source='login')
+        self.assertEqual(self.sources(), ['enrollment', 'enrollment', 'login'])
+
+    def test_replace_templates(self):
+        add_template(self.user.id, self.vector(0.1))
+        add_template(self.user.id, self.vector(0.2))
+        replace_templates(self.user.id, self.vector(0.9))
+        self.assertEqual(FaceTemplate.objects.filter(user=self.user).count(), 1)
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertAlmostEqual(float(unpack_encoding(profile.face_encoding)[0]), 0.9, places=6)
+
+    def test_nearest_template_decides(self):
+        templates = make_templates([self.vector(0.0), self.vector(1.0)])
+        # Far from the mean (0.5) but close to the second template
+        self.assertAlmostEqual(template_distance(templates, self.vector(0.95)), 0.05, places=5)
+        # Close to the mean: accepted without looking further
+        self.assertAlmostEqual(template_distance(templates, self.vector(0.6)), 0.1, places=5)
+        with override_settings(FACE_TEMPLATE_MEAN_ACCEPT_DISTANCE=None):
+            self.assertAlmostEqual(template_distance(templates, self.vector(0.6)), 0.4, places=5)
+
+    def test_learns_only_novel_confident_captures(self):
+        add_template(self.user.id, self.vector(0.0))
+        templates = encoding_cache.get_user_templates(self.user.id)
+        self.assertFalse(learn_from_login(self.user.id, self.vector(0.1), templates))
+        self.assertFalse(learn_from_login(self.user.id, self.vector(0.55), templates))
+        self.assertFalse(learn_from_login(self.user.id, None, templates))
+        self.assertTrue(learn_from_login(self.user.id, self.vector(0.35), templates))
+        self.assertEqual(self.sources(), ['enrollment', 'login'])
+
+    @override_settings(FACE_TEMPLATE_MEAN_ACCEPT_DISTANCE=0.5)
+    def test_learning_measures_nearest_template_not_mean(self):
+        add_template(self.user.id, self.vector(0.0))
+        add_template(self.user.id, self.vector(0.7))
+        templates = encoding_cache.get_user_templates(self.user.id)
+        # On the mean, so the match is accepted there, yet 0.35 from either template
+        self.assertAlmostEqual(template_distance(templates, self.vector(0.35)), 0.0, places=5)
+        self.assertTrue(learn_from_login(self.user.id, self.vector(0.35), templates))
+
+    def test_profile_encoding_without_templates_is_one_template(self):
+        UserProfile.objects.filter(user=self.user).update(face_encoding=pack_encoding(self.vector(0.7)), has_face_data=True)
+        templates = encoding_cache.get_user_templates(self.user.id)
+        self.assertEqual(templates.encodings.shape, (1, 128))
+        self.assertAlmostEqual(float(templates.mean[0]), 0.7, places=6)
+
+
+class _StubDetector(FaceDetector):
+    """Returns canned boxes per call and records the image sizes it was given"""
+
+    name = 'stub'
+
+    def __init__(self, *results):
+        super().__init__()
+        self.results = list(results)
+        self.calls = []
+
+    def detect(self, image, upsample=0):
+        self.calls.append((image.shape[:2], upsample))
+        return self.results.pop(0)
+
+
+def _encoded_image(mode, size, format, color=0, **save_options):
+    buffer = BytesIO()
+    Image.new(mode, size, color).save(buffer, format, **save_options)
+    return buffer.getvalue()
+
+
+class ImageDecodeTests(TestCase):
+    """Uploaded frames decode to upright RGB arrays, large JPEGs at reduced scale"""
+
+    def test_large_jpeg_decoded_in_draft_mode(self):
+        data = _encoded_image('RGB', (1600, 1200), 'JPEG', (200, 100, 50))
+        self.assertEqual(decode_image_bytes(data, max_dimension=400).shape, (300, 400, 3))
+        # No limit, or a frame already small enough, decodes at full size
+        self.assertEqual(decode_image_bytes(data, max_dimension=0).shape, (1200, 1600, 3))
+        self.assertEqual(decode_image_bytes(data, max_dimension=2000).shape, (1200, 1600, 3))
+
+    def test_png_not_reduced(self):
+        data = _encoded_image('RGB', (1600, 1200), 'PNG')
+        self.assertEqual(decode_image_bytes(data, max_dimension=400).shape, (1200, 1600, 3))
+
+    def test_exif_orientation_applied(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: stored rotated, display turned 90 degrees clockwise
+        data = _encoded_image('RGB', (40, 20), 'JPEG', exif=exif)
+        self.assertEqual(decode_image_bytes(data).shape, (40, 20, 3))
+
+    def test_converted_to_rgb(self):
+        for mode, color in (('RGBA', (10, 20, 30, 128)), ('L', 77)):
+            with self.subTest(mode=mode):
+                image = decode_image_bytes(_encoded_image(mode, (8, 6), 'PNG', color))
+                self.assertEqual(image.shape, (6, 8, 3))
+                self.assertEqual(image.dtype, np.uint8)
+                expected = color[:3] if mode == 'RGBA' else (color,) * 3
+                self.assertEqual(tuple(image[0, 0]), expected)
+
+    def test_data_url(self):
+        data = _encoded_image('L', (8, 6), 'PNG', 77)
+        face_data = 'data:image/png;base64,' + base64.b64encode(data).decode('ascii')
+        self.assertEqual(decode_face_data(face_data).shape, (6, 8, 3))
+        self.assertEqual(decode_face_data(base64.b64encode(data).decode('ascii')).shape, (6, 8, 3))
+
+
+class DetectorSelectionTests(TestCase):
+    """Each endpoint gets its configured backend, and bad configuration fails loudly"""
+
+    def setUp(self):
+        patcher = mock.patch.dict('authentication.detectors._instances', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(FACE_DETECTOR_BACKENDS={'default': 'hog', 'identify': 'cnn'})
+    def test_backend_per_endpoint(self):
+        self.assertIsInstance(get_detector('identify'), CnnDetector)
+        self.assertIsInstance(get_detector('login'), HogDetector)
+        self.assertIs(get_detector('default'), get_detector('login'))
+
+    @override_settings(FACE_DETECTOR_BACKENDS={})
+    def test_hog_when_unconfigured(self):
+        self.assertIsInstance(get_detector('login'), HogDetector)
+
+    @override_settings(FACE_DETECTOR_BACKENDS={'login': 'mtcnn'})
+    def test_unknown_backend(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "Unknown face detector backend 'mtcnn'"):
+            get_detector('login')
+
+    @override_settings(FACE_DETECTOR_BACKENDS={'login': 'yunet'},
+                       FACE_DETECTOR_OPTIONS={'yunet': {'model_path': '/nonexistent/yunet.onnx'}})
+    def test_unavailable_backend(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "needs FACE_DETECTOR_OPTIONS['yunet']['model_path']"):
+            get_detector('login')
+        # A broken backend is not cached, so fixing the settings takes effect
+        self.assertNotIn('yunet', detectors._instances)
+
+
+@override_settings(FACE_DETECTION_MAX_DIMENSION=320, FACE_DETECTION_UPSAMPLE=1, FACE_DETECTION_FALLBACK_UPSAMPLE=2)
+class FaceDetectionTests(TestCase):
+    """Detection tries a downscaled frame first and reports boxes at full resolution"""
+
+    image = np.zeros((480, 640, 3), dtype=np.uint8)
+
+    def detect(self, detector, image=None):
+        with mock.patch('authentication.face_utils.get_detector', return_value=detector):
+            return detect_faces(self.image if image is None else image)
+
+    def test_boxes_scaled_to_full_resolution(self):
+        detector = _StubDetector([(10, 60, 50, 20), (0, 320, 240, 300)])
+        boxes = self.detect(detector)
+        self.assertEqual(detector.calls, [((240, 320), 1)])
+        self.assertEqual(boxes, [(20, 120, 100, 40), (0, 640, 480, 600)])
+
+    def test_full_resolution_fallback(self):
+        detector = _StubDetector([], [(100, 300, 200, 200)])
+        self.assertEqual(self.detect(detector), [(100, 300, 200, 200)])
+        self.assertEqual(detector.calls, [((240, 320), 1), ((480, 640), 2)])
+
+    @override_settings(FACE_DETECTION_FALLBACK_UPSAMPLE=None)
+    def test_fallback_switched_off(self):
+        detector = _StubDetector([])
+        self.assertEqual(self.detect(detector), [])
+        self.assertEqual(len(detector.calls), 1)
+
+    def test_small_frame_single_pass(self):
+        detector = _StubDetector([(1, 2, 3, 0)])
+        self.assertEqual(self.detect(detector, np.zeros((240, 320, 3), dtype=np.uint8)), [(1, 2, 3, 0)])
+        self.assertEqual(detector.calls, [((240, 320), 2)])
+
+
+class LoginStatRollupTests(TestCase):
+    """Rollups add up large batches and survive a concurrently created bucket"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+
+    def records(self, count, start=datetime(2024, 1, 1, tzinfo=dt_timezone.utc)):
+        return [{'user_id': self.user.id, 'timestamp': start + timedelta(hours=i), 'successful': i % 3 != 0,
+                 'face_match_score': 0.5, 'ip_address': '10.0.0.1'} for i in range(count)]
+
+    def test_large_batch(self):
+        self.assertEqual(apply_rollup(self.records(3000)), 3000 + 125)
+        hours = LoginStat.objects.filter(user=self.user, granularity='hour')
+        self.assertEqual(hours.count(), 3000)
+        days = LoginStat.objects.filter(user=self.user, granularity='day')
+        self.assertEqual(sum(days.values_list('successes', flat=True)), 2000)
+        self.assertEqual(sum(days.values_list('failures', flat=True)), 1000)
+        # A second batch over the same buckets increments them
+        apply_rollup(self.records(3000))
+        self.assertEqual(hours.count(), 3000)
+        self.assertEqual(sum(days.values_list('successes', flat=True)), 4000)
+
+    @override_settings(LOGIN_STAT_MAX_IPS=3)
+    def test_ip_addresses_capped(self):
+        start = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+        apply_rollup([{'user_id': self.user.id, 'timestamp': start, 'ip_address': f'10.0.0.{i}'} for i in (5, 1)])
+        stat = LoginStat.objects.get(user=self.user, granularity='day')
+        self.assertEqual((stat.ip_addresses, stat.ips_truncated), (['10.0.0.1', '10.0.0.5'], False))
+        # The addresses seen first are kept; a repeat of one of them does not count as new
+        apply_rollup([{'user_id': self.user.id, 'timestamp': start, 'ip_address': f'10.0.0.{i}'} for i in (5, 9, 2, 3)])
+        stat.refresh_from_db()
+        self.assertEqual(stat.ip_addresses, ['10.0.0.1', '10.0.0.2', '10.0.0.5'])
+        self.assertTrue(stat.ips_truncated)
+        self.assertEqual(stat.failures, 6)
+        summary = login_stats.summarize(self.user, start)
+        self.assertEqual((summary['distinct_ips'], summary['distinct_ips_truncated']), (3, True))
+
+    def test_bucket_created_concurrently(self):
+        bucket = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+        LoginStat.objects.create(user=self.user, granularity='hour', bucket=bucket, successes=1)
+        lock_existing = login_stats._lock_existing
+        calls = []
+
+        def first_misses(keys):
+            # The first pass misses the row, as if another writer inserted it just after the lookup
+            calls.append(keys)
+            return {} if len(calls) == 1 else lock_existing(keys)
+
+        with mock.patch('authentication.login_stats._lock_existing', side_effect=first_misses):
+            apply_rollup(self.records(1))
+        self.assertEqual(len(calls), 2)
+        stat = LoginStat.objects.get(user=self.user, granularity='hour', bucket=bucket)
+        self.assertEqual(stat.successes, 1)
+        self.assertEqual(stat.failures, 1)
+        self.assertEqual(LoginStat.objects.get(user=self.user, granularity='day').failures, 1)
+
+
+@override_settings(FACE_POOL_WORKERS=0, FACE_IDENTIFY_RATE_LIMIT=2)
+class IdentifyFaceTests(TestCase):
+    """1:N identification is staff only and rate limited"""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.url = reverse('authentication:identify_face')
+        self.enrolled = User.objects.create_user('bob')
+        patcher = mock.patch('authentication.views.run_face_task', return_value=(np.zeros(128), None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('authentication.views.identify_face', return_value=[(self.enrolled.id, 0.2)])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self):
+        return self.client.post(self.url, json.dumps({'face_data': 'data:image/jpeg;base64,AAAA'}),
+                                content_type='application/json', HTTP_X_REQUESTED_WITH='XMLHttpRequest', secure=True)
+
+    def test_refused_without_staff(self):
+        self.assertEqual(self.post().status_code, 403)
+        self.client.force_login(User.objects.create_user('carol'))
+        self.assertEqual(self.post().status_code, 403)
+
+    def test_staff_identifies_until_rate_limited(self):
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        response = self.post()
+        self.assertEqual(response.json()['matches'], [{'username': 'bob', 'score': 80.0}])
+        self.assertEqual(self.post().status_code, 200)
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+
+class ServerTimingTests(TestCase):
+    """Stage timings are only sent to clients when switched on"""
+
+    def test_header_off_by_default(self):
+        response = self.client.get(reverse('authentication:login'), secure=True)
+        self.assertNotIn('Server-Timing', response)
+
+    def test_header_when_enabled(self):
+        with override_settings(SERVER_TIMING_HEADER=True):
+            response = self.client.get(reverse('authentication:login'), secure=True)
+        self.assertIn('total;dur=', response['Server-Timing'])
+
+
+class IVFIndexTests(TestCase):
+    """The IVF index finds near neighbours, with and without PQ, and tracks adds and removes"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(20, 32))
+        cls.vectors = (centers[rng.integers(0, 20, 2000)] + 0.3 * rng.normal(size=(2000, 32))).astype(np.float32)
+        cls.ids = np.arange(2000) + 100
+        cls.queries = cls.vectors[:100] + 0.01 * rng.normal(size=(100, 32)).astype(np.float32)
+
+    def recall(self, index, k):
+        return np.mean([self.ids[i] in index.search(query, k)[0] for i, query in enumerate(self.queries)])
+
+    def test_flat_recall(self):
+        index = IVFIndex.train(self.vectors, 16, nprobe=4)
+        index.add(self.ids, self.vectors)
+        self.assertEqual(len(index), 2000)
+        self.assertGreaterEqual(self.recall(index, 1), 0.95)
+
+    def test_pq_recall(self):
+        index = IVFIndex.train(self.vectors, 16, pq_m=8, nprobe=4)
+        index.add(self.ids, self.vectors)
+        self.assertGreaterEqual(self.recall(index, 10), 0.9)
+
+    def test_add_and_remove(self):
+        index = IVFIndex.train(self.vectors, 16, nprobe=16)
+        index.add(self.ids[:50], self.vectors[:50])
+        self.assertTrue(index.remove(100))
+        self.assertFalse(index.remove(100))
+        self.assertNotIn(100, index)
+        self.assertNotIn(100, index.search(self.vectors[0], 49)[0])
+        # Every other entry is still found after the swap-removal
+        for i in range(1, 50):
+            self.assertEqual(index.search(self.vectors[i], 1)[0][0], self.ids[i])
+        # Re-adding an id moves it rather than duplicating it
+        index.add([101], self.vectors[:1])
+        self.assertEqual(len(index), 49)
+        self.assertEqual(index.search(self.vectors[0], 1)[0][0], 101)
+
+    def test_save_and_load(self):
+        index = IVFIndex.train(self.vectors, 16, pq_m=8)
+        with tempfile.NamedTemporaryFile(suffix='.npz') as f:
+            index.save(f.name)
+            loaded = IVFIndex.load(f.name)
+        np.testing.assert_array_equal(loaded.centroids, index.centroids)
+        np.testing.assert_array_equal(loaded.pq.codebooks, index.pq.codebooks)
+        self.assertEqual(len(loaded), 0)
+
+
+class EncodingFormatTests(TestCase):
+    """Packed encodings round-trip and bad bytes are rejected"""
+
+    def test_round_trip(self):
+        encoding = np.linspace(-1, 1, 128)
+        data = pack_encoding(encoding)
+        self.assertEqual(len(data), 8 + 128 * 4)
+        unpacked = unpack_encoding(data)
+        self.assertEqual(unpacked.dtype, np.float32)
+        np.testing.assert_allclose(unpacked, encoding, rtol=1e-6)
+        self.assertFalse(unpacked.flags.writeable)
+
+    def test_templates_round_trip(self):
+        templates = make_templates([np.full(128, 0.2), np.full(128, 0.4)])
+        unpacked = unpack_templates(pack_templates(templates))
+        np.testing.assert_allclose(unpacked.mean, np.full(128, 0.3), rtol=1e-6)
+        self.assertEqual(unpacked.encodings.shape, (2, 128))
+
+    def test_rejects_bad_data(self):
+        data = pack_encoding(np.zeros(128))
+        for bad in (None, b'', data[:-4], b'XXXX' + data[4:], data[:4] + b'\x09' + data[5:]):
+            with self.assertRaises(EncodingFormatError):
+                unpack_encoding(bad)
+
+
+class GalleryFileTests(TestCase):
+    """The append-only gallery keeps the latest record per user, across readers and compaction"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'gallery.bin')
+
+    def vector(self, value):
+        return np.full(128, value, dtype=np.float32)
+
+    def test_latest_record_wins(self):
+        gallery = GalleryFile(self.path)
+        gallery.append(1, self.vector(0.1))
+        gallery.append(2, self.vector(0.2))
+        gallery.append(1, self.vector(0.3))
+        gallery.delete(2)
+        self.assertAlmostEqual(float(gallery.get(1)[0]), 0.3, places=6)
+        self.assertIsNone(gallery.get(2))
+        user_ids, encodings = gallery.snapshot()
+        self.assertEqual(user_ids.tolist(), [1])
+        self.assertEqual(encodings.shape, (1, 128))
+
+    def test_other_reader_sees_appends_and_compaction(self):
+        writer, reader = GalleryFile(self.path), GalleryFile(self.path)
+        writer.append(1, self.vector(0.1))
+        position, _ = reader.changes_since(None)
+        writer.append(2, self.vector(0.2))
+        writer.append(1, self.vector(0.3))
+        position, changed = reader.changes_since(position)
+        self.assertEqual(changed, [2, 1])
+        self.assertEqual(writer.compact(), 2)
+        # A compacted file is a new file: readers re-read it all
+        _, changed = reader.changes_since(position)
+        self.assertIsNone(changed)
+        self.assertEqual(len(reader), 2)
+        self.assertAlmostEqual(float(reader.get(1)[0]), 0.3, places=6)
+        self.assertEqual(os.path.getsize(self.path), HEADER_SIZE + 2 * record_dtype(128).itemsize)
+
+    def test_concurrent_appends_stay_aligned(self):
+        def append_many(start):
+            gallery = GalleryFile(self.path)
+            for user_id in range(start, start + 50):
+                gallery.append(user_id, self.vector(user_id / 1000))
+
+        threads = [threading.Thread(target=append_many, args=(start,)) for start in range(0, 200, 50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        gallery = GalleryFile(self.path)
+        gallery.refresh()
+        self.assertEqual(len(gallery), 200)
+        self.assertAlmostEqual(float(gallery.get(123)[0]), 0.123, places=6)
+
+    def test_torn_record_is_dropped(self):
+        gallery = GalleryFile(self.path)
+        gallery.append(1, self.vector(0.1))
+        with open(self.path, 'ab') as f:
+            f.write(b'\0' * 10)
+        gallery.append(2, self.vector(0.2))
+        reader = GalleryFile(self.path)
+        reader.refresh()
+        self.assertEqual(len(reader), 2)
+        self.assertAlmostEqual(float(reader.get(2)[0]), 0.2, places=6)
+
+    def test_loaded_gallery_follows_other_workers(self):
+        with override_settings(FACE_GALLERY_FILE=self.path), \
+                mock.patch('authentication.gallery._gallery', FaceGallery()), \
+                mock.patch('authentication.gallery._store_position', None):
+            loaded = get_gallery()
+            writer = GalleryFile(self.path)
+            for user_id in range(1, 101):
+                writer.append(user_id, self.vector(user_id / 1000))
+            # Requests refreshing at once apply each appended record once
+            threads = [threading.Thread(target=get_gallery) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(loaded), 100)
+            self.assertEqual(loaded.search(self.vector(0.05), 1)[0][0], 50)
+            writer.delete(50)
+            self.assertNotIn(50, get_gallery())
+
+
+class EncodingCacheTests(TestCase):
+    """The template cache expires entries, evicts the least recently used and follows profile changes"""
+
+    def test_ttl(self):
+        cache = EncodingCache(max_size=10, ttl=60)
+        with mock.patch('authentication.encoding_cache.time.monotonic', return_value=1000.0):
+            cache.set(1, 'one')
+        with mock.patch('authentication.encoding_cache.time.monotonic', return_value=1059.0):
+            self.assertEqual(cache.get(1), 'one')
+        with mock.patch('authentication.encoding_cache.time.monotonic', return_value=1061.0):
+            self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = EncodingCache(max_size=2, ttl=60)
+        cache.set(1, 'one')
+        cache.set(2, 'two')
+        cache.get(1)
+        cache.set(3, 'three')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), 'one')
+        self.assertEqual(cache.get(3), 'three')
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+
+    @override_settings(FACE_ENCODING_CACHE_ALIAS='default')
+    def test_profile_change_invalidates_both_tiers(self):
+        caches['default'].clear()
+        encoding_cache.get_local_cache().clear()
+        user = User.objects.create_user('alice')
+        add_template(user.id, np.full(128, 0.1))
+        encoding_cache.get_user_templates(user.id)
+        self.assertIsNotNone(caches['default'].get(encoding_cache._shared_key(user.id)))
+        with self.assertNumQueries(0):
+            encoding_cache.get_user_templates(user.id)
+        # Another process finds the templates in the shared tier
+        encoding_cache.get_local_cache().clear()
+        with self.assertNumQueries(0):
+            encoding_cache.get_user_templates(user.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            add_template(user.id, np.full(128, 0.3))
+        self.assertIsNone(encoding_cache.get_local_cache().get(user.id))
+        self.assertIsNone(caches['default'].get(encoding_cache._shared_key(user.id)))
+        self.assertAlmostEqual(float(encoding_cache.get_user_encoding(user.id)[0]), 0.2, places=6)
+
+
+@override_settings(KEY_POOL_BACKGROUND_REFILL=False)
+class CryptoUtilsTests(TestCase):
+    """Every signature algorithm round-trips, and parsed keys follow key rotation"""
+
+    def test_sign_and_verify(self):
+        for algorithm in ('rsa-pkcs1v15', 'ed25519', 'ecdsa-p256'):
+            with self.subTest(algorithm=algorithm):
+                public_key, private_key = generate_key_pair(algorithm)
+                signature = sign_data(private_key, 'token', algorithm)
+                self.assertTrue(verify_signature(public_key, 'token', signature, algorithm))
+                with self.assertLogs('authentication.crypto_utils', 'WARNING'):
+                    self.assertFalse(verify_signature(public_key, 'other token', signature, algorithm))
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(ValueError):
+            get_algorithm('dsa')
+
+    def test_parsed_key_cache(self):
+        cache = _ParsedKeyCache(2)
+        loader = mock.Mock(side_effect=lambda: object())
+        first = cache.get_or_load((1, 'public', 'a'), loader)
+        self.assertIs(cache.get_or_load((1, 'public', 'a'), loader), first)
+        self.assertEqual(loader.call_count, 1)
+        # A new fingerprint for the same user is parsed afresh
+        self.assertIsNot(cache.get_or_load((1, 'public', 'b'), loader), first)
+        cache.get_or_load((2, 'public', 'a'), loader)
+        cache.get_or_load((1, 'public', 'a'), loader)
+        self.assertEqual(loader.call_count, 4)
+
+    def test_rotated_key_not_served_stale(self):
+        old_public_key, old_private_key = generate_key_pair('ed25519')
+        new_public_key, new_private_key = generate_key_pair('ed25519')
+        signature = sign_data(old_private_key, 'token', 'ed25519', user_id=1)
+        self.assertTrue(verify_signature(old_public_key, 'token', signature, 'ed25519', user_id=1))
+        signature = sign_data(new_private_key, 'token', 'ed25519', user_id=1)
+        self.assertTrue(verify_signature(new_public_key, 'token', signature, 'ed25519', user_id=1))
+        with self.assertLogs('authentication.crypto_utils', 'WARNING'):
+            self.assertFalse(verify_signature(old_public_key, 'token', signature, 'ed25519', user_id=1))
+
+
+class KeyPoolTests(TestCase):
+    """Each pooled key pair is handed out once, even to concurrent claims"""
+
+    def setUp(self):
+        self.algorithm = preferred_algorithm()
+        store_key_pairs([(f'public-{i}', f'private-{i}') for i in range(10)], self.algorithm)
+
+    def test_claim_racing_another_request(self):
+        manager = PregeneratedKeyPair.objects
+        real_filter = manager.filter
+        rival = []
+
+        def filter_with_rival(*args, **kwargs):
+            if 'id' in kwargs and not rival:
+                # Another request claims every candidate between our SELECT and our DELETE
+                rival.append(None)
+                rival.extend(claim_key_pair(self.algorithm) for _ in range(key_pool.CLAIM_CANDIDATES))
+            return real_filter(*args, **kwargs)
+
+        with mock.patch.object(manager, 'filter', side_effect=filter_with_rival):
+            pair = claim_key_pair(self.algorithm)
+        claimed = rival[1:] + [pair]
+        self.assertEqual(len(set(claimed)), key_pool.CLAIM_CANDIDATES + 1)
+        self.assertEqual(pool_size(self.algorithm), 10 - len(claimed))
+
+    def test_empty_pool_generates_inline(self):
+        claimed = {claim_key_pair(self.algorithm) for _ in range(10)}
+        self.assertEqual(len(claimed), 10)
+        with mock.patch('authentication.key_pool.generate_key_pair', return_value=('public', 'private')) as generate:
+            self.assertEqual(claim_key_pair(self.algorithm), ('public', 'private'))
+        generate.assert_called_once_with(self.algorithm)
+
+
+class _ManualExecutor:
+    """Stands in for the process pool: each task finishes only when the test says so"""
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+
+class FacePoolTests(TestCase):
+    """The face pool sheds load when full or slow and always gives its slots back"""
+
+    def make_pool(self, workers=1, max_queue=1, timeout=None):
+        pool = FaceWorkPool(workers, max_queue, timeout)
+        executor = _ManualExecutor()
+        patcher = mock.patch.object(pool, '_get_executor', return_value=executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return pool, executor
+
+    def test_full_queue_rejected(self):
+        pool, executor = self.make_pool()
+        pool._submit(abs, (1,), {})
+        pool._submit(abs, (1,), {})
+        self.assertEqual(pool.queue_depth, 1)
+        with self.assertRaises(FacePoolBusy):
+            pool.run(abs, 1)
+        self.assertEqual(len(executor.futures), 2)
+        # A finished task frees its slot for the next request
+        executor.futures[0].set_result((time.time(), 1, []))
+        pool._submit(abs, (1,), {})
+        self.assertEqual(pool.in_flight, 2)
+
+    def test_timeout_keeps_slot_until_worker_finishes(self):
+        pool, executor = self.make_pool(max_queue=0, timeout=0.01)
+        with self.assertRaises(FacePoolBusy):
+            pool.run(abs, 1)
+        self.assertEqual(pool.in_flight, 1)
+        with self.assertRaises(FacePoolBusy):
+            pool.run(abs, 1)
+        executor.futures[0].set_result((time.time(), 1, []))
+        self.assertEqual(pool.in_flight, 0)
+        self.assertTrue(pool._slots.acquire(blocking=False))
+
+    def test_slot_released_after_exception(self):
+        pool, executor = self.make_pool(max_queue=0)
+        with mock.patch.object(executor, 'submit', side_effect=RuntimeError('pool broken')):
+            with self.assertRaises(RuntimeError):
+                pool.run(abs, 1)
+        self.assertEqual(pool.in_flight, 0)
+
+        failed = Future()
+        failed.set_exception(ValueError('bad image'))
+        with mock.patch.object(executor, 'submit', return_value=failed):
+            with self.assertRaises(ValueError):
+                pool.run(abs, 1)
+        self.assertEqual(pool.in_flight, 0)
+        self.assertTrue(pool._slots.acquire(blocking=False))
+
+    def test_timeout_answers_503(self):
+        pool, _ = self.make_pool(timeout=0.01)
+        User.objects.create_user('alice')
+        with mock.patch('authentication.face_pool.get_face_pool', return_value=pool), \
+                mock.patch('authentication.views.get_user_templates', return_value=object()):
+            response = self.client.post(reverse('authentication:verify_face'),
+                                        data=json.dumps({'username': 'alice', 'face_data': 'frame'}),
+                                        content_type='application/json', HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        secure=True)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '2')
+        self.assertTrue(response.json()['retry'])
+
+    @override_settings(FACE_POOL_WORKERS=0)
+    def test_inline_without_workers(self):
+        self.assertIsNone(get_face_pool())
+        caller = threading.get_ident()
+        self.assertEqual(run_face_task(lambda x: (x, threading.get_ident()), 1), (1, caller))
+
+
+class EnrollFacesTests(TestCase):
+    """Bulk enrollment checkpoints each batch, resumes, skips existing users and reports failures"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.source = os.path.join(self.directory, 'faces')
+        os.mkdir(self.source)
+        for username in ('alice', 'bob', 'carol', 'blurry'):
+            open(os.path.join(self.source, f'{username}.jpg'), 'wb').close()
+        self.encoded = []
+        patcher = mock.patch('authentication.management.commands.enroll_faces.encode_entry', side_effect=self.encode)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Keep the shared gallery file out of the test
+        patcher = mock.patch('authentication.management.commands.enroll_faces.update_user_encoding')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def encode(self, entry, with_keys=True):
+        self.encoded.append(entry['username'])
+        if entry['username'] == 'blurry':
+            return entry, None, None, "No face detected in the image"
+        return entry, pack_encoding(np.full(128, 0.1)), None, None
+
+    def enroll(self, **options):
+        stdout = StringIO()
+        call_command('enroll_faces', self.source, workers=0, batch_size=2, no_keys=True, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def key(self, username):
+        return os.path.join(self.source, f'{username}.jpg')
+
+    def test_enroll_and_report_failures(self):
+        output = self.enroll()
+        self.assertIn('Enrolled 3, skipped 0 existing, failed 1', output)
+        self.assertEqual(set(UserProfile.objects.filter(has_face_data=True).values_list('user__username', flat=True)),
+                         {'alice', 'bob', 'carol'})
+        self.assertEqual(FaceTemplate.objects.filter(source='enrollment').count(), 3)
+        with open(f'{self.source}.failures.csv') as f:
+            rows = f.read().splitlines()
+        self.assertEqual(rows, ['image,username,error', f'{self.key("blurry")},blurry,No face detected in the image'])
+        # One line per image, appended batch by batch
+        with open(f'{self.source}.checkpoint.jsonl') as f:
+            self.assertEqual(sorted(json.loads(line) for line in f),
+                             sorted(self.key(name) for name in ('alice', 'blurry', 'bob', 'carol')))
+
+    def test_resume_from_checkpoint(self):
+        with open(f'{self.source}.checkpoint.jsonl', 'w') as f:
+            f.write(json.dumps(self.key('alice')) + '\n' + json.dumps(self.key('bob')) + '\n"' + self.source)
+        output = self.enroll()
+        self.assertIn('Resuming: 2 images already processed', output)
+        self.assertEqual(sorted(self.encoded), ['blurry', 'carol'])
+        self.assertFalse(User.objects.filter(username__in=['alice', 'bob']).exists())
+        # A second run finds everything done, even past the torn line
+        self.encoded.clear()
+        self.assertIn('Enrolled 0', self.enroll())
+        self.assertEqual(self.encoded, [])
+
+    def test_restart_ignores_checkpoint(self):
+        self.enroll()
+        self.encoded.clear()
+        self.enroll(restart=True)
+        self.assertEqual(sorted(self.encoded), ['alice', 'blurry', 'bob', 'carol'])
+
+    def test_existing_users_skipped(self):
+        User.objects.create_user('alice')
+        self.assertIn('Enrolled 2, skipped 1 existing', self.enroll())
+        self.assertFalse(UserProfile.objects.get(user__username='alice').has_face_data)
+
+        self.assertIn('Enrolled 3, skipped 0 existing', self.enroll(restart=True, update_existing=True))
+        self.assertTrue(UserProfile.objects.get(user__username='alice').has_face_data)
+
+
+@override_settings(LOGIN_LOG_RETENTION_DAYS=30)
+class RetentionTests(TestCase):
+    """Old records are purged in chunks, and a dry run only counts them"""
+
+    def setUp(self):
+        user = User.objects.create_user('alice')
+        now = timezone.now()
+        LoginLog.objects.bulk_create(
+            [LoginLog(user=user, timestamp=now - timedelta(days=40 + i)) for i in range(25)]
+            + [LoginLog(user=user, timestamp=now - timedelta(days=i)) for i in range(5)]
+        )
+        DigitalSignature.objects.create(user=user, expires_at=now - timedelta(minutes=1))
+        DigitalSignature.objects.create(user=user, expires_at=now + timedelta(minutes=5))
+
+    def test_purge_in_chunks(self):
+        progress = []
+        deleted, _ = purge_in_chunks(old_login_logs(), chunk_size=10, progress=progress.append)
+        self.assertEqual(deleted, 25)
+        self.assertEqual(progress, [10, 20, 25])
+        self.assertEqual(LoginLog.objects.count(), 5)
+        self.assertEqual(purge_in_chunks(expired_signatures())[0], 1)
+        self.assertEqual(DigitalSignature.objects.count(), 1)
+
+    def test_dry_run(self):
+        self.assertEqual(purge_in_chunks(old_login_logs(), chunk_size=10, dry_run=True)[0], 25)
+        self.assertEqual(LoginLog.objects.count(), 30)
+
+
+class LoginLogWriterTests(TestCase):
+    """Batches that cannot be written are spooled to disk and replayed after the next good flush"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.spool_path = os.path.join(directory, 'spool.jsonl')
+        self.writer = LoginLogWriter(batch_size=100, flush_interval=3600, spool_path=self.spool_path)
+        self.addCleanup(self.stop_writer)
+        # A failed flush drops the connection; inside a test transaction that would poison it
+        patcher = mock.patch('authentication.log_writer.connection')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stop_writer(self):
+        self.writer._stopped = True
+        self.writer._wakeup.set()
+        if self.writer._thread is not None:
+            self.writer._thread.join()
+
+    def record(self, successful):
+        self.writer.record(user_id=self.user.id, successful=successful, ip_address='10.0.0.1')
+
+    def test_flush_writes_batch_and_rollup(self):
+        self.record(True)
+        self.record(False)
+        self.assertEqual(self.writer.flush(), 2)
+        self.assertEqual(LoginLog.objects.filter(user=self.user).count(), 2)
+        day = LoginStat.objects.get(user=self.user, granularity='day')
+        self.assertEqual((day.successes, day.failures), (1, 1))
+
+    def test_failed_flush_is_spooled_and_replayed(self):
+        self.record(False)
+        with mock.patch.object(LoginLog.objects, 'bulk_create', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('authentication.log_writer', 'ERROR'):
+            self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(LoginLog.objects.count(), 0)
+        with open(self.spool_path) as f:
+            self.assertEqual(json.loads(f.readline())['user_id'], self.user.id)
+
+        self.record(True)
+        self.assertEqual(self.writer.flush(), 1)
+        self.assertEqual(LoginLog.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(os.listdir(os.path.dirname(self.spool_path)), [])
+        self.assertEqual(LoginStat.objects.get(user=self.user, granularity='day').failures, 1)
+
+    def write_abandoned(self, pid, timestamps):
+        path = f'{self.spool_path}.{pid}.replay'
+        with open(path, 'w') as f:
+            for timestamp in timestamps:
+                f.write(json.dumps({'user_id': self.user.id, 'successful': False, 'timestamp': timestamp.isoformat()})
+                        + '\n')
+            f.write('{"user_id": ')
+        return path
+
+    def test_abandoned_replay_is_recovered_once(self):
+        now = timezone.now()
+        # The crashed process had inserted its first record before it died
+        LoginLog.objects.create(user=self.user, timestamp=now)
+        self.write_abandoned(999999, [now, now + timedelta(seconds=1)])
+        self.record(True)
+        with mock.patch('authentication.log_writer.os.kill', side_effect=ProcessLookupError), \
+                self.assertLogs('authentication.log_writer', 'WARNING'):
+            self.assertEqual(self.writer.flush(), 1)
+        self.assertEqual(LoginLog.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(LoginLog.objects.filter(user=self.user, timestamp=now).count(), 1)
+        self.assertEqual(os.listdir(os.path.dirname(self.spool_path)), [])
+
+    def test_replay_of_live_process_left_alone(self):
+        path = self.write_abandoned(999999, [timezone.now()])
+        self.record(True)
+        with mock.patch('authentication.log_writer.os.kill', return_value=None):
+            self.assertEqual(self.writer.flush(), 1)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(LoginLog.objects.filter(user=self.user).count(), 1)
+
+
+@override_settings(MAX_FAILED_LOGIN_ATTEMPTS=3, LOGIN_IP_MAX_FAILED_ATTEMPTS=5, LOCKOUT_TIME_MINUTES=1,
+                   LOGIN_FAILURE_WINDOW_SECONDS=None)
+class RateLimitTests(TestCase):
+    """Failures are counted in a sliding window and lock the username or IP at the limit"""
+
+    def setUp(self):
+        caches['default'].clear()
+        # Only the limiter's clock: the cache backends keep expiring entries in real time
+        patcher = mock.patch('authentication.rate_limit.time')
+        self.clock = patcher.start().time
+        self.clock.return_value = 1000.0
+        self.addCleanup(patcher.stop)
+
+    def test_window_rollover(self):
+        counter = SlidingWindowCounter(caches['default'], 'test', 60)
+        counter.hit('a')
+        self.assertEqual(counter.hit('a'), 2)
+        # 10s into the next window: the previous one still overlaps by 5/6
+        self.clock.return_value = 1030.0
+        self.assertAlmostEqual(counter.count('a'), 2 * 50 / 60)
+        self.assertAlmostEqual(counter.hit('a'), 1 + 2 * 50 / 60)
+        # Two windows on, the old hits have aged out
+        self.clock.return_value = 1150.0
+        self.assertEqual(counter.count('a'), 0)
+
+    def test_user_lockout_and_expiry(self):
+        self.assertFalse(record_login_failure('alice', '10.0.0.1'))
+        self.assertFalse(record_login_failure('alice', '10.0.0.1'))
+        self.assertTrue(record_login_failure('alice', '10.0.0.1'))
+        allowed, scope, retry_after = check_login_allowed('alice', '10.0.0.2')
+        self.assertEqual((allowed, scope), (False, 'user'))
+        self.assertEqual(retry_after, 61)
+        self.assertEqual(lockout_remaining('alice'), 61)
+        self.assertTrue(check_login_allowed('bob', '10.0.0.1')[0])
+        self.clock.return_value = 1061.0
+        self.assertTrue(check_login_allowed('alice', '10.0.0.2')[0])
+
+    def test_ip_lockout(self):
+        for username in ('a', 'b', 'c', 'd', 'e'):
+            self.assertFalse(record_login_failure(username, '10.0.0.9'))
+        self.assertEqual(check_login_allowed('f', '10.0.0.9')[:2], (False, 'ip'))
+        self.assertTrue(check_login_allowed('f', '10.0.0.8')[0])
+
+    def test_flood_does_not_lift_lock(self):
+        for _ in range(3):
+            record_login_failure('victim', None)
+        # Enough junk keys to push the lock out of an evicting local-memory cache
+        for i in range(400):
+            record_login_failure(f'junk{i}', f'10.1.{i // 256}.{i % 256}')
+        self.assertFalse(check_login_allowed('victim', None)[0])
+
+    def test_local_memory_store_refused(self):
+        check_cache_backend()
+        with override_settings(LOGIN_RATE_LIMIT_CACHE_ALIAS='default'), self.assertRaises(ImproperlyConfigured):
+            check_cache_backend()
+
+    def test_client_ip_from_trusted_proxies_only(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='192.0.2.1', HTTP_X_FORWARDED_FOR='6.6.6.6, 203.0.113.5')
+        self.assertEqual(get_client_ip(request), '192.0.2.1')
+        with override_settings(TRUSTED_PROXY_COUNT=1):
+            self.assertEqual(get_client_ip(request), '203.0.113.5')
+        with override_settings(TRUSTED_PROXY_COUNT=3):
+            self.assertEqual(get_client_ip(request), '192.0.2.1')
+
+    def test_unlock_and_success_reset(self):
+        for _ in range(3):
+            record_login_failure('alice', None)
+        unlock('alice')
+        self.assertTrue(check_login_allowed('alice', None)[0])
+        # The count starts afresh after an unlock, and after a successful login
+        record_login_failure('alice', None)
+        record_login_failure('alice', None)
+        record_login_success('alice')
+        self.assertFalse(record_login_failure('alice', None))
+        self.assertFalse(record_login_failure('alice', None))
+        self.assertTrue(check_login_allowed('alice', None)[0])
@@ -0,0 +1,81 @@
+"""Named timing spans for the stages of a request
+
+Wrap a stage in ``with span('detect'):``. Every span is observed into the
+``stage_duration_seconds`` histogram, labelled by stage. Inside ``collect()``
+(which ``ServerTimingMiddleware`` opens around each request) durations are also
+summed per name, so the response can carry them in a ``Server-Timing`` header.
+
+The active collector is a context variable, so it follows the request into
+``sync_to_async`` threads and async tasks. Face pool workers run in other
+processes; they collect their own spans, which ``face_pool`` merges back into
+the request. Database queries are timed as the ``db`` stage on every connection.
+
+A span costs two ``perf_counter`` calls and a histogram update; cheap enough
+to leave on in production.
+"""
+import contextvars
+import time
+from contextlib import contextmanager
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import metrics
+
+stage_seconds = metrics.histogram('stage_duration_seconds', "Time spent in each instrumented stage, by stage")
+
+_spans = contextvars.ContextVar('timing_spans', default=None)
+
+
+def record(name, seconds):
+    """Record a finished span of ``seconds``"""
+    stage_seconds.observe(seconds, stage=name)
+    spans = _spans.get()
+    if spans is not None:
+        spans[name] = spans.get(name, 0.0) + seconds
+
+
+def merge(spans):
+    """Record spans collected elsewhere, e.g. in a face pool worker"""
+    for name, seconds in spans.items():
+        record(name, seconds)
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block as stage ``name``"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+@contextmanager
+def collect():
+    """Gather the spans recorded in this context; yields a ``{name: seconds}`` dict"""
+    spans = {}
+    token = _spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _spans.reset(token)
+
+
+def current():
+    """The spans collected so far in this context, or None outside ``collect()``"""
+    return _spans.get()
+
+
+def _time_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record('db', time.perf_counter() - started)
+
+
+@receiver(connection_created)
+def _install_query_timer(sender, connection, **kwargs):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
@@ -7,8 +7,15 @@ urlpatterns = [
     path('', views.login_view, name='login'),
     path('register/', views.register_view, name='register'),
     path('login/', views.login_view, name='login'),
+    path('login/async/', views.login_async_view, name='login_async'),
     path('logout/', views.logout_view, name='logout'),
     path('dashboard/', views.dashboard_view, name='dashboard'),
     path('profile/', views.profile_view, name='profile'),
     path('verify-face/', views.verify_face_view, name='verify_face'),
+    path('verify-face/async/', views.verify_face_async_view, name='verify_face_async'),
+    path('verify-face/burst/', views.verify_face_burst_view, name='verify_face_burst'),
+    path('identify-face/', views.identify_face_view, name='identify_face'),
+    path('metrics/', views.metrics_view, name='metrics'),
+    path('profiles/', views.profiles_view, name='profiles'),
+    path('profiles/<str:name>/', views.profile_download_view, name='profile_download'),
 ]
\ No newline at end of file
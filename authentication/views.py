@@ -1,35 +1,70 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.contrib.auth import login, authenticate, logout
+from django.contrib.auth import login, logout
+from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.utils import timezone
-from django.http import JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden, JsonResponse
 from django.views.decorators.http import require_POST
 from django.conf import settings
+from asgiref.sync import sync_to_async
 from datetime import timedelta
+import itertools
 import json
-import base64
 import logging
 
 from .forms import CustomUserCreationForm, CustomAuthenticationForm, UserProfileForm
-from .models import UserProfile, LoginLog, DigitalSignature
-from .face_utils import process_face_image, compare_faces
-from .crypto_utils import create_login_challenge, sign_login_challenge, verify_login_signature , generate_key_pair
+from .models import UserProfile, FaceTemplate, LoginLog, DigitalSignature
+from .face_utils import extract_face_data, compare_face_data, match_face_data
+from .burst import verify_burst, averify_burst
+from .face_pool import FacePoolBusy, run_face_task, run_face_task_async
+from .gallery import identify_face
+from .encoding_cache import get_user_templates, aget_user_templates
+from .face_templates import add_template, replace_templates, learn_from_login
+from .crypto_utils import (create_login_challenge, sign_login_challenge, verify_login_signature, preferred_algorithm,
+                           create_signed_challenge, CHALLENGE_SESSION_KEY)
+from .key_pool import claim_key_pair
+from .log_writer import record_login
+from .rate_limit import check_login_allowed, check_identify_allowed, record_login_failure, record_login_success
+from .login_stats import summarize as summarize_logins
+from .timing import span
+from .profiling import note as note_profile
+from . import profiling
+from . import metrics
 logger = logging.getLogger(__name__)
+
+BUSY_MESSAGE = "The server is busy verifying other faces. Please try again in a moment."
+
+# The login views check passwords themselves, under the same rules as ModelBackend
+LOGIN_BACKEND_PATH = 'django.contrib.auth.backends.ModelBackend'
+LOGIN_BACKEND = ModelBackend()
+
+def _retry_later(response):
+    """Mark a response as a retryable 503 caused by face processing load shedding"""
+    response.status_code = 503
+    response['Retry-After'] = str(getattr(settings, 'FACE_POOL_RETRY_AFTER', 2))
+    return response
+
 def register_view(request):
     if request.method == 'POST':
         form = CustomUserCreationForm(request.POST, request.FILES)
         if form.is_valid():
             user = form.save()
             
-            # Generate key pair for the new user
+            # Take a pre-generated key pair for the new user
             try:
-                public_key, private_key = generate_key_pair()
+                algorithm = preferred_algorithm()
+                public_key, private_key = claim_key_pair(algorithm)
                 
-                # Get or create profile
-                profile, created = UserProfile.objects.get_or_create(user=user)
+                # Use the profile cached on the user, so the face save below keeps the new keys
+                try:
+                    profile = user.profile
+                except UserProfile.DoesNotExist:
+                    profile = UserProfile.objects.create(user=user)
                 profile.public_key = public_key
                 profile.private_key = private_key
+                profile.key_algorithm = algorithm
                 profile.save()
             except Exception as e:
                 logger.error(f"Key generation failed during registration: {str(e)}")
@@ -38,36 +73,19 @@ def register_view(request):
             # Process face image if provided
             if 'face_data' in request.POST and request.POST['face_data']:
                 try:
-                    # Process base64 data from webcam
-                    face_data = request.POST['face_data']
-                    format, imgstr = face_data.split(';base64,')
-                    face_image = base64.b64decode(imgstr)
-                    
-                    # Create a BytesIO object
-                    from io import BytesIO
-                    import tempfile
-                    from PIL import Image
-                    
-                    img = Image.open(BytesIO(face_image))
-                    temp_file = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-                    img.save(temp_file.name)
-                    
                     # Process the face image
-                    encoding_bytes, error = process_face_image(temp_file.name)
+                    encoding, error = run_face_task(extract_face_data, request.POST['face_data'], 'register')
                     
                     if error:
                         messages.error(request, error)
                     else:
-                        # Save the face encoding
-                        user_profile = user.profile
-                        user_profile.face_encoding = encoding_bytes
-                        user_profile.save()
+                        # Save the face as the first enrollment template
+                        add_template(user.id, encoding, profile=user.profile)
                         messages.success(request, "Face registered successfully!")
                     
-                    # Clean up the temp file
-                    import os
-                    os.unlink(temp_file.name)
-                    
+                except FacePoolBusy:
+                    # The account exists already; the face can be added from the profile page
+                    messages.warning(request, "Face registration is busy right now. You can add your face from your profile.")
                 except Exception as e:
                     messages.error(request, f"Error processing face image: {str(e)}")
             
@@ -79,151 +97,133 @@ def register_view(request):
     
     return render(request, 'authentication/register.html', {'form': form})
 
-def login_view(request):
-    if request.user.is_authenticated:
-        return redirect('authentication:dashboard')
-        
-    if request.method == 'POST':
-        form = CustomAuthenticationForm(request, data=request.POST)
-        
-        username = request.POST.get('username')
-        password = request.POST.get('password')
-        face_data = request.POST.get('face_data')
-        
-        # Basic validation
-        if not username or not password:
-            messages.error(request, "Please provide username and password.")
-            return render(request, 'authentication/login.html', {'form': form})
-        
-        # Get user
-        from django.contrib.auth.models import User
-        try:
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
+def _login_form(request):
+    # Left unbound: a bound AuthenticationForm runs authenticate() again when the template reads its errors
+    return CustomAuthenticationForm(request, initial={'username': request.POST.get('username', '')})
+
+def _render_login(request, form):
+    return render(request, 'authentication/login.html', {'form': form})
+
+def _check_login_password(request, form):
+    """Validate the credentials and lockout state; return ``(user, profile, error_response)``"""
+    username = request.POST.get('username')
+    password = request.POST.get('password')
+    
+    # Basic validation
+    if not username or not password:
+        messages.error(request, "Please provide username and password.")
+        return None, None, _render_login(request, form)
+    
+    # Refuse locked usernames and IPs before any database or password hashing work
+    ip_address = get_client_ip(request)
+    allowed, scope, retry_after = check_login_allowed(username, ip_address)
+    if not allowed:
+        minutes = (retry_after + 59) // 60
+        if scope == 'user':
+            messages.error(request, f"Account is locked due to multiple failed attempts. Try again in {minutes} minutes.")
+        else:
+            messages.error(request, f"Too many failed login attempts from your network. Try again in {minutes} minutes.")
+        response = _render_login(request, form)
+        response.status_code = 429
+        response['Retry-After'] = str(retry_after)
+        return None, None, response
+    
+    # Get user and profile in one query; the encoding comes from the cache
+    from django.contrib.auth.models import User
+    try:
+        user = User.objects.select_related('profile').defer('profile__face_encoding').get(username=username)
+    except User.DoesNotExist:
+        record_login_failure(username, ip_address)
+        messages.error(request, "Invalid username or password.")
+        return None, None, _render_login(request, form)
+    
+    # Check if profile exists and create if it doesn't
+    try:
+        profile = user.profile
+    except UserProfile.DoesNotExist:
+        profile = UserProfile.objects.create(user=user)
+        messages.info(request, "User profile was created.")
+    
+    # Check password against the user already loaded; authenticate() would fetch it again
+    with span('password'):
+        password_ok = user.check_password(password)
+    if not (password_ok and LOGIN_BACKEND.user_can_authenticate(user)):
+        # Record failed login
+        if record_login_failure(username, ip_address):
+            messages.error(request, "Account locked due to multiple failed login attempts.")
+        else:
             messages.error(request, "Invalid username or password.")
-            return render(request, 'authentication/login.html', {'form': form})
-        
-        # Check if profile exists and create if it doesn't
-        try:
-            profile = UserProfile.objects.get(user=user)
-        except UserProfile.DoesNotExist:
-            profile = UserProfile.objects.create(user=user)
-            messages.info(request, "User profile was created.")
         
-        # Check if account is locked
-        if profile.is_locked:
-            lockout_time = settings.LOCKOUT_TIME_MINUTES
-            if profile.last_failed_login and timezone.now() < profile.last_failed_login + timedelta(minutes=lockout_time):
-                remaining_time = (profile.last_failed_login + timedelta(minutes=lockout_time) - timezone.now())
-                minutes = int(remaining_time.total_seconds() // 60)
-                messages.error(request, f"Account is locked due to multiple failed attempts. Try again in {minutes} minutes.")
-                return render(request, 'authentication/login.html', {'form': form})
-            else:
-                # Reset lockout
-                profile.is_locked = False
-                profile.login_attempts = 0
-                profile.save()
-        
-        # Check password
-        user = authenticate(username=username, password=password)
-        if not user:
-            # Record failed login
-            profile.login_attempts += 1
-            profile.last_failed_login = timezone.now()
-            
-            if profile.login_attempts >= settings.MAX_FAILED_LOGIN_ATTEMPTS:
-                profile.is_locked = True
-                messages.error(request, "Account locked due to multiple failed login attempts.")
-            else:
-                messages.error(request, "Invalid username or password.")
-                
-            profile.save()
-            
-            LoginLog.objects.create(
-                user_id=User.objects.get(username=username).id,
-                successful=False,
-                ip_address=get_client_ip(request),
-                user_agent=request.META.get('HTTP_USER_AGENT', '')
-            )
-            
-            return render(request, 'authentication/login.html', {'form': form})
+        record_login(
+            user_id=user.id,
+            successful=False,
+            ip_address=ip_address,
+            user_agent=request.META.get('HTTP_USER_AGENT', '')
+        )
         
-        # Face recognition if required
-        score = None
-        if profile.face_encoding:
-            if not face_data:
-                messages.error(request, "Face verification required. Please allow camera access.")
-                return render(request, 'authentication/login.html', {'form': form})
+        return None, None, _render_login(request, form)
+    
+    return user, profile, None
+
+def _check_login_face(request, form, user, profile, match, score, error, faces):
+    """Record the outcome of the face comparison; return an error response unless it matched
+    
+    ``faces`` is how many compared frames showed a face: on a mismatch each
+    counts as a failed attempt, so a burst of frames is not extra free tries.
+    """
+    note_profile(face_match=match, face_score=score, face_error=error)
+    if match:
+        return None
+    
+    if not faces:
+        messages.error(request, error or "Face verification failed. Please try again.")
+        return _render_login(request, form)
+    
+    ip_address = get_client_ip(request)
+    locked = False
+    for _ in range(faces):
+        locked = record_login_failure(user.username, ip_address)
+        if locked:
+            break
+    if locked:
+        messages.error(request, "Account locked due to multiple failed login attempts.")
+    else:
+        messages.error(request, error or "Face verification failed. Please try again.")
+    
+    record_login(
+        user_id=user.id,
+        successful=False,
+        ip_address=ip_address,
+        user_agent=request.META.get('HTTP_USER_AGENT', ''),
+        face_match_score=score
+    )
+    
+    return _render_login(request, form)
+
+def _complete_login(request, form, user, profile, score):
+    """Issue the signed login challenge, log the success and start the session"""
+    # Check if the user has keys of the current algorithm, replace them if not
+    algorithm = preferred_algorithm()
+    if not profile.public_key or not profile.private_key or profile.key_algorithm != algorithm:
+        try:
+            # Take a pre-generated key pair
+            public_key, private_key = claim_key_pair(algorithm)
             
-            try:
-                # Process the face data
-                format, imgstr = face_data.split(';base64,')
-                face_image = base64.b64decode(imgstr)
-                
-                from io import BytesIO
-                import tempfile
-                from PIL import Image
-                
-                img = Image.open(BytesIO(face_image))
-                temp_file = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-                img.save(temp_file.name)
-                
-                # Compare faces
-                match, score, error = compare_faces(profile.face_encoding, temp_file.name)
-                
-                import os
-                os.unlink(temp_file.name)
-                
-                if error:
-                    messages.error(request, error)
-                    return render(request, 'authentication/login.html', {'form': form})
-                
-                if not match:
-                    profile.login_attempts += 1
-                    profile.last_failed_login = timezone.now()
-                    
-                    if profile.login_attempts >= settings.MAX_FAILED_LOGIN_ATTEMPTS:
-                        profile.is_locked = True
-                        messages.error(request, "Account locked due to multiple failed login attempts.")
-                    else:
-                        messages.error(request, "Face verification failed. Please try again.")
-                        
-                    profile.save()
-                    
-                    LoginLog.objects.create(
-                        user=user,
-                        successful=False,
-                        ip_address=get_client_ip(request),
-                        user_agent=request.META.get('HTTP_USER_AGENT', ''),
-                        face_match_score=score
-                    )
-                    
-                    return render(request, 'authentication/login.html', {'form': form})
+            # Save keys to profile
+            profile.public_key = public_key
+            profile.private_key = private_key
+            profile.key_algorithm = algorithm
+            profile.save(update_fields=['public_key', 'private_key', 'key_algorithm'])
             
-            except Exception as e:
-                logger.error(f"Face verification error: {str(e)}")
-                messages.error(request, f"Error during face verification: {str(e)}")
-                return render(request, 'authentication/login.html', {'form': form})
-        
-        # Check if the user has keys, generate if not
-        if not profile.public_key or not profile.private_key:
-            try:
-                # Generate new key pair
-                public_key, private_key = generate_key_pair()
-                
-                # Save keys to profile
-                profile.public_key = public_key
-                profile.private_key = private_key
-                profile.save()
-                
-                logger.info(f"Generated new key pair for user {user.username}")
-            except Exception as e:
-                logger.error(f"Key generation failed: {str(e)}")
-                messages.error(request, "Error setting up security credentials. Please contact support.")
-                return render(request, 'authentication/login.html', {'form': form})
-        
-        # Digital signature creation with error handling
-        try:
+            logger.info(f"Assigned new {algorithm} key pair to user {user.username}")
+        except Exception as e:
+            logger.error(f"Key generation failed: {str(e)}")
+            messages.error(request, "Error setting up security credentials. Please contact support.")
+            return _render_login(request, form)
+    
+    # Digital signature creation with error handling
+    try:
+        if getattr(settings, 'LOGIN_CHALLENGE_MODE', 'stateless') == 'database':
             token, expires_at = create_login_challenge(user)
             signature = sign_login_challenge(profile, token)
             
@@ -236,48 +236,163 @@ def login_view(request):
                 signature=signature,  # Corrected parameter name
                 expires_at=expires_at
             )
-        except Exception as e:
-            logger.error(f"Digital signature creation failed: {str(e)}")
-            messages.error(request, "Error during login process. Please try again.")
-            return render(request, 'authentication/login.html', {'form': form})
+            challenge = None
+        else:
+            # Signed, self-describing token kept in the session; LoginChallengeMiddleware
+            # verifies it with the public key on the next request. No row per login
+            challenge = create_signed_challenge(profile)
+            if not challenge:
+                raise ValueError("Failed to generate digital signature")
+    except Exception as e:
+        logger.error(f"Digital signature creation failed: {str(e)}")
+        messages.error(request, "Error during login process. Please try again.")
+        return _render_login(request, form)
+    
+    # Reset failed attempts on successful login
+    record_login_success(user.username)
+    
+    # Log the successful login
+    record_login(
+        user_id=user.id,
+        successful=True,
+        ip_address=get_client_ip(request),
+        user_agent=request.META.get('HTTP_USER_AGENT', ''),
+        face_match_score=score if score is not None else None,
+        # Not checked yet: a failed check on the next request logs signature_verified=False
+        signature_verified=None
+    )
+    
+    login(request, user, backend=LOGIN_BACKEND_PATH)
+    if challenge:
+        # After login(), which starts a new session
+        request.session[CHALLENGE_SESSION_KEY] = challenge
+    messages.success(request, "Login successful!")
+    return redirect('authentication:dashboard')
+
+def login_view(request):
+    if request.user.is_authenticated:
+        return redirect('authentication:dashboard')
         
-        # Reset login attempts on successful login
-        profile.login_attempts = 0
-        profile.is_locked = False
-        profile.save()
+    if request.method == 'POST':
+        form = _login_form(request)
+        user, profile, response = _check_login_password(request, form)
+        if response:
+            return response
         
-        # Log the successful login
-        LoginLog.objects.create(
-            user=user,
-            successful=True,
-            ip_address=get_client_ip(request),
-            user_agent=request.META.get('HTTP_USER_AGENT', ''),
-            face_match_score=score if score is not None else None,
-            signature_verified=True
-        )
+        # Face recognition if required
+        score = None
+        # The flag skips the template lookup for users without a face
+        templates = get_user_templates(user.id) if profile.has_face_data else None
+        if templates is not None:
+            frames = [face_data for face_data in request.POST.getlist('face_data') if face_data]
+            if not frames:
+                messages.error(request, "Face verification required. Please allow camera access.")
+                return _render_login(request, form)
+            
+            try:
+                # Compare faces; a burst of frames stops at the first confident one
+                if len(frames) > 1:
+                    burst = verify_burst(templates, frames, 'login')
+                    match, score, error, probe = burst.match, burst.score, burst.error, burst.encoding
+                    faces = burst.faces
+                else:
+                    match, score, error, probe = run_face_task(match_face_data, templates, frames[0], 'login')
+                    faces = int(probe is not None)
+            except FacePoolBusy:
+                messages.error(request, BUSY_MESSAGE)
+                return _retry_later(_render_login(request, form))
+            except Exception as e:
+                logger.error(f"Face verification error: {str(e)}")
+                messages.error(request, f"Error during face verification: {str(e)}")
+                return _render_login(request, form)
+            
+            response = _check_login_face(request, form, user, profile, match, score, error, faces)
+            if response:
+                return response
+            
+            # A confident capture unlike the stored ones becomes another template
+            learn_from_login(user.id, probe, templates)
         
-        login(request, user)
-        messages.success(request, "Login successful!")
-        return redirect('authentication:dashboard')
+        return _complete_login(request, form, user, profile, score)
     else:
         form = CustomAuthenticationForm()
     
-    return render(request, 'authentication/login.html', {'form': form})
-@login_required
-def dashboard_view(request):
-    # Ensure user has a profile
+    return _render_login(request, form)
+
+async def login_async_view(request):
+    """Login for ASGI deployments: the face comparison is awaited instead of holding a thread"""
+    user = await request.auser()
+    if user.is_authenticated:
+        return redirect('authentication:dashboard')
+    
+    if request.method != 'POST':
+        return await sync_to_async(_render_login)(request, CustomAuthenticationForm())
+    
+    form = _login_form(request)
+    user, profile, response = await sync_to_async(_check_login_password)(request, form)
+    if response:
+        return response
+    
+    # Face recognition if required
+    score = None
+    templates = await aget_user_templates(user.id) if profile.has_face_data else None
+    if templates is not None:
+        frames = [face_data for face_data in request.POST.getlist('face_data') if face_data]
+        if not frames:
+            messages.error(request, "Face verification required. Please allow camera access.")
+            return await sync_to_async(_render_login)(request, form)
+        
+        try:
+            # Compare faces; a burst of frames stops at the first confident one
+            if len(frames) > 1:
+                burst = await averify_burst(templates, frames, 'login')
+                match, score, error, probe = burst.match, burst.score, burst.error, burst.encoding
+                faces = burst.faces
+            else:
+                match, score, error, probe = await run_face_task_async(match_face_data, templates, frames[0], 'login')
+                faces = int(probe is not None)
+        except FacePoolBusy:
+            messages.error(request, BUSY_MESSAGE)
+            return _retry_later(await sync_to_async(_render_login)(request, form))
+        except Exception as e:
+            logger.error(f"Face verification error: {str(e)}")
+            messages.error(request, f"Error during face verification: {str(e)}")
+            return await sync_to_async(_render_login)(request, form)
+        
+        response = await sync_to_async(_check_login_face)(request, form, user, profile, match, score, error, faces)
+        if response:
+            return response
+        
+        # A confident capture unlike the stored ones becomes another template
+        await sync_to_async(learn_from_login)(user.id, probe, templates)
+    
+    return await sync_to_async(_complete_login)(request, form, user, profile, score)
+
+def _profile_without_blobs(user):
+    """The user's profile with the encoding and key columns deferred, created if missing"""
     try:
-        profile = request.user.profile
+        return UserProfile.objects.defer(*UserProfile.HEAVY_FIELDS).get(user=user)
     except UserProfile.DoesNotExist:
-        profile = UserProfile.objects.create(user=request.user)
+        return UserProfile.objects.create(user=user)
+
+@login_required
+def dashboard_view(request):
+    # Ensure user has a profile; only its flags are shown
+    profile = _profile_without_blobs(request.user)
     
     # Get recent login history
     login_logs = LoginLog.objects.filter(user=request.user).order_by('-timestamp')[:5]
     
+    # 30-day totals come from the pre-aggregated daily rollups
+    login_summary = summarize_logins(request.user, timezone.now() - timedelta(days=30))
+    if login_summary['score_mean'] is not None:
+        login_summary['score_mean'] = round(login_summary['score_mean'] * 100, 1)
+    
     context = {
         'user': request.user,
         'login_logs': login_logs,
-        'has_face_data': bool(profile.face_encoding)
+        'login_summary': login_summary,
+        'has_face_data': profile.has_face_data
     }
     
     return render(request, 'authentication/dashboard.html', context)
@@ -285,44 +400,33 @@ def dashboard_view(request):
 @login_required
 def profile_view(request):
     # Ensure user has a profile
-    try:
-        profile = request.user.profile
-    except UserProfile.DoesNotExist:
-        profile = UserProfile.objects.create(user=request.user)
+    profile = _profile_without_blobs(request.user)
     
     if request.method == 'POST':
         form = UserProfileForm(request.POST, request.FILES, instance=profile)
         
         if 'face_data' in request.POST and request.POST['face_data']:
             try:
-                # Process base64 data from webcam
-                face_data = request.POST['face_data']
-                format, imgstr = face_data.split(';base64,')
-                face_image = base64.b64decode(imgstr)
-                
-                # Create a BytesIO object
-                from io import BytesIO
-                import tempfile
-                from PIL import Image
-                img = Image.open(BytesIO(face_image))
-                temp_file = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-                img.save(temp_file.name)
-                
                 # Process the face image
-                encoding_bytes, error = process_face_image(temp_file.name)
+                encoding, error = run_face_task(extract_face_data, request.POST['face_data'], 'profile')
                 
                 if error:
                     messages.error(request, error)
-                else:
-                    # Save the face encoding
-                    profile.face_encoding = encoding_bytes
-                    profile.save()
+                elif request.POST.get('replace_face_templates'):
+                    # Start over from this capture alone
+                    replace_templates(request.user.id, encoding, profile=profile)
                     messages.success(request, "Face updated successfully!")
+                else:
+                    # Keep the earlier captures too: another angle, glasses, lighting
+                    add_template(request.user.id, encoding, profile=profile)
+                    messages.success(request, "Face added successfully!")
                 
-                # Clean up the temp file
-                import os
-                os.unlink(temp_file.name)
-                
+            except FacePoolBusy:
+                messages.error(request, BUSY_MESSAGE)
+                return _retry_later(render(request, 'authentication/profile.html', {
+                    'form': form,
+                    'has_face_data': profile.has_face_data
+                }))
             except Exception as e:
                 messages.error(request, f"Error processing face image: {str(e)}")
         
@@ -335,7 +439,8 @@ def profile_view(request):
     
     context = {
         'form': form,
-        'has_face_data': bool(profile.face_encoding)
+        'has_face_data': profile.has_face_data,
+        'face_template_count': FaceTemplate.objects.filter(user=request.user).count() if profile.has_face_data else 0
     }
     return render(request, 'authentication/profile.html', context)
 
@@ -344,6 +449,16 @@ def logout_view(request):
     messages.success(request, "Logged out successfully!")
     return redirect('authentication:login')
 
+def _face_verification_response(match, score, error):
+    note_profile(face_match=match, face_score=score, face_error=error)
+    if error:
+        return JsonResponse({'success': False, 'error': error})
+    
+    if match:
+        return JsonResponse({'success': True, 'score': round(score * 100, 2)})
+    else:
+        return JsonResponse({'success': False, 'error': 'Face verification failed', 'score': round(score * 100, 2)})
+
 @require_POST
 def verify_face_view(request):
     """AJAX endpoint to verify face without completing login"""
@@ -361,56 +476,235 @@ def verify_face_view(request):
         
         # Get user
         from django.contrib.auth.models import User
-        try:
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
+        user_id = User.objects.filter(username=username).values_list('id', flat=True).first()
+        if user_id is None:
             return JsonResponse({'success': False, 'error': 'User not found'})
-            
-        # Get or create profile
-        try:
-            profile = user.profile
-        except UserProfile.DoesNotExist:
-            profile = UserProfile.objects.create(user=user)
         
-        if not profile.face_encoding:
+        templates = get_user_templates(user_id)
+        if templates is None:
             return JsonResponse({'success': False, 'error': 'No face data registered for this user'})
         
-        # Process the face data
-        format, imgstr = face_data.split(';base64,')
-        face_image = base64.b64decode(imgstr)
+        # Compare faces
+        match, score, error = run_face_task(compare_face_data, templates, face_data, 'verify')
+        return _face_verification_response(match, score, error)
+        
+    except FacePoolBusy:
+        return _retry_later(JsonResponse({'success': False, 'error': BUSY_MESSAGE, 'retry': True}))
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': f"Error: {str(e)}"})
+
+@require_POST
+async def verify_face_async_view(request):
+    """Async variant of verify_face_view for ASGI: many precheck requests share one worker"""
+    
+    if not request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return JsonResponse({'success': False, 'error': 'Invalid request'})
+    
+    try:
+        data = json.loads(request.body)
+        username = data.get('username')
+        face_data = data.get('face_data')
+        
+        if not username or not face_data:
+            return JsonResponse({'success': False, 'error': 'Missing required data'})
         
-        # Create a temp file
-        from io import BytesIO
-        import tempfile
-        from PIL import Image
+        # Get user
+        from django.contrib.auth.models import User
+        user_id = await User.objects.filter(username=username).values_list('id', flat=True).afirst()
+        if user_id is None:
+            return JsonResponse({'success': False, 'error': 'User not found'})
         
-        img = Image.open(BytesIO(face_image))
-        temp_file = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-        img.save(temp_file.name)
+        templates = await aget_user_templates(user_id)
+        if templates is None:
+            return JsonResponse({'success': False, 'error': 'No face data registered for this user'})
         
-        # Compare faces
-        match, score, error = compare_faces(profile.face_encoding, temp_file.name)
+        # Compare faces off the event loop
+        match, score, error = await run_face_task_async(compare_face_data, templates, face_data, 'verify')
+        return _face_verification_response(match, score, error)
         
-        # Clean up the temp file
-        import os
-        os.unlink(temp_file.name)
+    except FacePoolBusy:
+        return _retry_later(JsonResponse({'success': False, 'error': BUSY_MESSAGE, 'retry': True}))
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': f"Error: {str(e)}"})
+
+def _ndjson_lines(request):
+    """Parse an NDJSON body line by line, reading it only as far as needed"""
+    for line in request:
+        if line.strip():
+            yield json.loads(line)
+
+def _burst_response(result):
+    note_profile(face_match=result.match, face_score=result.score, face_error=result.error,
+                 face_frames=len(result.frames))
+    body = {
+        'success': result.match,
+        'score': round(result.score * 100, 2),
+        'stopped': result.stopped,
+        'frames': [
+            {'index': frame['index'], 'match': frame['match'], 'score': round(frame['score'] * 100, 2),
+             'error': frame['error']}
+            for frame in result.frames
+        ],
+    }
+    if not result.match:
+        body['error'] = result.error
+    return JsonResponse(body)
+
+@require_POST
+def verify_face_burst_view(request):
+    """AJAX endpoint to verify a burst of frames, stopping once one is conclusive
+    
+    Frames come as multipart form data (``username``, then ``frames`` image files
+    and/or ``face_data`` data URLs) or as NDJSON (``application/x-ndjson``): a
+    ``{"username": ...}`` line followed by one ``{"face_data": ...}`` line per
+    frame, streamed so that frames after the decision are never read.
+    """
+    
+    if not request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return JsonResponse({'success': False, 'error': 'Invalid request'})
+    
+    try:
+        if request.content_type == 'application/x-ndjson':
+            lines = _ndjson_lines(request)
+            username = next(lines, {}).get('username')
+            frames = (line['face_data'] for line in lines if line.get('face_data'))
+        else:
+            username = request.POST.get('username')
+            frames = itertools.chain(
+                (upload.read() for upload in request.FILES.getlist('frames')),
+                (face_data for face_data in request.POST.getlist('face_data') if face_data),
+            )
+        
+        if not username:
+            return JsonResponse({'success': False, 'error': 'Missing required data'})
+        
+        # Get user
+        from django.contrib.auth.models import User
+        user_id = User.objects.filter(username=username).values_list('id', flat=True).first()
+        if user_id is None:
+            return JsonResponse({'success': False, 'error': 'User not found'})
+        
+        templates = get_user_templates(user_id)
+        if templates is None:
+            return JsonResponse({'success': False, 'error': 'No face data registered for this user'})
+        
+        return _burst_response(verify_burst(templates, frames, 'verify'))
+        
+    except FacePoolBusy:
+        return _retry_later(JsonResponse({'success': False, 'error': BUSY_MESSAGE, 'retry': True}))
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': f"Error: {str(e)}"})
+
+@require_POST
+def identify_face_view(request):
+    """AJAX endpoint to find which enrolled users a face belongs to, without a username; staff only"""
+    
+    # Names enrolled users from a photo, so it is neither public nor unlimited
+    if not (request.user.is_authenticated and request.user.is_staff):
+        return JsonResponse({'success': False, 'error': 'Permission denied'}, status=403)
+    
+    if not request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return JsonResponse({'success': False, 'error': 'Invalid request'})
+    
+    allowed, retry_after = check_identify_allowed(request.user.id, get_client_ip(request))
+    if not allowed:
+        response = JsonResponse({'success': False, 'error': 'Too many identification requests. Try again later.'},
+                                status=429)
+        response['Retry-After'] = str(retry_after)
+        return response
+    
+    try:
+        data = json.loads(request.body)
+        face_data = data.get('face_data')
         
+        if not face_data:
+            return JsonResponse({'success': False, 'error': 'Missing required data'})
+        
+        max_k = getattr(settings, 'FACE_IDENTIFY_TOP_K', 5)
+        k = min(max(int(data.get('k') or max_k), 1), max_k)
+        
+        # Encode the probe face
+        encoding, error = run_face_task(extract_face_data, face_data, 'identify')
         if error:
             return JsonResponse({'success': False, 'error': error})
         
-        if match:
-            return JsonResponse({'success': True, 'score': round(score * 100, 2)})
-        else:
-            return JsonResponse({'success': False, 'error': 'Face verification failed', 'score': round(score * 100, 2)})
+        # One batched distance computation against every enrolled face
+        candidates = identify_face(encoding, k=k)
+        if not candidates:
+            return JsonResponse({'success': False, 'error': 'Face not recognized', 'matches': []})
         
+        from django.contrib.auth.models import User
+        usernames = dict(User.objects.filter(id__in=[user_id for user_id, _ in candidates]).values_list('id', 'username'))
+        matches = [
+            {'username': usernames[user_id], 'score': round((1 - distance) * 100, 2)}
+            for user_id, distance in candidates if user_id in usernames
+        ]
+        return JsonResponse({'success': bool(matches), 'matches': matches})
+        
+    except FacePoolBusy:
+        return _retry_later(JsonResponse({'success': False, 'error': BUSY_MESSAGE, 'retry': True}))
     except Exception as e:
         return JsonResponse({'success': False, 'error': f"Error: {str(e)}"})
 
+def metrics_view(request):
+    """Prometheus scrape endpoint; staff only, or a bearer token matching METRICS_TOKEN"""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorized = request.user.is_authenticated and request.user.is_staff
+    if token and request.headers.get('Authorization') == f"Bearer {token}":
+        authorized = True
+    if not authorized:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@staff_member_required
+def profiles_view(request):
+    """List stored request profiles and switch the profiling toggle on or off"""
+    if request.method == 'POST':
+        if request.POST.get('action') == 'stop':
+            profiling.clear_toggle()
+            messages.success(request, "Profiling toggle switched off.")
+        else:
+            try:
+                minutes = min(max(float(request.POST.get('minutes') or 5), 1), 60)
+            except ValueError:
+                minutes = 5
+            username = request.POST.get('username', '').strip()
+            profiling.set_toggle(minutes, username)
+            messages.success(request, f"Profiling {'requests from ' + username if username else 'all requests'} "
+                                      f"for {minutes:g} minutes.")
+        return redirect('authentication:profiles')
+    
+    context = {
+        'title': 'Request profiles',
+        'profiles': profiling.list_profiles(),
+        'toggle': profiling.get_toggle(),
+        'header': getattr(settings, 'PROFILING_HEADER', 'X-Profile-Request'),
+        'token': profiling.make_trigger_token(),
+        'token_minutes': getattr(settings, 'PROFILING_TOKEN_MAX_AGE', 3600) // 60,
+        'sample_rate': getattr(settings, 'PROFILING_SAMPLE_RATE', 0),
+    }
+    return render(request, 'authentication/profiles.html', context)
+
+@staff_member_required
+def profile_download_view(request, name):
+    """Download one stored request profile"""
+    path = profiling.profile_path(name)
+    if path is None:
+        raise Http404("No such profile")
+    try:
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=path.rsplit('/', 1)[-1])
+    except FileNotFoundError:
+        raise Http404("No such profile")
+
 def get_client_ip(request):
-    """Get client IP address from request"""
-    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-    if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0]
-    else:
-        ip = request.META.get('REMOTE_ADDR')
-    return ip
\ No newline at end of file
+    """Get client IP address from request
+    
+    Only the ``TRUSTED_PROXY_COUNT`` rightmost X-Forwarded-For entries were
+    added by our proxies; anything left of them is whatever the client sent.
+    """
+    proxies = getattr(settings, 'TRUSTED_PROXY_COUNT', 0)
+    if proxies:
+        forwarded = [ip.strip() for ip in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if ip.strip()]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR')
\ No newline at end of file
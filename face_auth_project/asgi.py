@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'face_auth_project.settings')
 
 application = get_asgi_application()
+
+# Start the face processing workers now instead of on the first logins
+from authentication.face_pool import prewarm_face_pool  # noqa: E402
+prewarm_face_pool()
@@ -32,12 +32,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'authentication.middleware.ServerTimingMiddleware',
+    'authentication.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'authentication.middleware.LoginChallengeMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -155,9 +158,204 @@ FACE_DATA_DIR = os.path.join(MEDIA_ROOT, 'face_data')
 if not os.path.exists(FACE_DATA_DIR):
     os.makedirs(FACE_DATA_DIR, exist_ok=True)
 
+# Server-side face state (the gallery file and ANN index) lives outside MEDIA_ROOT,
+# which is served under MEDIA_URL. A gallery file missing here is seeded from the
+# database on first use; rebuild the index with "manage.py rebuild_face_index".
+FACE_STATE_DIR = os.getenv('FACE_STATE_DIR', os.path.join(BASE_DIR, 'var'))
+os.makedirs(FACE_STATE_DIR, exist_ok=True)
+
+# Face detection runs first on a copy downscaled to FACE_DETECTION_MAX_DIMENSION px
+# (long side), with FACE_DETECTION_UPSAMPLE HOG upsamples; only if that finds nothing
+# is the full-resolution frame searched with FACE_DETECTION_FALLBACK_UPSAMPLE
+# upsamples (None skips the fallback). Set FACE_DETECTION_MAX_DIMENSION = None to
+# always detect at full resolution. Per-stage timings are in the Server-Timing
+# response header and the stage_duration_seconds metric.
+FACE_DETECTION_MAX_DIMENSION = 320
+FACE_DETECTION_UPSAMPLE = 1
+FACE_DETECTION_FALLBACK_UPSAMPLE = 1
+
+# Face detector backend per endpoint: 'hog' (dlib HOG), 'cnn' (dlib CNN), 'yunet'
+# (OpenCV FaceDetectorYN, ONNX model) or 'opencv_dnn' (OpenCV DNN SSD, e.g. res10
+# Caffe model). Endpoints: register, login, profile, verify, identify, enroll; anything not
+# listed uses 'default'. E.g. a fast 'yunet' on the AJAX 'verify' precheck and a
+# more precise 'cnn' on the final 'login'.
+FACE_DETECTOR_BACKENDS = {
+    'default': 'hog',
+}
+FACE_DETECTOR_OPTIONS = {
+    'yunet': {
+        'model_path': os.path.join(BASE_DIR, 'models', 'face_detection_yunet_2023mar.onnx'),
+        'score_threshold': 0.9,
+    },
+    'opencv_dnn': {
+        'model_path': os.path.join(BASE_DIR, 'models', 'res10_300x300_ssd_iter_140000.caffemodel'),
+        'config_path': os.path.join(BASE_DIR, 'models', 'deploy.prototxt'),
+        'score_threshold': 0.7,
+    },
+}
+
+# Face detection/encoding runs in a pool of FACE_POOL_WORKERS pre-warmed processes
+# (0 = inline in the request thread). At most FACE_POOL_MAX_QUEUE tasks wait for a
+# worker; further requests, or tasks unfinished after FACE_POOL_TIMEOUT seconds, get
+# a 503 with Retry-After: FACE_POOL_RETRY_AFTER.
+# The pool is per Django process and each worker loads the dlib models: N web
+# workers (gunicorn/uvicorn) start N x FACE_POOL_WORKERS of them, so size it to
+# about the number of cores divided by the number of web workers.
+FACE_POOL_WORKERS = int(os.getenv('FACE_POOL_WORKERS', 2))
+FACE_POOL_MAX_QUEUE = int(os.getenv('FACE_POOL_MAX_QUEUE', 2 * FACE_POOL_WORKERS))
+FACE_POOL_TIMEOUT = 10
+FACE_POOL_RETRY_AFTER = 2
+FACE_POOL_PREWARM = True
+
+# Async views (served under ASGI) await face work instead of holding a thread; this caps
+# how many face computations one event loop has outstanding at a time.
+FACE_ASYNC_CONCURRENCY = int(os.getenv('FACE_ASYNC_CONCURRENCY', FACE_POOL_WORKERS + FACE_POOL_MAX_QUEUE))
+
+# Decoded stored encodings are cached per user (LRU, per process) for
+# FACE_ENCODING_CACHE_TTL seconds. Set FACE_ENCODING_CACHE_ALIAS to a CACHES alias
+# (e.g. Redis or memcached) to share them between workers as well.
+FACE_ENCODING_CACHE_SIZE = 10000
+FACE_ENCODING_CACHE_TTL = 60
+FACE_ENCODING_CACHE_ALIAS = os.getenv('FACE_ENCODING_CACHE_ALIAS') or None
+
+# Login challenges are signed with SIGNATURE_ALGORITHM ('rsa-pkcs1v15', 'ed25519' or
+# 'ecdsa-p256'). Profiles holding keys of another algorithm get a new pair at their
+# next login. Parsed keys are cached per user (SIGNING_KEY_CACHE_SIZE entries).
+SIGNATURE_ALGORITHM = os.getenv('SIGNATURE_ALGORITHM', 'ed25519')
+SIGNING_KEY_CACHE_SIZE = 10000
+
+# 'stateless' login challenges are signed tokens carrying user, nonce and expiry, kept
+# in the session and verified with the public key on the next request
+# (LoginChallengeMiddleware); nonces are remembered in the LOGIN_CHALLENGE_CACHE_ALIAS
+# cache until expiry to stop replays, so it must be shared like the rate-limit store.
+# 'database' stores a DigitalSignature row per login instead.
+LOGIN_CHALLENGE_MODE = os.getenv('LOGIN_CHALLENGE_MODE', 'stateless')
+LOGIN_CHALLENGE_TTL_SECONDS = 300
+LOGIN_CHALLENGE_CACHE_ALIAS = 'rate_limit'
+
+# Login attempts are logged by a background writer in batches of LOGIN_LOG_BATCH_SIZE
+# or every LOGIN_LOG_FLUSH_SECONDS. Batches that cannot be written are appended to
+# LOGIN_LOG_SPOOL_FILE and replayed once the database is reachable again.
+LOGIN_LOG_BUFFERED = os.getenv('LOGIN_LOG_BUFFERED', 'True').lower() == 'true'
+LOGIN_LOG_BATCH_SIZE = 100
+LOGIN_LOG_FLUSH_SECONDS = 1.0
+LOGIN_LOG_SPOOL_FILE = os.path.join(BASE_DIR, 'login_log_spool.jsonl')
+
+# Each hourly/daily LoginStat rollup keeps at most LOGIN_STAT_MAX_IPS distinct client
+# IPs; past that the bucket is flagged and its IP count shown as a lower bound ("50+").
+LOGIN_STAT_MAX_IPS = 50
+
+# `manage.py purge_auth_records` deletes expired DigitalSignature rows and login logs
+# older than LOGIN_LOG_RETENTION_DAYS, RETENTION_CHUNK_SIZE rows per transaction.
+LOGIN_LOG_RETENTION_DAYS = 90
+RETENTION_CHUNK_SIZE = 1000
+
+# Registration claims key pairs generated ahead of time. `manage.py fill_key_pool`
+# tops the pool up to KEY_POOL_TARGET; with KEY_POOL_BACKGROUND_REFILL a claim that
+# leaves fewer than KEY_POOL_LOW_WATER pairs also starts a refill thread.
+KEY_POOL_TARGET = int(os.getenv('KEY_POOL_TARGET', 100))
+KEY_POOL_LOW_WATER = int(os.getenv('KEY_POOL_LOW_WATER', 20))
+KEY_POOL_BACKGROUND_REFILL = True
+
+# Bearer token allowed to scrape /auth/metrics/ (staff users can always view it)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Send each response's stage timings (decode, detect, encode, sign, db, ...) in a
+# Server-Timing header; the latency histograms are kept either way. Off unless
+# DEBUG: on the login endpoints the breakdown is a timing oracle for anyone.
+SERVER_TIMING_HEADER = os.getenv('SERVER_TIMING_HEADER', str(DEBUG)).lower() == 'true'
+
+# On-demand request profiling (see authentication/profiling.py). A request is profiled
+# when it carries a PROFILING_HEADER token from /auth/profiles/, is sampled, or matches
+# the toggle set on that page. Only the newest PROFILING_MAX_PROFILES are kept on disk.
+PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILING_MAX_PROFILES = 50
+PROFILING_MODE = os.getenv('PROFILING_MODE', 'cprofile')  # or 'sampling': collapsed stacks
+PROFILING_SAMPLING_INTERVAL = 0.005
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_HEADER = 'X-Profile-Request'
+PROFILING_TOKEN_MAX_AGE = 3600
+PROFILING_TOGGLE_POLL_SECONDS = 5
+PROFILING_CACHE_ALIAS = 'default'
+
+# Append-only, memory-mapped file of every enrolled encoding, shared by all workers.
+# Rebuild or compact it with "manage.py rebuild_face_gallery"; set to None to disable.
+FACE_GALLERY_FILE = os.path.join(FACE_STATE_DIR, 'gallery.bin')
+
 # Face recognition tolerance (lower is stricter)
 FACE_RECOGNITION_TOLERANCE = 0.6
 
+# Largest frame side (px) worth decoding; bigger JPEGs are decoded at reduced scale
+FACE_IMAGE_MAX_DIMENSION = 800
+
+# 1:N identification: how many candidates to return, and how often each worker
+# reloads its in-memory gallery to pick up enrollments saved by other workers.
+# The endpoint is staff only and limited to FACE_IDENTIFY_RATE_LIMIT requests
+# per user and per IP in each FACE_IDENTIFY_RATE_WINDOW_SECONDS.
+FACE_IDENTIFY_TOP_K = 5
+FACE_GALLERY_MAX_AGE_SECONDS = 300
+FACE_IDENTIFY_RATE_LIMIT = 30
+FACE_IDENTIFY_RATE_WINDOW_SECONDS = 60
+
+# Multi-frame verification (/auth/verify-face/burst/, and logins posting several
+# face_data frames): stop at the first frame closer than the accept distance or
+# further than the reject distance, otherwise after MAX_FRAMES or TIME_BUDGET seconds
+FACE_BURST_ACCEPT_DISTANCE = 0.5
+FACE_BURST_REJECT_DISTANCE = 0.8
+FACE_BURST_MAX_FRAMES = 5
+FACE_BURST_TIME_BUDGET = 3.0
+
+# Several face templates per user (enrollment captures plus learned login captures);
+# the nearest one decides. A capture closer than MEAN_ACCEPT_DISTANCE to the user's
+# mean template is accepted without checking each template (None: always check all).
+# Login captures between the LEARN distances of their nearest template are kept.
+FACE_TEMPLATES_PER_USER = 8
+FACE_TEMPLATE_MEAN_ACCEPT_DISTANCE = 0.3
+FACE_TEMPLATE_LEARNING = True
+FACE_TEMPLATE_LEARN_MIN_DISTANCE = 0.3
+FACE_TEMPLATE_LEARN_MAX_DISTANCE = 0.45
+
+# Approximate nearest-neighbour (IVF/PQ) index for large galleries. Build it with
+# "manage.py rebuild_face_index" and pick nprobe/pq_m with "manage.py benchmark_face_index".
+FACE_ANN_ENABLED = True
+FACE_ANN_INDEX_PATH = os.path.join(FACE_STATE_DIR, 'face_ann_index.npz')
+FACE_ANN_MIN_GALLERY_SIZE = 20000  # below this, brute force is fast enough
+FACE_ANN_NLIST = 1024              # k-means cells (fixed at build time)
+FACE_ANN_PQ_M = 0                  # PQ sub-quantizers, 0 keeps raw vectors (fixed at build time)
+FACE_ANN_NPROBE = 16               # cells scanned per query: higher = better recall, slower
+FACE_ANN_RERANK = 4                # shortlist k * RERANK candidates and re-score them exactly
+
 # Maximum failed login attempts before temporary lockout
 MAX_FAILED_LOGIN_ATTEMPTS = 5
-LOCKOUT_TIME_MINUTES = 15
\ No newline at end of file
+LOCKOUT_TIME_MINUTES = 15
+
+# Failed logins are counted per username and per client IP over a sliding window
+# (None: the lockout length), in the LOGIN_RATE_LIMIT_CACHE_ALIAS cache. That store
+# must be shared by every worker and must not evict live keys: a local-memory
+# cache drops the oldest entries once full, so a flood of junk usernames would
+# lift any lock. It is Redis when REDIS_URL is set (configure it with a noeviction
+# or volatile-* policy), otherwise a database cache table created by
+# `manage.py createcachetable`; the app refuses to start with a local-memory one.
+LOGIN_FAILURE_WINDOW_SECONDS = None
+LOGIN_IP_MAX_FAILED_ATTEMPTS = 20
+LOGIN_RATE_LIMIT_CACHE_ALIAS = 'rate_limit'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'rate_limit': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL'),
+    } if os.getenv('REDIS_URL') else {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'auth_rate_limit_cache',
+        # Only expired rows are culled; live counters and locks are never dropped
+        'OPTIONS': {'MAX_ENTRIES': 10 ** 12},
+    },
+}
+
+# Number of reverse proxies in front of the app that append the client address to
+# X-Forwarded-For. 0 trusts only REMOTE_ADDR; N takes the address the outermost
+# trusted proxy saw. Entries further left are sent by the client and never used.
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 0))
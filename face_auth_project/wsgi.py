@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'face_auth_project.settings')
 
 application = get_wsgi_application()
+
+# Start the face processing workers now instead of on the first logins
+from authentication.face_pool import prewarm_face_pool  # noqa: E402
+prewarm_face_pool()
@@ -9,9 +9,15 @@ let previewImage = null;
 let videoContainer = null;
 let captureContainer = null;
 let faceFeedback = null;
+let burstSize = 1;
+let burstInputs = [];
 
-// Initialize the webcam capture UI
-function initWebcam(containerId, inputId, previewId, captureId, retakeId, feedbackId = null) {
+// Extra frames of a burst are taken this far apart, so one blurry frame is not fatal
+const BURST_INTERVAL_MS = 150;
+
+// Initialize the webcam capture UI; burstFrames > 1 captures that many frames per capture
+function initWebcam(containerId, inputId, previewId, captureId, retakeId, feedbackId = null, burstFrames = 1) {
+    burstSize = burstFrames;
     videoContainer = document.getElementById(containerId);
     faceDataInput = document.getElementById(inputId);
     previewImage = document.getElementById(previewId);
@@ -85,23 +91,47 @@ function stopCamera() {
     }
 }
 
-// Capture face from webcam
-function captureFace() {
-    if (!videoElement || !canvas) return;
-
+// Draw the current video frame and return it as a base64 JPEG data URL
+function grabFrame() {
     // Set canvas dimensions to match video
     canvas.width = videoElement.videoWidth;
     canvas.height = videoElement.videoHeight;
     
-    // Draw the current video frame to canvas
     const context = canvas.getContext('2d');
     context.drawImage(videoElement, 0, 0, canvas.width, canvas.height);
+    return canvas.toDataURL('image/jpeg');
+}
+
+// Add the rest of a burst as extra face_data inputs, then stop the camera
+function captureBurstFrames(remaining) {
+    if (remaining <= 0 || !stream) {
+        stopCamera();
+        return;
+    }
+    setTimeout(function() {
+        if (!stream) return;
+        const input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = faceDataInput.name;
+        input.value = grabFrame();
+        faceDataInput.parentNode.appendChild(input);
+        burstInputs.push(input);
+        captureBurstFrames(remaining - 1);
+    }, BURST_INTERVAL_MS);
+}
+
+// Capture face from webcam
+function captureFace() {
+    if (!videoElement || !canvas) return;
+
+    const imageData = grabFrame();
     
-    // Convert canvas to base64 data URL
-    const imageData = canvas.toDataURL('image/jpeg');
-    
-    // Stop the camera
-    stopCamera();
+    // Stop the camera, after the rest of the burst when there is one
+    if (burstSize > 1) {
+        captureBurstFrames(burstSize - 1);
+    } else {
+        stopCamera();
+    }
     
     // Hide video, show preview
     videoContainer.style.display = 'none';
@@ -117,8 +147,11 @@ function captureFace() {
 // Restart the camera to retake photo
 function restartCamera() {
     // Clear the preview and form data
+    stopCamera();
     previewImage.src = '';
     faceDataInput.value = '';
+    burstInputs.forEach(input => input.remove());
+    burstInputs = [];
     
     // Hide preview, show video
     previewImage.parentElement.style.display = 'none';
@@ -148,19 +181,35 @@ function verifyFace(username) {
     // Get CSRF token
     const csrfToken = document.querySelector('[name=csrfmiddlewaretoken]').value;
 
-    // Send request to verify face
-    fetch('/auth/verify-face/', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-            'X-CSRFToken': csrfToken,
-            'X-Requested-With': 'XMLHttpRequest'
-        },
-        body: JSON.stringify({
-            username: username,
-            face_data: faceDataInput.value
-        })
-    })
+    // Send request to verify face; a burst goes to the multi-frame endpoint
+    let request;
+    if (burstInputs.length) {
+        const body = new FormData();
+        body.append('username', username);
+        [faceDataInput, ...burstInputs].forEach(input => body.append('face_data', input.value));
+        request = fetch('/auth/verify-face/burst/', {
+            method: 'POST',
+            headers: {
+                'X-CSRFToken': csrfToken,
+                'X-Requested-With': 'XMLHttpRequest'
+            },
+            body: body
+        });
+    } else {
+        request = fetch('/auth/verify-face/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': csrfToken,
+                'X-Requested-With': 'XMLHttpRequest'
+            },
+            body: JSON.stringify({
+                username: username,
+                face_data: faceDataInput.value
+            })
+        });
+    }
+    request
     .then(response => response.json())
     .then(data => {
         if (data.success) {